@@ -0,0 +1,113 @@
+import json
+import os
+import re
+from functools import lru_cache
+
+# Config
+ALIAS_FILE = "address_aliases.json"
+
+# Canonical address keys
+#
+# Every stage that matches addresses (geocode cache, feature engineering,
+# training-data dedupe and comp labels, feedback, explanations) goes through
+# address_key, so the same street written as "12 Rock Lake Point NW",
+# "12 rock lake pt nw" or "Unit 3 - 12 ..." vs "3-12 ..." maps to one key.
+# Suffixes and directions are abbreviated as whole words only, so names like
+# "Broadway" are never rewritten.
+#
+# address_aliases.json maps every raw variant seen during cleaning to its
+# key. It is checked before the rules, so an entry can be edited by hand to
+# merge two spellings the rules keep apart, and the geocoder uses it to try
+# other spellings of an address before asking the LLM. One alias file is
+# active at a time (use_aliases); it is read from and saved to that path.
+
+SUFFIXES = {
+    "street": "st", "str": "st", "road": "rd", "avenue": "ave", "av": "ave",
+    "drive": "dr", "crescent": "cres", "court": "crt", "ct": "crt",
+    "place": "pl", "lane": "ln", "terrace": "terr", "ter": "terr",
+    "boulevard": "blvd", "circle": "cir", "parkway": "pkwy", "highway": "hwy",
+    "point": "pt", "square": "sq", "trail": "trl", "heights": "hts",
+    "north": "n", "south": "s", "east": "e", "west": "w",
+    "northeast": "ne", "northwest": "nw", "southeast": "se", "southwest": "sw",
+}
+UNIT_WORDS = {"unit", "suite", "ste", "apt", "apartment"}
+
+alias_file = ALIAS_FILE
+aliases = None
+
+
+@lru_cache(maxsize=1 << 16)
+def canonical_key(address):
+    address = str(address).lower()
+    address = re.sub(r"[.,'\"()]", "", address)
+    address = re.sub(r"[-#/]", " ", address)
+    words = [SUFFIXES.get(word, word) for word in address.split() if word not in UNIT_WORDS]
+    return " ".join(words) or None
+
+
+def _variant(address):
+    return " ".join(str(address).split())
+
+
+def use_aliases(path=ALIAS_FILE):
+    # Switches the active alias file, loading it unless it is already active
+    global alias_file, aliases
+    if aliases is None or path != alias_file:
+        alias_file, aliases = path, load_aliases(path)
+    return aliases
+
+
+def get_aliases():
+    return use_aliases(alias_file)
+
+
+def address_key(address):
+    if not address:
+        return None
+    return get_aliases().get(_variant(address)) or canonical_key(address)
+
+
+def load_aliases(path=ALIAS_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_aliases():
+    # Writes the active table back to the file it was loaded from
+    table = get_aliases()
+    tmp_path = f"{alias_file}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(table, f, indent=0, sort_keys=True)
+    os.replace(tmp_path, alias_file)
+
+
+def add_aliases(raw_addresses):
+    # Existing entries win, so hand edits survive re-cleaning
+    table = get_aliases()
+    added = 0
+    for address in raw_addresses:
+        if not address:
+            continue
+        variant = _variant(address)
+        if variant not in table:
+            table[variant] = canonical_key(address)
+            added += 1
+    return added
+
+
+def variants_of(key):
+    return [variant for variant, k in get_aliases().items() if k == key]
+
+
+def canonical_cache(cache):
+    # Re-keys a geocode cache written under older keys; a hit wins over a
+    # recorded failure for the same key
+    out = {}
+    for address, value in cache.items():
+        key = address_key(address)
+        previous = out.get(key)
+        if key and not (isinstance(previous, dict) and previous.get("lat") is not None):
+            out[key] = value
+    return out
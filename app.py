@@ -1,18 +1,74 @@
 import streamlit as st
 import pandas as pd
 import os
+import json
 import subprocess
+from bisect import bisect_left
 
 EXPLANATIONS_FILE = "top3_gpt_explanations.csv"
 FEEDBACK_FILE = "feedback_log.csv"
-
-df = pd.read_csv(EXPLANATIONS_FILE)
+VALUATIONS_FILE = "valuations.json"
+# Above this many orders the selector is narrowed by an orderID search first
+MAX_SELECT_OPTIONS = 1000
+
+# Data layer
+#
+# Loaders are memoized on the file's version (mtime and size), so a retrain
+# that rewrites an artifact invalidates them on the next rerun and nothing is
+# re-read otherwise. Explanations are sorted by (orderID, rank) once and
+# indexed orderID -> row range, so selecting an order is a dict hit and a
+# slice instead of a mask over every row.
+
+def file_version(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+# cache_resource hands back the same object instead of a copy per rerun;
+# callers must not modify it
+@st.cache_resource(max_entries=2)
+def load_explanations(path, version):
+    df = pd.read_csv(path, dtype={"orderID": str})
+    df = df.sort_values(["orderID", "rank"], kind="stable").reset_index(drop=True)
+    order_ids = df["orderID"].drop_duplicates()
+    stops = list(order_ids.index[1:]) + [len(df)]
+    index = {order_id: (start, stop) for order_id, start, stop in zip(order_ids, order_ids.index, stops)}
+    return df, list(order_ids), index
+
+# Precomputed estimates from valuation.py, reloaded only when the file changes
+@st.cache_resource(max_entries=2)
+def load_valuations(path, version):
+    with open(path) as f:
+        return json.load(f)
+
+def get_order(order_id):
+    start, stop = index[order_id]
+    return df.iloc[start:stop]
+
+def search_orders(prefix, limit=MAX_SELECT_OPTIONS):
+    # order_ids is sorted, so prefix matches are one contiguous run
+    start = bisect_left(order_ids, prefix)
+    matches = []
+    for order_id in order_ids[start:start + limit]:
+        if not order_id.startswith(prefix):
+            break
+        matches.append(order_id)
+    return matches
+
+df, order_ids, index = load_explanations(EXPLANATIONS_FILE, file_version(EXPLANATIONS_FILE))
+valuations = load_valuations(VALUATIONS_FILE, file_version(VALUATIONS_FILE)) if os.path.exists(VALUATIONS_FILE) else None
 
 # Appraisal Selection 
-order_ids = sorted(df["orderID"].unique())
-selected_order = st.selectbox("Select an Appraisal (orderID)", order_ids)
+if len(order_ids) > MAX_SELECT_OPTIONS:
+    prefix = st.text_input(f"Search orderID ({len(order_ids):,} orders)").strip()
+    options = search_orders(prefix)
+else:
+    options = order_ids
+if not options:
+    st.warning("No orderID matches that search.")
+    st.stop()
+selected_order = st.selectbox("Select an Appraisal (orderID)", options)
 
-appraisal_df = df[df["orderID"] == selected_order].sort_values("rank")
+appraisal_df = get_order(selected_order)
 
 st.title("🏠 Property Comparison Feedback")
 st.subheader(f"Subject Property: {appraisal_df['subject_address'].iloc[0]}")
@@ -100,16 +156,32 @@ st.markdown("---")
 # Suggested Price Estimate
 st.header("💰 Suggested Value Estimate")
 
-if valid_prices:
+precomputed = valuations["orders"].get(str(selected_order)) if valuations else None
+avg_price = None
+estimate_k = 3
+estimate_label = "Average Price of Top-3 Comps"
+
+if precomputed and precomputed.get("estimate") is not None:
+    avg_price = precomputed["estimate"]
+    min_price = precomputed["min_price"]
+    max_price = precomputed["max_price"]
+    mid_point = precomputed["midpoint"]
+    estimate_k = valuations["meta"]["k"]
+    if valuations["meta"]["weighting"] == "equal":
+        estimate_label = f"Average Price of Top-{estimate_k} Comps"
+    else:
+        estimate_label = f"Estimate from Top-{estimate_k} Comps ({valuations['meta']['weighting']}-weighted)"
+elif valid_prices:
     avg_price = sum(valid_prices) / len(valid_prices)
     min_price = min(valid_prices)
     max_price = max(valid_prices)
     mid_point = min_price + ((max_price-min_price) / 2)
 
+if avg_price is not None:
     st.markdown(
         f"""
         <div style='margin-top: 1rem;'>
-            <span style='font-size: 1.15rem; font-weight: 600;'>Average Price of Top-3 Comps:</span>
+            <span style='font-size: 1.15rem; font-weight: 600;'>{estimate_label}:</span>
             <span style='font-size: 1.15rem; font-weight: 500; margin-left: 0.5rem;'>
                 {format_price(avg_price)}
             </span>
@@ -128,7 +200,7 @@ if valid_prices:
         </div>
         <div style='margin-top: 1rem; margin-bottom: 1rem'>
             <span style='font-size: 0.8rem; font-weight: 600; color: grey'>
-                This estimate is based on the closing prices of the top 3 comparable properties selected by the model.
+                This estimate is based on the closing prices of the top {estimate_k} comparable properties selected by the model.
             </span>
         </div>
         """,
@@ -166,6 +238,7 @@ if st.button("✅ Submit Feedback"):
     subprocess.run(["/usr/local/bin/python3.12", "training_data.py"])
     subprocess.run(["/usr/local/bin/python3.12", "train_model.py"])
     subprocess.run(["/usr/local/bin/python3.12", "top3_explanations.py"])
+    subprocess.run(["/usr/local/bin/python3.12", "valuation.py"])
 
     st.success("✅ Model updated with feedback.")
 
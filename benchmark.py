@@ -0,0 +1,241 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import metrics
+import synthetic_data
+from addresses import canonical_cache
+
+# Config
+RESULTS_FILE = "benchmark_results.json"
+BASELINE_FILE = "benchmark_baseline.json"
+STAGES = ["clean", "features", "training_data", "train", "shap", "explain"]
+REGRESSION_THRESHOLD = 1.2
+
+
+# Stubbed LLM client with the same response shape as the OpenAI SDK
+class StubCompletions:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def create(self, model, messages, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        prompt_tokens = sum(len(m["content"].split()) for m in messages)
+        text = "The candidate was ranked on its feature similarities to the subject."
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(text.split())),
+        )
+
+
+class StubClient:
+    def __init__(self, latency=0.0):
+        self.chat = SimpleNamespace(completions=StubCompletions(latency))
+
+
+def measure(name, fn, items, use_tracemalloc=False):
+    if use_tracemalloc:
+        tracemalloc.start()
+
+    with metrics.stage(f"benchmark:{name}", items=items) as record:
+        result = fn()
+
+    stats = {k: v for k, v in record.items() if k != "stage"}
+    if use_tracemalloc:
+        stats["py_alloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+
+    print(f"  {name:<14} {stats['wall_s']:8.3f}s wall {stats['cpu_s']:8.3f}s cpu {stats['peak_rss_mb']:8.1f} MB peak  {items} items")
+    return result, stats
+
+
+def run_scale(num_appraisals, num_candidates, stages, workdir, seed=0, shap_orders=20, use_tracemalloc=False, reuse=0.0, llm=False):
+    geocoded = {}
+    data = synthetic_data.generate(num_appraisals, num_candidates, seed, geocoded, reuse)
+    total_candidates = num_appraisals * num_candidates
+
+    paths = {
+        "raw": os.path.join(workdir, "appraisals_dataset.json"),
+        "cleaned": os.path.join(workdir, "cleaned_appraisals_dataset.json"),
+        "features": os.path.join(workdir, "feature_engineered_appraisals_dataset.json"),
+        "training": os.path.join(workdir, "training_data.csv"),
+        "aliases": os.path.join(workdir, "address_aliases.json"),
+    }
+    with open(paths["raw"], "w") as f:
+        json.dump(data, f)
+    del data
+
+    print(f"\n{num_appraisals} appraisals x {num_candidates} candidates = {total_candidates} candidates")
+    metrics.reset()
+    results = {}
+    state = {}
+
+    def stage(name, fn, items, key=None):
+        if name not in stages:
+            return None
+        result, results[key or name] = measure(key or name, fn, items, use_tracemalloc)
+        return result
+
+    import clean_initial_data
+    stage("clean", lambda: clean_initial_data.clean_all_data(paths["raw"], paths["cleaned"], alias_file=paths["aliases"]), total_candidates)
+
+    import features
+    features.address_data = canonical_cache(geocoded)
+    stage("features", lambda: features.add_new_features(paths["cleaned"], paths["features"]), total_candidates)
+
+    import training_data
+
+    def build():
+        df = training_data.build_training_data_from_cleaned(paths["features"])
+        df.to_csv(paths["training"], index=False)
+        return df
+
+    df = stage("training_data", build, total_candidates)
+
+    if {"train", "shap", "explain"} & set(stages):
+        import train_model
+        if df is None:
+            df = training_data.build_training_data_from_cleaned(paths["features"])
+        df["label"] = df["is_comp"]
+        df_train, _ = train_model.split_data(df)
+        state["model"] = stage("train", lambda: train_model.train_model(df_train), len(df_train))
+        if state["model"] is None:
+            state["model"] = train_model.train_model(df_train)
+
+    if {"shap", "explain"} & set(stages):
+        import top3_explanations
+        top3_explanations.client = StubClient()
+        model = state["model"]
+        df[top3_explanations.feature_cols] = df[top3_explanations.feature_cols].astype(float)
+        order_ids = sorted(df["orderID"].unique())[:shap_orders]
+        sample = df[df["orderID"].isin(order_ids)]
+        raw_index = top3_explanations.build_raw_index(top3_explanations.load_raw_data(paths["features"]))
+
+        def run_shap():
+            explainer = top3_explanations.make_explainer(model, df[top3_explanations.feature_cols])
+            rows = []
+            for _, group in sample.groupby("orderID"):
+                for _, row in top3_explanations.top_candidates(model, group).iterrows():
+                    rows.append((row, top3_explanations.shap_factors(explainer, row)))
+            return rows
+
+        shap_rows = stage("shap", run_shap, len(order_ids) * 3)
+
+        # Template text by default, as in top3_explanations.py; --llm times
+        # the per-candidate LLM path against the stub client instead
+        explain = top3_explanations.gpt_explanation if llm else top3_explanations.template_explanation
+
+        def run_explain():
+            out = []
+            for row, (positive, negative) in shap_rows or []:
+                extra = top3_explanations.lookup_raw_values(raw_index, row["orderID"], row["candidate_address"])
+                out.append(explain(
+                    row["score"], positive[:3], negative[:3],
+                    row["candidate_address"], row["subject_address"], row.to_dict() | extra
+                ))
+            return out
+
+        if shap_rows is None and "explain" in stages:
+            shap_rows = run_shap()
+        stage("explain", run_explain, len(shap_rows or []), key="explain_llm" if llm else None)
+
+    return {
+        "appraisals": num_appraisals,
+        "candidates_per_appraisal": num_candidates,
+        "total_candidates": total_candidates,
+        "stages": results,
+        "functions": metrics.snapshot()["functions"],
+        "counters": metrics.snapshot()["counters"],
+    }
+
+
+def run_key(run):
+    return f"{run['appraisals']}x{run['candidates_per_appraisal']}"
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    baseline_runs = {run_key(r): r for r in baseline.get("runs", [])}
+    regressions = []
+
+    print("\nComparison against baseline (wall time ratio, >1 is slower):")
+    for run in results["runs"]:
+        base = baseline_runs.get(run_key(run))
+        if not base:
+            print(f"  {run_key(run)}: no baseline run")
+            continue
+        for name, stats in run["stages"].items():
+            base_stats = base["stages"].get(name)
+            if not base_stats or not base_stats["wall_s"]:
+                continue
+            ratio = stats["wall_s"] / base_stats["wall_s"]
+            mem_ratio = stats["peak_rss_mb"] / base_stats["peak_rss_mb"] if base_stats["peak_rss_mb"] else None
+            flag = "  REGRESSION" if ratio > threshold else ""
+            mem = f"{mem_ratio:.2f}x" if mem_ratio else "n/a"
+            print(f"  {run_key(run):<12} {name:<14} time {ratio:.2f}x  peak rss {mem}{flag}")
+            if ratio > threshold:
+                regressions.append((run_key(run), name, ratio))
+    return regressions
+
+
+def parse_list(val):
+    return [int(v) for v in str(val).split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmark each pipeline stage on synthetic appraisals")
+    arg_parser.add_argument("--appraisals", default="10,100", help="comma-separated appraisal counts")
+    arg_parser.add_argument("--candidates", default="100", help="comma-separated candidates per appraisal")
+    arg_parser.add_argument("--stages", default=",".join(STAGES), help=f"subset of {','.join(STAGES)}")
+    arg_parser.add_argument("--shap-orders", type=int, default=20, help="orders to explain in the shap/explain stages")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--reuse", type=float, default=0.0, help="share of pool properties shared between appraisals")
+    arg_parser.add_argument("--tracemalloc", action="store_true", help="also record Python allocation peaks (slower)")
+    arg_parser.add_argument("--llm", action="store_true", help="time LLM explanations (stubbed client) instead of template text")
+    arg_parser.add_argument("--output", default=RESULTS_FILE)
+    arg_parser.add_argument("--baseline", default=BASELINE_FILE)
+    arg_parser.add_argument("--save-baseline", action="store_true", help="write these results as the new baseline")
+    arg_parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    arg_parser.add_argument("--fail-on-regression", action="store_true")
+    args = arg_parser.parse_args()
+
+    stages = [s for s in args.stages.split(",") if s]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    runs = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for num_appraisals in parse_list(args.appraisals):
+            for num_candidates in parse_list(args.candidates):
+                runs.append(run_scale(
+                    num_appraisals, num_candidates, stages, workdir,
+                    seed=args.seed, shap_orders=args.shap_orders, use_tracemalloc=args.tracemalloc, reuse=args.reuse, llm=args.llm
+                ))
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nSaved benchmark results to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
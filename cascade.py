@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import forest
+import metrics
+import model_registry
+import training_data
+from feature_registry import FEATURE_COLS, compile_batch_kernel, get_features
+from records import load_appraisals
+
+# Config
+INPUT_FILE = "feature_engineered_appraisals_dataset.json"
+STAGE1_MODEL_FILE = "cascade_stage1_model.json"
+TRAINING_DATA_FILE = "training_data.csv"
+
+# Rules run on cheap features only. A missing value never prunes a candidate,
+# and None switches a rule off.
+CASCADE_CONFIG = {
+    "require_same_property_type": True,
+    "max_days_since_sale": 730,
+    "max_days_after_effective": 90,
+    "max_abs_gla_diff": 1500,
+    "max_distance_km": None,
+    "stage1_model": None,
+    "stage1_keep": 30,
+}
+
+# Days between the subject's effective date and the candidate's sale, using
+# the same fields as sold_recently
+DAYS_SINCE_SALE = dict(get_features(["sold_recently"])[0], name="days_since_sale", transform="date_diff")
+
+STAGE1_FEATURES = ["same_property_type", "abs_gla_diff", "abs_bedrooms_diff", "abs_bath_score_diff", "sold_recently"]
+CHEAP_FEATURES = get_features(
+    ["same_property_type", "abs_gla_diff", "abs_bedrooms_diff", "abs_bath_score_diff", "sold_recently", "distance_to_subject_km"]
+) + [DAYS_SINCE_SALE]
+
+cheap_kernel = compile_batch_kernel(CHEAP_FEATURES)
+
+stage1_params = {
+    'objective': 'rank:pairwise',
+    'eta': 0.3,
+    'max_depth': 2,
+    'verbosity': 0
+}
+STAGE1_ROUNDS = 20
+
+# Scoring paths (score.py, valuation.py, top3_explanations.py) prune with
+# --cascade before featurizing or scoring; --cascade-stage1 adds the
+# first-stage model. Rules whose input is not available (the date rules on
+# training-data rows, which carry only sold_recently) are skipped there.
+def cascade_config(stage1=False):
+    return CASCADE_CONFIG | ({"stage1_model": STAGE1_MODEL_FILE} if stage1 else {})
+
+
+def rule_masks(cheap, config=CASCADE_CONFIG):
+    # cheap: the cheap kernel's columns, or training-data rows
+    masks = {}
+    with np.errstate(invalid="ignore"):
+        if config.get("require_same_property_type") and "same_property_type" in cheap:
+            masks["property_type"] = np.asarray(cheap["same_property_type"]) == 0
+        if config.get("max_days_since_sale") is not None and "days_since_sale" in cheap:
+            masks["sale_too_old"] = np.asarray(cheap["days_since_sale"]) > config["max_days_since_sale"]
+        if config.get("max_days_after_effective") is not None and "days_since_sale" in cheap:
+            masks["sale_too_late"] = np.asarray(cheap["days_since_sale"]) < -config["max_days_after_effective"]
+        if config.get("max_abs_gla_diff") is not None and "abs_gla_diff" in cheap:
+            masks["gla"] = np.asarray(cheap["abs_gla_diff"]) > config["max_abs_gla_diff"]
+        if config.get("max_distance_km") is not None and "distance_to_subject_km" in cheap:
+            masks["distance"] = np.asarray(cheap["distance_to_subject_km"]) > config["max_distance_km"]
+    return masks
+
+
+def keep_top_per_group(scores, group_ids, keep, k):
+    order = np.lexsort((-scores, group_ids))
+    sorted_groups = group_ids[order]
+    starts = np.r_[0, np.flatnonzero(sorted_groups[1:] != sorted_groups[:-1]) + 1]
+    positions = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+    result = np.zeros(len(scores), dtype=bool)
+    result[order[positions < k]] = True
+    return result & keep
+
+
+def keep_mask(cheap, group_ids, size, config=CASCADE_CONFIG, stage1=None):
+    keep = np.ones(size, dtype=bool)
+    for mask in rule_masks(cheap, config).values():
+        keep &= ~mask
+
+    stage1 = stage1 if stage1 is not None else load_stage1(config.get("stage1_model"))
+    if stage1 is not None and config.get("stage1_keep"):
+        X = np.column_stack([np.asarray(cheap[name], dtype=float) for name in stage1["feature_names"]])
+        scores = np.where(keep, forest.predict_forest(stage1, X), -np.inf)
+        keep = keep_top_per_group(scores, np.asarray(group_ids), keep, config["stage1_keep"])
+
+    return keep
+
+
+def prune_candidates(table, config=CASCADE_CONFIG, stage1=None, cheap=None):
+    cheap = cheap if cheap is not None else cheap_kernel(
+        table["subjects"], table["candidates"], table["subject_index"], table["groups"]
+    )
+    return keep_mask(cheap, table["subject_index"], len(table["candidates"]), config, stage1)
+
+
+def _count_pruned(keep):
+    metrics.incr("cascade_candidates_total", int(keep.sum()), result="kept")
+    metrics.incr("cascade_candidates_total", int(len(keep) - keep.sum()), result="pruned")
+
+
+def cascade_keep(table, config=CASCADE_CONFIG):
+    keep = prune_candidates(table, config)
+    _count_pruned(keep)
+    return keep
+
+
+def apply_cascade(table, config=CASCADE_CONFIG):
+    # The candidate table with pruned candidates removed, ready for featurize
+    return training_data.select_candidates(table, cascade_keep(table, config))
+
+
+def prune_frame(df, config=CASCADE_CONFIG):
+    # Training-data rows: features are already computed, so pruning saves
+    # the scoring and SHAP work downstream
+    keep = keep_mask(df, pd.factorize(df["orderID"])[0], len(df), config)
+    _count_pruned(keep)
+    return df[keep]
+
+
+# Compiled once per file version, since scoring calls this for every chunk
+_stage1_cache = {}
+
+def load_stage1(path):
+    if not path or not os.path.exists(path):
+        return None
+    version = (path, os.stat(path).st_mtime_ns)
+    if version not in _stage1_cache:
+        with open(path, "r") as f:
+            _stage1_cache.clear()
+            _stage1_cache[version] = forest.compile_forest(json.load(f))
+    return _stage1_cache[version]
+
+
+def train_stage1(training_data_file=TRAINING_DATA_FILE, output_file=STAGE1_MODEL_FILE):
+    import xgboost as xgb
+
+    df = pd.read_csv(training_data_file).sort_values("orderID", kind="stable")
+    dtrain = xgb.DMatrix(df[STAGE1_FEATURES].astype(float), label=df["is_comp"])
+    dtrain.set_group(df.groupby("orderID", sort=True).size().to_list())
+    model = xgb.train(stage1_params, dtrain, num_boost_round=STAGE1_ROUNDS)
+    model.save_model(output_file)
+    print(f"Stage-1 model saved as {output_file}")
+    return output_file
+
+
+def recall_at_k(scores, group_ids, keep, ks=(1, 3, 5)):
+    df = pd.DataFrame({"group": group_ids, "score": scores, "keep": keep})
+    df["rank"] = df.groupby("group")["score"].rank(method="first", ascending=False)
+    report = {}
+    for k in ks:
+        topk = df[df["rank"] <= k]
+        report[k] = float(topk["keep"].mean()) if len(topk) else 1.0
+    return report
+
+
+def evaluate_cascade(input_file=INPUT_FILE, model_file=None, config=CASCADE_CONFIG, ks=(1, 3, 5)):
+    with open(model_file or model_registry.model_path(), "r") as f:
+        full_model = forest.compile_forest(json.load(f))
+
+    table = training_data.collect_candidates(load_appraisals(input_file))
+    group_ids = np.asarray(table["subject_index"])
+    is_comp = np.asarray(table["meta"]["is_comp"])
+
+    # Unpruned reference: every candidate featurized and scored
+    start = time.perf_counter()
+    full = training_data.featurize(table)
+    scores = forest.predict_forest(full_model, np.column_stack([full[c] for c in FEATURE_COLS]))
+    full_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cheap = cheap_kernel(table["subjects"], table["candidates"], table["subject_index"], table["groups"])
+    keep = prune_candidates(table, config, cheap=cheap)
+    pruned = training_data.select_candidates(table, keep)
+    pruned_full = training_data.featurize(pruned)
+    forest.predict_forest(full_model, np.column_stack([pruned_full[c] for c in FEATURE_COLS]))
+    cascade_s = time.perf_counter() - start
+
+    masks = rule_masks(cheap, config)
+    return {
+        "candidates": len(keep),
+        "kept": int(keep.sum()),
+        "pruned_fraction": float(1 - keep.mean()) if len(keep) else 0.0,
+        "pruned_by_rule": {name: int(mask.sum()) for name, mask in masks.items()},
+        "recall_at_k": recall_at_k(scores, group_ids, keep, ks),
+        "comp_recall": float(keep[is_comp == 1].mean()) if (is_comp == 1).any() else 1.0,
+        "full_scoring_s": round(full_s, 4),
+        "cascade_scoring_s": round(cascade_s, 4),
+    }
+
+
+def print_report(report):
+    print(f"Candidates: {report['candidates']}  kept: {report['kept']}  pruned: {report['pruned_fraction']:.1%}")
+    for name, count in report["pruned_by_rule"].items():
+        print(f"  rule {name:<16} flags {count}")
+    for k, recall in report["recall_at_k"].items():
+        print(f"Recall@{k} vs unpruned ranking: {recall:.3f}")
+    print(f"Labelled comp recall: {report['comp_recall']:.3f}")
+    print(f"Full scoring: {report['full_scoring_s']:.3f}s  cascade: {report['cascade_scoring_s']:.3f}s")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Evaluate cascade candidate pruning against the unpruned ranking")
+    arg_parser.add_argument("--input", default=INPUT_FILE)
+    arg_parser.add_argument("--model", help="model file (default: current registry version)")
+    arg_parser.add_argument("--max-days-since-sale", type=int, default=CASCADE_CONFIG["max_days_since_sale"])
+    arg_parser.add_argument("--max-abs-gla-diff", type=float, default=CASCADE_CONFIG["max_abs_gla_diff"])
+    arg_parser.add_argument("--max-distance-km", type=float, default=CASCADE_CONFIG["max_distance_km"])
+    arg_parser.add_argument("--allow-other-types", action="store_true", help="do not prune on property type")
+    arg_parser.add_argument("--stage1", action="store_true", help="also use the first-stage model")
+    arg_parser.add_argument("--stage1-keep", type=int, default=CASCADE_CONFIG["stage1_keep"])
+    arg_parser.add_argument("--train-stage1", action="store_true", help=f"train the first-stage model from {TRAINING_DATA_FILE}")
+    args = arg_parser.parse_args(argv)
+
+    if args.train_stage1:
+        train_stage1()
+
+    config = CASCADE_CONFIG | {
+        "require_same_property_type": not args.allow_other_types,
+        "max_days_since_sale": args.max_days_since_sale,
+        "max_abs_gla_diff": args.max_abs_gla_diff,
+        "max_distance_km": args.max_distance_km,
+        "stage1_model": STAGE1_MODEL_FILE if args.stage1 else None,
+        "stage1_keep": args.stage1_keep,
+    }
+    print_report(evaluate_cascade(args.input, args.model, config))
+    metrics.export("cascade")
+
+
+if __name__ == "__main__":
+    main()
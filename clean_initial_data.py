@@ -1,12 +1,37 @@
+import argparse
+import inspect
 import json
 import re
+from functools import wraps
 from dateutil import parser
+import addresses
+import metrics
+from records import AppraisalRecord, content_hash, is_unchanged, load_existing, merge_appraisals, property_id, save_appraisals, snapshot_raw
 
 # Config
 
 INPUT_FILE = "appraisals_dataset.json"
 OUTPUT_FILE = "cleaned_appraisals_dataset.json"
 
+def track_parse(field, context=()):
+    # Count calls where a raw value was passed in (any argument not named in
+    # context, e.g. val, or full/half for baths) but nothing could be parsed
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            value = result[0] if isinstance(result, tuple) else result
+            if value is None:
+                passed = signature.bind(*args, **kwargs).arguments
+                if any(raw for name, raw in passed.items() if name not in context):
+                    metrics.incr("parse_failures_total", field=field)
+            return result
+        return wrapper
+    return decorator
+
+@track_parse("age", context=("effective_date",))
 def parse_age(val, effective_date):
     if not val:
         return None
@@ -56,6 +81,7 @@ def clean_ages(appraisal):
 
     return appraisal
 
+@track_parse("gla")
 def parse_gla(val):
     if not val:
         return None
@@ -91,6 +117,7 @@ def clean_glas(appraisal):
 
     return appraisal
 
+@track_parse("lot_size")
 def parse_lot_size(val):
     if not val:
         return None
@@ -143,6 +170,7 @@ def clean_lot_sizes(appraisal):
 
     return appraisal
 
+@track_parse("rooms")
 def parse_total_rooms(val):
 
     if not val:
@@ -186,6 +214,7 @@ def clean_bedrooms(appraisal):
         
     return appraisal
 
+@track_parse("baths")
 def get_bath_score(val=None, full=None, half=None):
     try:
         if val:
@@ -267,6 +296,7 @@ def clean_conditions(appraisal):
             unique_comp_conditions.append(comp_cond)
     
 
+@track_parse("distance")
 def parse_comp_dist(val):
     if not val or not isinstance(val, str):
         return None
@@ -283,6 +313,7 @@ def clean_comp_distances(appraisal):
     return appraisal
         
 
+@track_parse("sale_price")
 def safe_float(val):
     try:
         return int(str(val).replace(",", "").strip())
@@ -302,31 +333,85 @@ def clean_sale_price(appraisal):
     return appraisal
         
 
-def clean_all_data():
-    with open(INPUT_FILE, "r") as f:
-        data = json.load(f)
+def clean_appraisal(appraisal):
+    clean_ages(appraisal)
+    clean_glas(appraisal)
+    clean_lot_sizes(appraisal)
+    clean_total_rooms(appraisal)
+    clean_bedrooms(appraisal)
+    clean_baths(appraisal)
+    clean_conditions(appraisal)
+    clean_sale_price(appraisal)
 
-    cleaned = []
-    for appraisal in data["appraisals"]:
+    clean_comp_distances(appraisal)
 
-        clean_ages(appraisal)
-        clean_glas(appraisal)
-        clean_lot_sizes(appraisal)
-        clean_total_rooms(appraisal)
-        clean_bedrooms(appraisal)
-        clean_baths(appraisal)
-        clean_conditions(appraisal)
-        clean_sale_price(appraisal)
+    return appraisal
 
-        clean_comp_distances(appraisal)
+def clean_all_data(input_file=INPUT_FILE, output_file=OUTPUT_FILE, keep_raw=False, incremental=False, alias_file=addresses.ALIAS_FILE):
+    with open(input_file, "r") as f:
+        appraisals = json.load(f)["appraisals"]
 
-        cleaned.append(appraisal)
-    
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump({"appraisals": cleaned}, f, indent=2)
+    # Incremental: orderIDs already cleaned from identical raw input are kept as is
+    existing = load_existing(output_file, incremental)
 
-    print(f"Saved cleaned JSON to {OUTPUT_FILE}")
+    # Aliases are read from and saved back to alias_file
+    addresses.use_aliases(alias_file)
+
+    # Shared listings are cleaned the first time they are seen
+    table = {p.property_id: p for a in existing.values() for p in a.properties}
+
+    cleaned = []
+    with metrics.stage("clean") as stage:
+        for i, appraisal in enumerate(appraisals):
+            source_hash = content_hash(appraisal)
+            order_id = str(appraisal.get("orderID", "UNKNOWN"))
+            appraisals[i] = None
+            if is_unchanged(existing, order_id, source_hash):
+                metrics.incr("incremental_orders_total", stage="clean", result="unchanged")
+                continue
+            if incremental:
+                metrics.incr("incremental_orders_total", stage="clean", result="changed" if order_id in existing else "new")
+
+            ids, new_ids, new_props = [], [], []
+            for prop in appraisal.get("properties", []):
+                pid = property_id(prop)
+                ids.append(pid)
+                if pid not in table and pid not in new_ids:
+                    new_ids.append(pid)
+                    new_props.append(prop)
+            metrics.incr("property_table_lookups_total", len(ids) - len(new_ids), result="hit")
+            metrics.incr("property_table_lookups_total", len(new_ids), result="miss")
+            appraisal["properties"] = new_props
+
+            raw = snapshot_raw(appraisal) if keep_raw else None
+            record = AppraisalRecord.from_cleaned(clean_appraisal(appraisal), raw, source_hash)
+            for pid, prop in zip(new_ids, record.properties):
+                prop.property_id = pid
+                table[pid] = prop
+            record.properties = [table[pid] for pid in ids]
+            cleaned.append(record)
+
+            # Every raw spelling seen is recorded against its canonical key
+            addresses.add_aliases([record.subject.address] + [c.address for c in record.comps] + [table[pid].address for pid in new_ids])
+        stage["items"] = len(cleaned)
+
+    save_appraisals(output_file, merge_appraisals(existing, cleaned) if incremental else cleaned)
+
+    addresses.save_aliases()
+
+    print(f"Saved cleaned JSON to {output_file}")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Clean and parse the raw appraisal data")
+    arg_parser.add_argument("--keep-raw", action="store_true", help="keep the raw input fields on each record")
+    arg_parser.add_argument("--incremental", action="store_true", help="only clean new or changed orderIDs and merge them into the existing output")
+    arg_parser.add_argument("--input", default=INPUT_FILE)
+    args = arg_parser.parse_args(argv)
+
+    clean_all_data(args.input, keep_raw=args.keep_raw, incremental=args.incremental)
+    metrics.export("clean_initial_data")
 
 
 if __name__ == "__main__":
-    clean_all_data()
+    main()
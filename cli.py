@@ -0,0 +1,116 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import metrics
+import model_registry
+
+# Subcommand -> (module, help). Each module exposes main(argv) and is only
+# imported when its subcommand runs, so heavy dependencies (pandas, xgboost,
+# shap, openai) never load for commands that do not use them.
+COMMANDS = {
+    "clean": ("clean_initial_data", "clean and parse the raw appraisal data"),
+    "geocode": ("geocode_all_addresses", "geocode addresses listed in the missing-address file"),
+    "features": ("features", "add property types, coordinates and distances"),
+    "build": ("training_data", "build candidate training rows"),
+    "train": ("train_model", "train and register a ranking model"),
+    "size": ("model_sizing", "sweep model depth and rounds for the latency/quality frontier"),
+    "explain": ("top3_explanations", "explain the top-3 candidates per order"),
+    "score": ("score", "rank candidates with the current model"),
+    "cascade": ("cascade", "evaluate cascade pruning and train its first-stage model"),
+    "value": ("valuation", "precompute value estimates for every order"),
+    "index": ("retrieval", "build the comp retrieval index over the listing history"),
+    "drift": ("feature_stats", "compare scoring feature distributions with the training snapshot"),
+}
+
+# Config
+ARTIFACTS = [
+    "appraisals_dataset.json",
+    "cleaned_appraisals_dataset.json",
+    "geocoded_addresses.json",
+    "address_aliases.json",
+    "missing_addresses.txt",
+    "geocode_watermark.json",
+    "feature_engineered_appraisals_dataset.json",
+    "training_data.csv",
+    "training_data_with_feedback.csv",
+    "feedback_log.csv",
+    "top3_gpt_explanations.csv",
+    "top_k_scores.jsonl",
+    "valuations.json",
+    "comp_index.npz",
+    "feature_stats_training.json",
+    "feature_stats_scoring.json",
+]
+MANIFEST_FILE = "training_data_manifest.json"
+GEOCODE_CACHE_FILE = "geocoded_addresses.json"
+MISSING_FILE = "missing_addresses.txt"
+
+
+def _size(num_bytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if num_bytes < 1024 or unit == "GB":
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+
+
+def status():
+    print("Artifacts:")
+    for path in ARTIFACTS:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(stat.st_mtime))
+            print(f"  {path:<45} {_size(stat.st_size):>10}  {modified}")
+        else:
+            print(f"  {path:<45} {'missing':>10}")
+
+    version = model_registry.current_version()
+    if version is not None:
+        meta = model_registry.read_metadata(version)
+        scores = "  ".join(f"{k}={v:.3f}" for k, v in meta.get("metrics", {}).items())
+        print(f"\nModel: v{version:04d} of {len(model_registry.list_versions())}, trained {meta['created']}  {scores}")
+    elif os.path.exists(model_registry.LEGACY_MODEL_FILE):
+        print(f"\nModel: {model_registry.LEGACY_MODEL_FILE} (not registered)")
+    else:
+        print("\nModel: none")
+
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE) as f:
+            print(f"Orders in training data: {len(json.load(f))}")
+
+    if os.path.exists(GEOCODE_CACHE_FILE):
+        with open(GEOCODE_CACHE_FILE) as f:
+            cache = json.load(f)
+        failed = sum(1 for v in cache.values() if not (isinstance(v, dict) and v.get("lat") is not None))
+        missing = 0
+        if os.path.exists(MISSING_FILE):
+            with open(MISSING_FILE) as f:
+                missing = sum(1 for line in f if line.strip())
+        print(f"Geocode cache: {len(cache) - failed} addresses, {failed} failed, {missing} listed as missing")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    arg_parser = argparse.ArgumentParser(description="Comp ranking pipeline. Run '<command> --help' for command options.")
+    subparsers = arg_parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        # Options are parsed by the module's own main()
+        subparsers.add_parser(name, help=help_text, add_help=False)
+    subparsers.add_parser("status", help="show pipeline artifacts, current model and geocode coverage")
+    args, rest = arg_parser.parse_known_args(argv)
+
+    if args.command == "status":
+        status()
+        return
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    module.main(rest)
+    # Commands run in this process, so their stages are still recorded here
+    metrics.print_summary()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import math
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from dateutil import parser
+
+# Feature registry
+#
+# Every subject-vs-candidate feature is declared once here and compiled into
+# a vectorized batch kernel, used for training data and for scoring, single
+# requests included. Adding a feature means adding one entry to FEATURES.
+#
+# subject / candidate: field names on the cleaned records (records.py). A
+#     candidate field can be a dict keyed by group ("comps" / "properties")
+#     when the two pools store the value under different names. The distance
+#     transform takes (lat, lon) pairs and an optional "precomputed" candidate
+#     field, used only for candidates without coordinates. Every computed
+#     distance is haversine, comps and pool properties alike.
+# transform: diff | abs_diff | equal | date_window | date_diff | distance
+# missing:   falsy   -> NaN unless both values are truthy (0 counts as missing)
+#            none    -> NaN unless both values are present
+#            subject -> NaN only when the subject value is falsy
+# model: False keeps a feature in the training rows but out of FEATURE_COLS
+
+FEATURES = [
+    {"name": "bath_score_diff", "subject": "bath_score", "candidate": "bath_score", "transform": "diff", "missing": "falsy"},
+    {"name": "full_baths_diff", "subject": "num_full_baths", "candidate": "num_full_baths", "transform": "diff", "missing": "falsy"},
+    {"name": "half_baths_diff", "subject": "num_half_baths", "candidate": "num_half_baths", "transform": "diff", "missing": "falsy"},
+    {"name": "room_count_diff", "subject": "room_count", "candidate": "room_count", "transform": "diff", "missing": "falsy"},
+    {"name": "bedrooms_diff", "subject": "num_beds", "candidate": "num_beds", "transform": "diff", "missing": "falsy"},
+    {"name": "effective_age_diff", "subject": "effective_age", "candidate": "age", "transform": "diff", "missing": "falsy"},
+    {"name": "subject_age_diff", "subject": "subject_age", "candidate": "age", "transform": "diff", "missing": "falsy"},
+    {"name": "lot_size_sf_diff", "subject": "lot_size_sf", "candidate": "lot_size_sf", "transform": "diff", "missing": "none"},
+    {"name": "gla_diff", "subject": "gla", "candidate": "gla", "transform": "diff", "missing": "falsy"},
+
+    {"name": "abs_bath_score_diff", "subject": "bath_score", "candidate": "bath_score", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_full_bath_diff", "subject": "num_full_baths", "candidate": "num_full_baths", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_half_bath_diff", "subject": "num_half_baths", "candidate": "num_half_baths", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_room_count_diff", "subject": "room_count", "candidate": "room_count", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_bedrooms_diff", "subject": "num_beds", "candidate": "num_beds", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_effective_age_diff", "subject": "effective_age", "candidate": "age", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_subject_age_diff", "subject": "subject_age", "candidate": "age", "transform": "abs_diff", "missing": "falsy"},
+    {"name": "abs_lot_size_sf_diff", "subject": "lot_size_sf", "candidate": "lot_size_sf", "transform": "abs_diff", "missing": "none"},
+    {"name": "abs_gla_diff", "subject": "gla", "candidate": "gla", "transform": "abs_diff", "missing": "falsy"},
+
+    {"name": "distance_to_subject_km", "subject": ("lat", "lon"), "candidate": ("lat", "lon"), "precomputed": "distance_to_subject_km",
+     "transform": "distance", "missing": "none", "model": False},
+    {"name": "same_property_type", "subject": "property_type", "candidate": "property_type", "transform": "equal", "missing": "subject"},
+    {"name": "sold_recently", "subject": "effective_date", "candidate": "sale_date",
+     "transform": "date_window", "window_days": 90, "missing": "falsy"},
+]
+
+FEATURE_NAMES = [f["name"] for f in FEATURES]
+FEATURE_COLS = [f["name"] for f in FEATURES if f.get("model", True)]
+
+TRANSFORMS = {"diff", "abs_diff", "equal", "date_window", "date_diff", "distance"}
+MISSING_RULES = {"falsy", "none", "subject"}
+
+EARTH_RADIUS_KM = 6371.0088
+EPOCH = datetime(1970, 1, 1)
+
+
+def get_features(names):
+    by_name = {f["name"]: f for f in FEATURES}
+    return [by_name[name] for name in names]
+
+
+def _check(features):
+    for f in features:
+        if f["transform"] not in TRANSFORMS:
+            raise ValueError(f"Unknown transform for {f['name']}: {f['transform']}")
+        if f.get("missing", "falsy") not in MISSING_RULES:
+            raise ValueError(f"Unknown missing rule for {f['name']}: {f['missing']}")
+
+
+def _kind(feature):
+    if feature["transform"] == "equal":
+        return "category"
+    if feature["transform"] in ("date_window", "date_diff"):
+        return "date"
+    return "number"
+
+
+@lru_cache(maxsize=65536)
+def _parse_date(val):
+    try:
+        dt = parser.parse(val)
+    except (ValueError, OverflowError, TypeError):
+        return math.nan
+    return (dt.replace(tzinfo=None) - EPOCH).total_seconds()
+
+
+# Value parsing
+
+def _number(val):
+    if not isinstance(val, (int, float, np.integer, np.floating)):
+        return math.nan
+    return float(val)
+
+
+def _date(val):
+    if not val or not isinstance(val, str):
+        return math.nan
+    return _parse_date(val)
+
+
+# Column helpers
+
+def _gather(records, field, index=None):
+    if index is None:
+        return [r.get(field) for r in records]
+    return [records[i].get(field) for i in index]
+
+
+def _gather_candidates(candidates, groups, field):
+    if not isinstance(field, dict):
+        return [c.get(field) for c in candidates]
+    return [c.get(field.get(g)) if field.get(g) else None for c, g in zip(candidates, groups)]
+
+
+def _number_column(values):
+    out = np.fromiter((_number(v) for v in values), dtype=float, count=len(values))
+    present = ~np.isnan(out)
+    return out, present, present & (out != 0)
+
+
+def _date_column(values):
+    out = np.fromiter((_date(v) for v in values), dtype=float, count=len(values))
+    present = ~np.isnan(out)
+    return out, present, present
+
+
+def _category_columns(s_values, c_values):
+    codes = {}
+    s_codes = np.fromiter((codes.setdefault(v, len(codes)) if v is not None else -1 for v in s_values), dtype=np.int64, count=len(s_values))
+    c_codes = np.fromiter((codes.setdefault(v, len(codes)) if v is not None else -1 for v in c_values), dtype=np.int64, count=len(c_values))
+    s_truthy = np.fromiter((bool(v) for v in s_values), dtype=bool, count=len(s_values))
+    c_truthy = np.fromiter((bool(v) for v in c_values), dtype=bool, count=len(c_values))
+    return (s_codes, s_codes >= 0, s_truthy), (c_codes, c_codes >= 0, c_truthy)
+
+
+def _valid(missing, s_present, s_truthy, c_present, c_truthy):
+    if missing == "falsy":
+        return s_truthy & c_truthy
+    if missing == "none":
+        return s_present & c_present
+    return s_truthy
+
+
+def _haversine_vec(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return np.round(2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a)), 3)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    return float(_haversine_vec(lat1, lon1, lat2, lon2))
+
+
+def compile_batch_kernel(features=FEATURES):
+    _check(features)
+    features = list(features)
+    names = [f["name"] for f in features]
+
+    def kernel(subjects, candidates, subject_index, groups=None):
+        subject_index = np.asarray(subject_index, dtype=np.int64)
+        if groups is None:
+            groups = ["properties"] * len(candidates)
+
+        # Each distinct (field, kind) column is gathered once and shared across features
+        subject_cols, candidate_cols = {}, {}
+
+        def subject_column(field, kind):
+            key = (field, kind)
+            if key not in subject_cols:
+                values = _gather(subjects, field)
+                col = _date_column(values) if kind == "date" else _number_column(values)
+                subject_cols[key] = tuple(a[subject_index] for a in col)
+            return subject_cols[key]
+
+        def candidate_column(field, kind):
+            key = (repr(field), kind)
+            if key not in candidate_cols:
+                values = _gather_candidates(candidates, groups, field)
+                candidate_cols[key] = _date_column(values) if kind == "date" else _number_column(values)
+            return candidate_cols[key]
+
+        out = {}
+        for feature in features:
+            transform = feature["transform"]
+            missing = feature.get("missing", "falsy")
+            kind = _kind(feature)
+
+            if transform == "distance":
+                s_lat, s_lon = (subject_column(k, "number") for k in feature["subject"])
+                c_lat, c_lon = (candidate_column(k, "number") for k in feature["candidate"])
+                valid = s_lat[1] & s_lon[1] & c_lat[1] & c_lon[1]
+                with np.errstate(invalid="ignore"):
+                    values = np.where(valid, _haversine_vec(s_lat[0], s_lon[0], c_lat[0], c_lon[0]), np.nan)
+                if feature.get("precomputed"):
+                    pre = candidate_column(feature["precomputed"], "number")
+                    values = np.where(valid, values, np.where(pre[1], pre[0], np.nan))
+                out[feature["name"]] = values
+                continue
+
+            if kind == "category":
+                s_values = [subjects[i].get(feature["subject"]) for i in subject_index]
+                c_values = _gather_candidates(candidates, groups, feature["candidate"])
+                (s, s_present, s_truthy), (c, c_present, c_truthy) = _category_columns(s_values, c_values)
+                values = (s == c).astype(float)
+            else:
+                s, s_present, s_truthy = subject_column(feature["subject"], kind)
+                c, c_present, c_truthy = candidate_column(feature["candidate"], kind)
+                with np.errstate(invalid="ignore"):
+                    if transform == "diff":
+                        values = s - c
+                    elif transform == "abs_diff":
+                        values = np.abs(s - c)
+                    else:
+                        days = np.floor((s - c) / 86400)
+                        values = days if transform == "date_diff" else (days <= feature["window_days"]).astype(float)
+
+            valid = _valid(missing, s_present, s_truthy, c_present, c_truthy)
+            out[feature["name"]] = np.where(valid, values, np.nan)
+        return out
+
+    kernel.columns = names
+    return kernel
@@ -0,0 +1,267 @@
+import argparse
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from feature_registry import FEATURE_COLS
+
+# Config
+REFERENCE_FILE = "feature_stats_training.json"
+SCORING_FILE = "feature_stats_scoring.json"
+CHUNK_ROWS = 100_000
+# Relative accuracy of the quantile sketch: estimates are within 1% of the true value
+SKETCH_ACCURACY = 0.01
+# Values closer to zero than this fall in the sketch's zero bucket
+ZERO_THRESHOLD = 1e-9
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+# Drift rules per feature: population stability index over the reference
+# deciles, and the absolute change in missing rate
+PSI_WARN = 0.1
+PSI_ALERT = 0.2
+MISSING_RATE_ALERT = 0.1
+MIN_COUNT = 100
+
+# Streaming feature statistics
+#
+# One FeatureStats holds, per feature: row count, missing count, min/max,
+# mean and variance (merged with the parallel-variance formula) and a
+# relative-error quantile sketch whose buckets double as a log-scale
+# histogram. update() takes a batch of columns in one vectorized pass, and
+# merge() adds two collectors exactly, so workers collect separately and the
+# parent combines them. Training rows are summarized into REFERENCE_FILE when
+# training_data.py runs; scoring collects the same stats inline and compare()
+# reports features whose distribution moved away from the reference.
+
+
+class FeatureStats:
+    def __init__(self, columns=FEATURE_COLS):
+        self.columns = list(columns)
+        self.gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        self.stats = {c: self._empty() for c in self.columns}
+
+    @staticmethod
+    def _empty():
+        return {"count": 0, "missing": 0, "n": 0, "mean": 0.0, "m2": 0.0, "min": math.inf, "max": -math.inf,
+                "zero": 0, "pos": {}, "neg": {}}
+
+    def _buckets(self, values):
+        idx = np.ceil(np.log(values) / math.log(self.gamma)).astype(np.int64)
+        keys, counts = np.unique(idx, return_counts=True)
+        return zip(keys.tolist(), counts.tolist())
+
+    def update(self, columns):
+        for name in self.columns:
+            x = np.asarray(columns[name], dtype=float)
+            s = self.stats[name]
+            present = x[~np.isnan(x)]
+            s["count"] += len(x)
+            s["missing"] += len(x) - len(present)
+            if not len(present):
+                continue
+
+            # Chan et al. parallel update of mean and sum of squared deviations
+            n, mean, m2 = len(present), float(present.mean()), float(((present - present.mean()) ** 2).sum())
+            total = s["n"] + n
+            delta = mean - s["mean"]
+            s["mean"] += delta * n / total
+            s["m2"] += m2 + delta ** 2 * s["n"] * n / total
+            s["n"] = total
+            s["min"], s["max"] = min(s["min"], float(present.min())), max(s["max"], float(present.max()))
+
+            s["zero"] += int((np.abs(present) <= ZERO_THRESHOLD).sum())
+            for store, values in (("pos", present[present > ZERO_THRESHOLD]), ("neg", -present[present < -ZERO_THRESHOLD])):
+                buckets = s[store]
+                for key, count in self._buckets(values):
+                    buckets[key] = buckets.get(key, 0) + count
+        return self
+
+    def merge(self, other):
+        for name in self.columns:
+            s, o = self.stats[name], other.stats[name]
+            s["count"] += o["count"]
+            s["missing"] += o["missing"]
+            if o["n"]:
+                total = s["n"] + o["n"]
+                delta = o["mean"] - s["mean"]
+                s["mean"] += delta * o["n"] / total
+                s["m2"] += o["m2"] + delta ** 2 * s["n"] * o["n"] / total
+                s["n"] = total
+                s["min"], s["max"] = min(s["min"], o["min"]), max(s["max"], o["max"])
+            s["zero"] += o["zero"]
+            for store in ("pos", "neg"):
+                for key, count in o[store].items():
+                    s[store][key] = s[store].get(key, 0) + count
+        return self
+
+    def _sorted_buckets(self, name):
+        # (value, count) from most negative to most positive
+        s = self.stats[name]
+        neg = [(-self._value(k), c) for k, c in sorted(s["neg"].items(), reverse=True)]
+        pos = [(self._value(k), c) for k, c in sorted(s["pos"].items())]
+        return neg + ([(0.0, s["zero"])] if s["zero"] else []) + pos
+
+    def _value(self, key):
+        # Midpoint of bucket (gamma^(key-1), gamma^key] with relative error <= SKETCH_ACCURACY
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def quantile(self, name, q):
+        s = self.stats[name]
+        if not s["n"]:
+            return math.nan
+        rank = q * (s["n"] - 1)
+        seen = 0
+        for value, count in self._sorted_buckets(name):
+            seen += count
+            if seen > rank:
+                return min(max(value, s["min"]), s["max"])
+        return s["max"]
+
+    def cdf(self, name, x):
+        s = self.stats[name]
+        if not s["n"]:
+            return math.nan
+        below = sum(count for value, count in self._sorted_buckets(name) if value <= x)
+        return below / s["n"]
+
+    def summary(self, name):
+        s = self.stats[name]
+        return {
+            "count": s["count"],
+            "missing_rate": s["missing"] / s["count"] if s["count"] else math.nan,
+            "mean": s["mean"] if s["n"] else math.nan,
+            "std": math.sqrt(s["m2"] / (s["n"] - 1)) if s["n"] > 1 else math.nan,
+            "min": s["min"] if s["n"] else math.nan,
+            "max": s["max"] if s["n"] else math.nan,
+            **{f"p{int(q * 100)}": self.quantile(name, q) for q in QUANTILES},
+        }
+
+    def histogram(self, name):
+        return self._sorted_buckets(name)
+
+    def to_dict(self):
+        return {
+            "columns": self.columns,
+            "stats": {
+                name: dict(s, pos={str(k): v for k, v in s["pos"].items()}, neg={str(k): v for k, v in s["neg"].items()},
+                           min=s["min"] if s["n"] else None, max=s["max"] if s["n"] else None)
+                for name, s in self.stats.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        collector = cls(data["columns"])
+        for name, s in data["stats"].items():
+            collector.stats[name] = dict(
+                s, pos={int(k): v for k, v in s["pos"].items()}, neg={int(k): v for k, v in s["neg"].items()},
+                min=s["min"] if s["min"] is not None else math.inf, max=s["max"] if s["max"] is not None else -math.inf,
+            )
+        return collector
+
+
+def save_stats(stats, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(stats.to_dict(), f)
+    os.replace(tmp_path, path)
+
+
+def load_stats(path):
+    with open(path, "r") as f:
+        return FeatureStats.from_dict(json.load(f))
+
+
+def stats_from_csv(path, columns=FEATURE_COLS, chunk_rows=CHUNK_ROWS):
+    stats = FeatureStats(columns)
+    for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_rows):
+        stats.update(chunk)
+    return stats
+
+
+def psi(reference, current, name, bins=10):
+    # Population stability index over the reference deciles, both sides
+    # read from their sketches
+    edges = sorted({reference.quantile(name, q / bins) for q in range(1, bins)})
+    ref_cdf = np.array([0.0] + [reference.cdf(name, e) for e in edges] + [1.0])
+    cur_cdf = np.array([0.0] + [current.cdf(name, e) for e in edges] + [1.0])
+    ref_p = np.clip(np.diff(ref_cdf), 1e-4, None)
+    cur_p = np.clip(np.diff(cur_cdf), 1e-4, None)
+    return float(((cur_p - ref_p) * np.log(cur_p / ref_p)).sum())
+
+
+def compare(reference, current):
+    report = []
+    for name in current.columns:
+        if name not in reference.stats:
+            continue
+        ref, cur = reference.summary(name), current.summary(name)
+        row = {
+            "feature": name,
+            "count": cur["count"],
+            "missing_rate": cur["missing_rate"],
+            "missing_rate_change": cur["missing_rate"] - ref["missing_rate"],
+            "mean_shift_std": (cur["mean"] - ref["mean"]) / ref["std"] if ref["std"] else math.nan,
+            "psi": psi(reference, current, name) if reference.stats[name]["n"] and current.stats[name]["n"] else math.nan,
+        }
+        if cur["count"] < MIN_COUNT:
+            row["status"] = "too few rows"
+        elif row["psi"] >= PSI_ALERT or abs(row["missing_rate_change"]) >= MISSING_RATE_ALERT:
+            row["status"] = "drift"
+        elif row["psi"] >= PSI_WARN:
+            row["status"] = "warn"
+        else:
+            row["status"] = "ok"
+        report.append(row)
+    return report
+
+
+def print_report(report):
+    print(f"{'feature':<24} {'rows':>8} {'missing':>8} {'Δmissing':>9} {'Δmean/sd':>9} {'psi':>7}  status")
+    for row in report:
+        print(f"{row['feature']:<24} {row['count']:>8} {row['missing_rate']:>8.1%} {row['missing_rate_change']:>+9.1%} "
+              f"{row['mean_shift_std']:>+9.2f} {row['psi']:>7.3f}  {row['status']}")
+    drifted = [row["feature"] for row in report if row["status"] == "drift"]
+    for name in drifted:
+        metrics.incr("feature_drift_alerts_total", feature=name)
+    if drifted:
+        print(f"\nDrift in {len(drifted)} feature(s): {', '.join(drifted)}. Consider retraining.")
+    else:
+        print("\nNo feature drift against the training snapshot.")
+    return drifted
+
+
+def check_drift(current, reference_file=REFERENCE_FILE):
+    if not os.path.exists(reference_file):
+        print(f"No training snapshot at {reference_file}; skipping drift check")
+        return None
+    return print_report(compare(load_stats(reference_file), current))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Summarize feature distributions and check them against the training snapshot")
+    arg_parser.add_argument("command", choices=["snapshot", "compare", "show"])
+    arg_parser.add_argument("stats", nargs="?", help=f"stats file for compare/show (default: {SCORING_FILE})")
+    arg_parser.add_argument("--data", help="training rows for snapshot (default: training_data.csv), or rows to compare instead of a stats file")
+    arg_parser.add_argument("--reference", default=REFERENCE_FILE)
+    args = arg_parser.parse_args(argv)
+
+    if args.command == "snapshot":
+        with metrics.stage("feature_stats"):
+            save_stats(stats_from_csv(args.data or "training_data.csv"), args.reference)
+        print(f"Saved training feature snapshot to {args.reference}")
+    elif args.command == "show":
+        stats = load_stats(args.stats or args.reference)
+        for name in stats.columns:
+            print(name, {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.summary(name).items()})
+    else:
+        current = stats_from_csv(args.data) if args.data and not args.stats else load_stats(args.stats or SCORING_FILE)
+        check_drift(current, args.reference)
+    metrics.export("feature_stats")
+
+
+if __name__ == "__main__":
+    main()
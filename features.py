@@ -1,7 +1,9 @@
+import argparse
 import json
-from dateutil import parser
-from fuzzywuzzy import process
-from geopy.distance import geodesic
+import metrics
+from addresses import address_key, canonical_cache
+from feature_registry import haversine_km
+from records import is_unchanged, load_appraisals, load_existing, merge_appraisals, save_appraisals
 
 # Config
 INPUT_FILE = "cleaned_appraisals_dataset.json"
@@ -9,8 +11,16 @@ OUTPUT_FILE = "feature_engineered_appraisals_dataset.json"
 
 ADDRESS_FILE = "geocoded_addresses.json"
 
-with open(ADDRESS_FILE, "r") as f:
-            address_data = json.load(f)
+# Geocode cache keyed by address_key, loaded on first use so importing this
+# module stays cheap
+address_data = None
+
+def get_address_data():
+    global address_data
+    if address_data is None:
+        with open(ADDRESS_FILE, "r") as f:
+            address_data = canonical_cache(json.load(f))
+    return address_data
 
 CANONICAL_TYPES = [
     "Townhouse", "Detached", "Condominium", "Semi Detached",
@@ -50,29 +60,7 @@ manual_type_map = {
 }
 
 
-def sold_recently(appraisal):
-    subject = appraisal['subject']
-    subject_effective_data = parser.parse(subject['effective_date'])
-
-    for comp in appraisal['comps']:
-        sale_date = parser.parse(comp.get('sale_date'))
-        days_ago_sold = (subject_effective_data-sale_date).days
-        if days_ago_sold <= 90:
-            comp['sold_recently'] = 1
-        else:
-            comp['sold_recently'] = 0
-        
-
-    for property in appraisal['properties']:
-        close_date = parser.parse(property.get('close_date'))
-        days_ago_sold = (subject_effective_data-close_date).days
-        if days_ago_sold <= 90:
-            property['sold_recently'] = 1
-        else:
-            property['sold_recently'] = 0
-
-    return appraisal
-
+@metrics.timed("map_to_property_type")
 def map_to_property_type(raw):
     if not raw:
         return None
@@ -81,275 +69,63 @@ def map_to_property_type(raw):
 
     # Manual check first
     if val in manual_type_map:
+        metrics.incr("property_type_lookups_total", result="manual")
         return manual_type_map[val]
 
     # Fuzzy fallback to catch close things
+    from fuzzywuzzy import process
     match, score = process.extractOne(val, CANONICAL_TYPES, scorer=process.fuzz.partial_ratio)
+    metrics.incr("property_type_lookups_total", result="fuzzy_match" if score >= 80 else "fuzzy_miss")
     return match if score >= 80 else None
 
 
-def same_property_type(appraisal):
-    subject = appraisal['subject']
-    subject_raw = subject.get('structure_type')
-    subject_type = map_to_property_type(subject_raw)
-    subject['property_type'] = subject_type
-
-    if not subject_type:
-        return appraisal  
-
-    for comp in appraisal['comps']:
-        comp_raw = comp.get('prop_type')
-        comp_type = map_to_property_type(comp_raw)
-        comp['property_type'] = comp_type
-        comp['same_property_type'] = int(subject_type == comp_type)
-
-    for property in appraisal['properties']:
-        property_raw = property.get('property_sub_type')
-        property_type = map_to_property_type(property_raw)
-        property['property_type'] = property_type
-        property['same_property_type'] = int(subject_type == property_type)
-        
-
-    return appraisal
-
-def effective_age_diff(appraisal):
-    subject = appraisal['subject']
-    subject_effective_age = subject.get("effective_age")
-    
-    if not subject_effective_age:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_age = comp.get('age')
-        if comp_age:
-            comp['effective_age_diff'] = subject_effective_age-comp_age
-        else:
-            comp['effective_age_diff'] = None
-
-    for property in appraisal['properties']:
-        property_age = property.get('age')
-        if property_age:
-            property['effective_age_diff'] = subject_effective_age-property_age
-        else:
-            property['effective_age_diff'] = None
-
-    return appraisal
-
-def subject_age_diff(appraisal):
-    subject = appraisal['subject']
-    subject_age = subject.get("subject_age")
-
-    if not subject_age:
-        return appraisal
-    
-    for comp in appraisal['comps']:
-        comp_age = comp.get('age')
-        if comp_age:
-            comp['subject_age_diff'] = subject_age-comp_age
-        else:
-            comp['subject_age_diff'] = None
-
-    for property in appraisal['properties']:
-        property_age = property.get('age')
-        if property_age:
-            property['subject_age_diff'] = subject_age-property_age
-        else:
-            property['subject_age_diff'] = None
-
-    return appraisal
-
-def lot_size_diff(appraisal):
-    subject = appraisal['subject']
-    subject_lot_size = subject.get('lot_size_sf')
-
-    for comp in appraisal['comps']:
-        comp_lot_size = comp.get('lot_size_sf')
-        if subject_lot_size is not None and comp_lot_size is not None:
-            comp['lot_size_diff_sf'] = subject_lot_size - comp_lot_size
-        else:
-            comp['lot_size_diff_sf'] = None
-
-    for property in appraisal['properties']:
-        property_lot_size = property.get('lot_size_sf')
-        if subject_lot_size is not None and property_lot_size is not None:
-            property['lot_size_diff_sf'] = subject_lot_size - property_lot_size
-        else:
-            property['lot_size_diff_sf'] = None
-
-    return appraisal
-
-def gla_diff(appraisal):
-    subject = appraisal['subject']
-    subject_gla = subject.get('gla')
-
-    if not subject_gla:
-        return appraisal
-    
-    for comp in appraisal['comps']:
-        comp_gla = comp.get('gla')
-        if comp_gla:
-            comp['gla_diff'] = subject_gla - comp_gla
-        else:
-            comp['gla_diff'] = None
-
-    for property in appraisal['properties']:
-        property_gla = property.get('gla')
-        if property_gla:
-            property['gla_diff'] = subject_gla - property_gla
-        else:
-            property['gla_diff'] = None
-
-    return appraisal
-
-def room_diff(appraisal):
-    subject = appraisal['subject']
-    subject_rooms = subject.get('room_count')
-
-    if not subject_rooms:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_rooms = comp.get('room_count')
-        if comp_rooms:
-            comp['room_count_diff'] = subject_rooms - comp_rooms
-        else:
-            comp['room_count_diff'] = None
-
-    for property in appraisal['properties']:
-        property_rooms = property.get('room_count')
-        if property_rooms:
-            property['room_count_diff'] = subject_rooms - property_rooms
-        else:
-            property['room_count_diff'] = None
-    
-    return appraisal
+# properties defaults to the appraisal's pool; add_new_features passes only
+# the shared listings not yet handled in this run
+def add_property_types(appraisal, properties=None):
+    subject = appraisal.subject
+    subject['property_type'] = map_to_property_type(subject.get('raw_type'))
 
-def bedroom_diff(appraisal):
-    subject = appraisal['subject']
-    subject_bedrooms = subject.get('num_beds')
-
-    if not subject_bedrooms:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_bedrooms = comp.get('num_beds')
-        if comp_bedrooms:
-            comp['bedrooms_diff'] = subject_bedrooms - comp_bedrooms
-        else:
-            comp['bedrooms_diff'] = None
-
-    for property in appraisal['properties']:
-        property_bedrooms = property.get('num_beds')
-        if property_bedrooms:
-            property['bedrooms_diff'] = subject_bedrooms - property_bedrooms
-        else:
-            property['bedrooms_diff'] = None
-    
-    return appraisal
+    for comp in appraisal.comps:
+        comp['property_type'] = map_to_property_type(comp.get('raw_type'))
 
-def bath_score_diff(appraisal):
-    subject = appraisal['subject']
-    subject_bath_score = subject.get('bath_score')
-
-    if not subject_bath_score:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_bath_score = comp.get('bath_score')
-        if comp_bath_score:
-            comp['bath_score_diff'] = subject_bath_score - comp_bath_score
-        else:
-            comp['bath_score_diff'] = None
-
-    for property in appraisal['properties']:
-        property_bath_score = property.get('bath_score')
-        if property_bath_score:
-            property['bath_score_diff'] = subject_bath_score - property_bath_score
-        else:
-            property['bath_score_diff'] = None
-    
-    return appraisal
+    for property in appraisal.properties if properties is None else properties:
+        property['property_type'] = map_to_property_type(property.get('raw_type'))
 
-def full_bath_diff(appraisal):
-    subject = appraisal['subject']
-    subject_fulls = subject.get('num_full_baths')
-
-    if not subject_fulls:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_fulls = comp.get('num_full_baths')
-        if comp_fulls:
-            comp['full_baths_diff'] = subject_fulls - comp_fulls
-        else:
-            comp['full_baths_diff'] = None
-
-    for property in appraisal['properties']:
-        property_fulls = property.get('num_full_baths')
-        if property_fulls:
-            property['full_baths_diff'] = subject_fulls - property_fulls
-        else:
-            property['full_baths_diff'] = None
-    
     return appraisal
 
-def half_bath_diff(appraisal):
-    subject = appraisal['subject']
-    subject_halfs = subject.get('num_half_baths')
-
-    if not subject_halfs:
-        return appraisal
-
-    for comp in appraisal['comps']:
-        comp_halfs = comp.get('num_half_baths')
-        if comp_halfs:
-            comp['half_baths_diff'] = subject_halfs - comp_halfs
-        else:
-            comp['half_baths_diff'] = None
-
-    for property in appraisal['properties']:
-        property_halfs = property.get('num_half_baths')
-        if property_halfs:
-            property['half_baths_diff'] = subject_halfs - property_halfs
-        else:
-            property['half_baths_diff'] = None
-    
-    return appraisal
-
-def add_geocoded_addresses(appraisal):
+def add_geocoded_addresses(appraisal, properties=None):
     def get_lat_lon(address):
-        data = address_data.get(address)
-        if data and isinstance(data, dict):
+        data = get_address_data().get(address_key(address))
+        # Failed lookups are cached as records without coordinates
+        if isinstance(data, dict) and data.get('lat') is not None:
+            metrics.incr("geocode_cache_lookups_total", result="hit")
             return data.get('lat'), data.get('lon')
+        metrics.incr("geocode_cache_lookups_total", result="miss")
         return None, None
 
-    subject = appraisal['subject']
-    subject_address = subject.get('address').lower()
-    subject['lat'], subject['lon'] = get_lat_lon(subject_address)
+    subject = appraisal.subject
+    subject['lat'], subject['lon'] = get_lat_lon(subject.get('address'))
 
-    for comp in appraisal.get('comps', []):
-        comp_address = comp.get('address').lower()
-        comp['lat'], comp['lon'] = get_lat_lon(comp_address)
+    for comp in appraisal.comps:
+        comp['lat'], comp['lon'] = get_lat_lon(comp.get('address'))
 
-    for prop in appraisal.get('properties', []):
-        prop_address = prop.get('address').lower()
-        prop['lat'], prop['lon'] = get_lat_lon(prop_address)
+    for prop in appraisal.properties if properties is None else properties:
+        prop['lat'], prop['lon'] = get_lat_lon(prop.get('address'))
 
     return appraisal
 
+@metrics.timed("get_distance_to_subject")
 def get_distance_to_subject(appraisal):
-
+    # Haversine, the same distance the distance_to_subject_km feature computes
+    # for pool properties
     def get_dist(sub_lat, sub_lon, lat, lon):
         try:
-            dist_km = geodesic(
-                (sub_lat, sub_lon), (lat, lon)
-            ).km
-            return round(dist_km, 3)
+            return haversine_km(sub_lat, sub_lon, lat, lon)
         except Exception as e:
             print(f"Distance error for {comp_address}: {e}")
             return None
 
-    subject = appraisal['subject']
+    subject = appraisal.subject
     subject_lat = subject.get('lat')
     subject_lon = subject.get('lon')
 
@@ -357,7 +133,9 @@ def get_distance_to_subject(appraisal):
         print(subject.get('address'))
         return appraisal 
 
-    for comp in appraisal['comps']:
+    # Pool properties are shared across appraisals, so their distance to this
+    # subject is computed by the distance feature from lat/lon instead
+    for comp in appraisal.comps:
 
         # Skip if already has a valid distance
         if comp.get('distance_to_subject_km') is not None:
@@ -367,64 +145,59 @@ def get_distance_to_subject(appraisal):
         if not comp_address:
             continue
 
-        cached = address_data.get(comp_address.lower())
+        cached = get_address_data().get(address_key(comp_address))
         if cached and isinstance(cached, dict):
             comp_lat = cached.get('lat')
             comp_lon = cached.get('lon')
             if comp_lat is not None and comp_lon is not None:
 
-                # Calculate geodesic distance in kilometers
+                # Calculate haversine distance in kilometers
                 comp['distance_to_subject_km'] = get_dist(subject_lat, subject_lon, comp_lat, comp_lon)
 
-    for property in appraisal['properties']:
-        property_address = property.get('address')
-        if not property_address: 
-            continue
-
-        cached = address_data.get(property_address.lower())
-        if cached and isinstance(cached, dict):
-            property_lat = cached.get('lat')
-            property_lon = cached.get('lon')
-            if property_lat is not None and property_lon is not None:
-
-                # Calculate geodesic distance in kilometers
-                property['distance_to_subject_km'] = get_dist(subject_lat, subject_lon, property_lat, property_lon)
-        
     return appraisal 
         
 
-def add_new_features():
-    with open(INPUT_FILE, "r") as f:
-            data = json.load(f)
+def add_new_features(input_file=INPUT_FILE, output_file=OUTPUT_FILE, incremental=False):
+    appraisals = load_appraisals(input_file)
+    existing = load_existing(output_file, incremental)
 
     feature_engineered = []
+    done = set()
     
-    for appraisal in data["appraisals"]:
-        
-        sold_recently(appraisal)
-        same_property_type(appraisal)
-        effective_age_diff(appraisal)
-        subject_age_diff(appraisal)
-        lot_size_diff(appraisal)
-        gla_diff(appraisal)
-        room_diff(appraisal)
-        bedroom_diff(appraisal)
-        bath_score_diff(appraisal)
-        full_bath_diff(appraisal)
-        half_bath_diff(appraisal)
+    with metrics.stage("features") as stage:
+        for appraisal in appraisals:
+            if is_unchanged(existing, appraisal.order_id, appraisal.source_hash):
+                metrics.incr("incremental_orders_total", stage="features", result="unchanged")
+                continue
+
+            # Shared listings are typed and geocoded once per run
+            fresh = [p for p in appraisal.properties if p.property_id not in done]
+            done.update(p.property_id for p in fresh)
 
-        add_geocoded_addresses(appraisal)
-        get_distance_to_subject(appraisal)
+            # Subject-vs-candidate features live in feature_registry.py and are
+            # computed when the training rows are built
+            add_property_types(appraisal, fresh)
+            add_geocoded_addresses(appraisal, fresh)
+            get_distance_to_subject(appraisal)
 
-        feature_engineered.append(appraisal)
+            feature_engineered.append(appraisal)
+        stage["items"] = len(feature_engineered)
 
 
-    with open(OUTPUT_FILE, "w") as f:
-        json.dump({"appraisals": feature_engineered}, f, indent=2)
+    save_appraisals(output_file, merge_appraisals(existing, feature_engineered) if incremental else feature_engineered)
 
-    print(f"Saved cleaned JSON to {OUTPUT_FILE}")
+    print(f"Saved cleaned JSON to {output_file}")
     
 
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Add property types, coordinates and distances to the cleaned appraisals")
+    arg_parser.add_argument("--incremental", action="store_true", help="only process new or changed orderIDs")
+    args = arg_parser.parse_args(argv)
+
+    add_new_features(incremental=args.incremental)
+    metrics.export("features")
+
+
 if __name__ == "__main__":
-    add_new_features()    
+    main()    
 
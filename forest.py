@@ -0,0 +1,178 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+import model_registry
+
+# Config
+FOREST_FILE = "xgb_rank_model.forest.npz"
+BATCH_SIZES = [1, 3, 10, 30, 100, 1000]
+
+# Compiled forest
+#
+# The booster is flattened into one set of node arrays shared by every tree:
+# feature, threshold, left, right, default_left and value. Leaves point back
+# at themselves, so walking all trees for a fixed number of steps (the
+# deepest tree's depth) lands every row on its leaf without per-tree
+# branching. Splits and leaf sums are done in float32 in tree order, the way
+# the XGBoost CPU predictor does them, so scores match Booster.predict
+# exactly.
+
+
+def _tree_depth(left, right):
+    depth, stack = 0, [(0, 0)]
+    while stack:
+        node, d = stack.pop()
+        if left[node] == -1:
+            depth = max(depth, d)
+        else:
+            stack.append((left[node], d + 1))
+            stack.append((right[node], d + 1))
+    return depth
+
+
+def _base_score(val):
+    # Newer XGBoost releases store a per-target vector such as "[0.5]"
+    return np.float32(float(str(val).strip("[]").split(",")[0]))
+
+
+def compile_forest(model_json):
+    learner = model_json["learner"]
+    booster = learner["gradient_booster"]
+    if booster["name"] != "gbtree":
+        raise ValueError(f"Only gbtree models can be compiled, got {booster['name']}")
+    if int(learner["learner_model_param"].get("num_target", "1")) != 1:
+        raise ValueError("Multi-target models are not supported")
+
+    trees = booster["model"]["trees"]
+    feature, threshold, left, right, default_left, value, roots = [], [], [], [], [], [], []
+    max_depth = 0
+    offset = 0
+
+    for tree in trees:
+        if any(tree["split_type"]):
+            raise ValueError("Categorical splits are not supported")
+        t_left = tree["left_children"]
+        t_right = tree["right_children"]
+        n = len(t_left)
+        is_leaf = np.asarray(t_left) == -1
+        ids = np.arange(offset, offset + n)
+
+        roots.append(offset)
+        feature.append(np.where(is_leaf, 0, tree["split_indices"]))
+        threshold.append(np.where(is_leaf, 0, tree["split_conditions"]))
+        left.append(np.where(is_leaf, ids, np.asarray(t_left) + offset))
+        right.append(np.where(is_leaf, ids, np.asarray(t_right) + offset))
+        default_left.append(np.asarray(tree["default_left"], dtype=bool))
+        value.append(np.where(is_leaf, tree["split_conditions"], 0))
+
+        max_depth = max(max_depth, _tree_depth(t_left, t_right))
+        offset += n
+
+    return {
+        "feature": np.concatenate(feature).astype(np.int32),
+        "threshold": np.concatenate(threshold).astype(np.float32),
+        "left": np.concatenate(left).astype(np.int32),
+        "right": np.concatenate(right).astype(np.int32),
+        "default_left": np.concatenate(default_left),
+        "value": np.concatenate(value).astype(np.float32),
+        "roots": np.asarray(roots, dtype=np.int32),
+        "base_score": _base_score(learner["learner_model_param"]["base_score"]),
+        "max_depth": max_depth,
+        "feature_names": list(learner.get("feature_names", [])),
+    }
+
+
+def export_forest(model_file=None, output_file=FOREST_FILE):
+    with open(model_file or model_registry.model_path(), "r") as f:
+        forest = compile_forest(json.load(f))
+
+    np.savez(
+        output_file,
+        **{k: v for k, v in forest.items() if k != "feature_names"},
+        feature_names=np.asarray(forest["feature_names"], dtype=str),
+    )
+    print(f"Saved compiled forest ({len(forest['roots'])} trees, {len(forest['value'])} nodes) to {output_file}")
+    return forest
+
+
+def load_forest(path=FOREST_FILE):
+    with np.load(path) as data:
+        forest = {k: data[k] for k in data.files}
+    forest["base_score"] = np.float32(forest["base_score"])
+    forest["max_depth"] = int(forest["max_depth"])
+    forest["feature_names"] = [str(name) for name in forest["feature_names"]]
+    return forest
+
+
+def predict_leaves(forest, X):
+    X = np.asarray(X, dtype=np.float32)
+    if X.ndim == 1:
+        X = X[None, :]
+    rows = np.arange(X.shape[0])[:, None]
+    node = np.broadcast_to(forest["roots"], (X.shape[0], len(forest["roots"])))
+
+    for _ in range(forest["max_depth"]):
+        x = X[rows, forest["feature"][node]]
+        go_left = np.where(np.isnan(x), forest["default_left"][node], x < forest["threshold"][node])
+        node = np.where(go_left, forest["left"][node], forest["right"][node])
+
+    return forest["value"][node]
+
+
+def predict_forest(forest, X):
+    leaves = predict_leaves(forest, X)
+    out = np.full(leaves.shape[0], forest["base_score"], dtype=np.float32)
+    # Accumulate tree by tree in float32 to match the XGBoost summation order
+    for t in range(leaves.shape[1]):
+        out += leaves[:, t]
+    return out
+
+
+def benchmark(model_file=None, data_file="training_data.csv", batch_sizes=BATCH_SIZES, repeats=50):
+    import pandas as pd
+    import xgboost as xgb
+
+    model_file = model_file or model_registry.model_path()
+    booster = xgb.Booster()
+    booster.load_model(model_file)
+    with open(model_file, "r") as f:
+        forest = compile_forest(json.load(f))
+
+    X_all = pd.read_csv(data_file)[forest["feature_names"]].astype(float)
+
+    print(f"{'batch':>6} {'booster ms':>11} {'forest ms':>10} {'speedup':>8}  identical")
+    results = []
+    for size in batch_sizes:
+        X = X_all.iloc[:size]
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            expected = booster.predict(xgb.DMatrix(X))
+        booster_ms = (time.perf_counter() - start) / repeats * 1000
+
+        values = X.to_numpy()
+        start = time.perf_counter()
+        for _ in range(repeats):
+            got = predict_forest(forest, values)
+        forest_ms = (time.perf_counter() - start) / repeats * 1000
+
+        identical = bool(np.array_equal(expected, got))
+        print(f"{len(X):>6} {booster_ms:>11.3f} {forest_ms:>10.3f} {booster_ms / forest_ms:>7.1f}x  {identical}")
+        results.append({"batch": len(X), "booster_ms": booster_ms, "forest_ms": forest_ms, "identical": identical})
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Compile the ranking model into NumPy tree tables")
+    arg_parser.add_argument("--model", help="model file (default: current registry version)")
+    arg_parser.add_argument("--output", default=FOREST_FILE)
+    arg_parser.add_argument("--benchmark", action="store_true", help="compare against Booster.predict across batch sizes")
+    arg_parser.add_argument("--data", default="training_data.csv", help="rows used for the benchmark")
+    args = arg_parser.parse_args()
+
+    export_forest(args.model, args.output)
+    if args.benchmark:
+        benchmark(args.model, args.data)
@@ -154,25 +154,62 @@
 
 # print(f"✅ Final cache saved to {CACHE_FILE}")
 
+import argparse
+import csv
 import os
 import json
 import time
+from datetime import datetime, timedelta
 from tqdm import tqdm
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from openai import OpenAI
+import metrics
+from addresses import address_key, canonical_cache, variants_of
+from records import load_appraisals
 
 # Config 
 CACHE_FILE = "geocoded_addresses.json"
 MISSING_FILE = "missing_addresses.txt"
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=OPENAI_API_KEY)
+DATA_FILE = "cleaned_appraisals_dataset.json"
+# orderID -> source_hash of every appraisal whose addresses were already checked
+WATERMARK_FILE = "geocode_watermark.json"
 
-# Helper functions
-def normalize_address(address):
-    return address.lower().strip()
+# Missing-address queue
+#
+# queue_missing checks only appraisals that are new or changed since the last
+# run (per the watermark), and appends every address whose canonical key is
+# neither in the cache nor already queued to the missing file. Failures whose
+# retry is due count as not cached; those without a stored raw address are
+# looked up in every appraisal, since the geocoder cannot retry them otherwise. Each line is
+# the raw address, then a tab and its city/province/postal context when known;
+# hand-added lines without context still work. geocode_missing drops lines
+# from the queue once their key is in the cache.
+
+# Failed lookups are cached as records instead of None:
+#   {"failed": reason, "attempts": n, "last_attempt": ..., "next_retry": ...,
+#    "address": raw, "context": [...]}
+# A failure is retried (from the cache, whether or not it is queued) only once
+# next_retry has passed. The wait doubles with every attempt, starting at
+# RETRY_BASE_DAYS and capped at RETRY_MAX_DAYS; after MAX_ATTEMPTS the address
+# is given up on (next_retry None) and listed by --report.
+RETRY_BASE_DAYS = 1
+RETRY_MAX_DAYS = 90
+MAX_ATTEMPTS = 6
+FAILURES_FILE = "geocode_failures.csv"
+
+# OpenAI client, created on first use so importing this module is side-effect free
+client = None
 
+def get_client():
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return client
+
+# Helper functions
+@metrics.timed("safe_geocode")
 def safe_geocode(geolocator, address):
+    from geopy.exc import GeocoderTimedOut
+
     try:
         return geolocator.geocode(address, timeout=10)
     except GeocoderTimedOut:
@@ -182,9 +219,11 @@ def safe_geocode(geolocator, address):
         print(f"Geocode error for '{address}': {e}")
         return None
 
+@metrics.timed("clean_address_with_gpt")
 def clean_address_with_gpt(raw_address):
     try:
-        response = client.chat.completions.create(
+        start = time.perf_counter()
+        response = get_client().chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": (
@@ -204,61 +243,264 @@ def clean_address_with_gpt(raw_address):
             ],
             temperature=0
         )
+        metrics.record_llm_call(response, "address_cleanup", time.perf_counter() - start)
         return response.choices[0].message.content.strip()
     except Exception as e:
+        metrics.incr("llm_errors_total", call="address_cleanup")
         print(f"GPT error for '{raw_address}': {e}")
         return None
 
-# Load cache 
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r") as f:
-        geocoded = json.load(f)
-else:
-    geocoded = {}
+def is_hit(entry):
+    return isinstance(entry, dict) and entry.get("lat") is not None
+
+def is_due(entry, now):
+    if is_hit(entry) or entry.get("next_retry") is None:
+        return False
+    return datetime.fromisoformat(entry["next_retry"]) <= now
+
+def failure_record(previous, reason, address, context, now):
+    attempts = previous.get("attempts", 1) + 1 if isinstance(previous, dict) else 1
+    wait = min(RETRY_BASE_DAYS * 2 ** (attempts - 1), RETRY_MAX_DAYS)
+    return {
+        "failed": reason,
+        "attempts": attempts,
+        "last_attempt": now.isoformat(timespec="seconds"),
+        "next_retry": (now + timedelta(days=wait)).isoformat(timespec="seconds") if attempts < MAX_ATTEMPTS else None,
+        "address": address,
+        "context": context,
+    }
+
+# Failures cached as None by older versions become records due now: one
+# retry on the next run, then the usual backoff
+def legacy_failure(now):
+    return {
+        "failed": "unknown (legacy)",
+        "attempts": 1,
+        "last_attempt": None,
+        "next_retry": now.isoformat(timespec="seconds"),
+        "address": None,
+        "context": [],
+    }
+
+# Load cache, keyed by address_key
+def load_cache(cache_file=CACHE_FILE):
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, "r") as f:
+        cache = canonical_cache(json.load(f))
+    now = datetime.now()
+    return {key: entry if entry is not None else legacy_failure(now) for key, entry in cache.items()}
+
+# Load missing list as (raw address, context), one per canonical key
+def load_missing(missing_file=MISSING_FILE):
+    missing = {}
+    if not os.path.exists(missing_file):
+        return []
+    with open(missing_file, "r") as f:
+        for line in f:
+            address, _, context = line.rstrip("\n").partition("\t")
+            if address.strip():
+                parts = [part.strip() for part in context.split(",") if part.strip()]
+                missing.setdefault(address_key(address), (address.strip(), parts))
+    return list(missing.values())
+
+def save_missing(missing, missing_file=MISSING_FILE):
+    tmp_path = f"{missing_file}.tmp"
+    with open(tmp_path, "w") as f:
+        for address, context in missing:
+            f.write(f"{address}\t{', '.join(context)}\n" if context else f"{address}\n")
+    os.replace(tmp_path, missing_file)
+
+def enrich_address(address, context):
+    # Context parts the address does not already contain, e.g. "12 Main St, Kingston, ON K7L 1A1"
+    parts = [address] + [part for part in context if part.lower() not in address.lower()]
+    return ", ".join(parts)
+
+def load_watermark(watermark_file=WATERMARK_FILE):
+    if not os.path.exists(watermark_file):
+        return {}
+    with open(watermark_file, "r") as f:
+        return json.load(f)
+
+def find_missing(appraisals, known):
+    missing = {}
+    for appraisal in appraisals:
+        for prop in [appraisal.subject] + list(appraisal.comps) + list(appraisal.properties):
+            key = address_key(prop.address)
+            if key and key not in known and key not in missing:
+                missing[key] = (prop.address.strip(), prop.address_context or [])
+    return missing
+
+def queue_missing(data_file=DATA_FILE, cache_file=CACHE_FILE, missing_file=MISSING_FILE, watermark_file=WATERMARK_FILE, full=False):
+    watermark = {} if full else load_watermark(watermark_file)
+    all_appraisals = load_appraisals(data_file)
+    appraisals = [a for a in all_appraisals if a.source_hash is None or watermark.get(a.order_id) != a.source_hash]
+    metrics.incr("geocode_watermark_orders_total", len(appraisals), result="checked")
+
+    geocoded = load_cache(cache_file)
+    queued = load_missing(missing_file)
+    queued_keys = {address_key(address) for address, _ in queued}
+    now = datetime.now()
+    due = {key for key, entry in geocoded.items() if is_due(entry, now)}
+    known = (set(geocoded) - due) | queued_keys
+    missing = find_missing(appraisals, known)
 
-# Load missing list 
-with open(MISSING_FILE, "r") as f:
-    missing_addresses = [normalize_address(line) for line in f if line.strip()]
+    # Due failures with no raw address to retry from the cache
+    unaddressed = {key for key in due - queued_keys - set(missing) if not geocoded[key].get("address")}
+    if unaddressed:
+        missing |= {key: value for key, value in find_missing(all_appraisals, known).items() if key in unaddressed}
+    save_missing(queued + list(missing.values()), missing_file)
+    metrics.incr("geocode_queued_total", len(missing))
+
+    # The watermark only moves once the delta is safely in the queue
+    watermark.update({a.order_id: a.source_hash for a in appraisals if a.source_hash})
+    with open(watermark_file, "w") as f:
+        json.dump(watermark, f)
+
+    # Queued lines not yet resolved, new lines, and due failures retried from the cache
+    retried = {key for key in due - queued_keys - set(missing) if geocoded[key].get("address")}
+    pending = sum(1 for key in queued_keys if key not in geocoded or key in due) + len(missing) + len(retried)
+    print(f"Checked {len(appraisals)} new or changed appraisals: {len(missing)} addresses queued, {pending} pending")
+    return pending
+
+# Other spellings of the same address seen during cleaning, tried before the LLM
+def geocode_variants(geolocator, raw_address, key):
+    for variant in variants_of(key):
+        if variant.lower() == raw_address.lower():
+            continue
+        time.sleep(1)
+        location = safe_geocode(geolocator, variant)
+        if location:
+            print(f"Alias success: {variant}")
+            return location
+    return None
 
 # Main process 
-geolocator = Nominatim(user_agent="comp-geocoder")
-added = 0
-
-for raw_address in tqdm(missing_addresses):
-    if raw_address in geocoded and geocoded[raw_address] is not None:
-        continue
-
-    print(f"📍 Geocoding: {raw_address}")
-    location = safe_geocode(geolocator, raw_address)
-    if location:
-        geocoded[raw_address] = {
-            "lat": location.latitude,
-            "lon": location.longitude,
-        }
-        added += 1
-    else:
-        print(f"⚠️ Nominatim failed. Trying GPT to clean: {raw_address}")
-        cleaned = clean_address_with_gpt(raw_address)
-        if cleaned:
-            location = safe_geocode(geolocator, cleaned)
+def geocode_missing(missing_file=MISSING_FILE, cache_file=CACHE_FILE):
+    from geopy.geocoders import Nominatim
+
+    geocoded = load_cache(cache_file)
+    missing_addresses = load_missing(missing_file)
+    now = datetime.now()
+
+    # Failures that are due come back from the cache even when no longer queued
+    queued = {address_key(address) for address, _ in missing_addresses}
+    missing_addresses += [
+        (entry["address"], entry.get("context") or [])
+        for key, entry in geocoded.items()
+        if key not in queued and entry.get("address") and is_due(entry, now)
+    ]
+
+    geolocator = Nominatim(user_agent="comp-geocoder")
+    added = 0
+
+    with metrics.stage("geocode", items=len(missing_addresses)):
+        for raw_address, context in tqdm(missing_addresses):
+            key = address_key(raw_address)
+            if is_hit(geocoded.get(key)):
+                metrics.incr("geocode_cache_lookups_total", result="hit")
+                continue
+            if key in geocoded and not is_due(geocoded[key], now):
+                metrics.incr("geocode_cache_lookups_total", result="failure_cached")
+                continue
+            metrics.incr("geocode_cache_lookups_total", result="miss")
+
+            print(f"📍 Geocoding: {raw_address}")
+            location, source = None, "nominatim"
+            if context:
+                location = safe_geocode(geolocator, enrich_address(raw_address, context))
+                if not location:
+                    time.sleep(1)
+            if not location:
+                location = safe_geocode(geolocator, raw_address)
+            if not location:
+                location, source = geocode_variants(geolocator, raw_address, key), "alias"
             if location:
-                print(f"GPT cleaned success: {cleaned}")
-                geocoded[raw_address] = {
+                geocoded[key] = {
                     "lat": location.latitude,
                     "lon": location.longitude,
                 }
+                metrics.incr("geocode_results_total", source=source)
                 added += 1
             else:
-                print(f"GPT cleaned address failed to geocode: {cleaned}")
-                geocoded[raw_address] = None
-        else:
-            print(f"GPT failed to parse: {raw_address}")
-            geocoded[raw_address] = None
+                print(f"⚠️ Nominatim failed. Trying GPT to clean: {raw_address}")
+                cleaned = clean_address_with_gpt(raw_address)
+                if cleaned:
+                    location = safe_geocode(geolocator, cleaned)
+                    if location:
+                        print(f"GPT cleaned success: {cleaned}")
+                        geocoded[key] = {
+                            "lat": location.latitude,
+                            "lon": location.longitude,
+                        }
+                        metrics.incr("geocode_results_total", source="gpt")
+                        added += 1
+                    else:
+                        print(f"GPT cleaned address failed to geocode: {cleaned}")
+                        metrics.incr("geocode_results_total", source="failed")
+                        geocoded[key] = failure_record(geocoded.get(key), "no_match", raw_address, context, now)
+                else:
+                    print(f"GPT failed to parse: {raw_address}")
+                    metrics.incr("geocode_results_total", source="failed")
+                    geocoded[key] = failure_record(geocoded.get(key), "llm_cleanup_failed", raw_address, context, now)
+
+            # Save incrementally
+            with open(cache_file, "w") as f:
+                json.dump(geocoded, f, indent=2)
+
+            time.sleep(1)
+
+    # Everything now in the cache, hit or failure, leaves the queue
+    save_missing([(a, c) for a, c in load_missing(missing_file) if address_key(a) not in geocoded], missing_file)
+
+    print(f"\nGeocoding complete — {added} new addresses added to {cache_file}")
+    return added
+
+def report_failures(cache_file=CACHE_FILE, output_file=FAILURES_FILE):
+    failures = {key: entry for key, entry in load_cache(cache_file).items() if not is_hit(entry)}
+    rows = []
+    for key, entry in sorted(failures.items()):
+        rows.append({
+            "key": key,
+            "address": entry.get("address"),
+            "reason": entry.get("failed"),
+            "attempts": entry.get("attempts"),
+            "last_attempt": entry.get("last_attempt"),
+            "next_retry": entry.get("next_retry") or ("gave up" if entry.get("attempts") else None),
+        })
+    with open(output_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["key", "address", "reason", "attempts", "last_attempt", "next_retry"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    gave_up = sum(1 for row in rows if row["next_retry"] == "gave up")
+    reasons = {}
+    for row in rows:
+        reasons[row["reason"]] = reasons.get(row["reason"], 0) + 1
+    print(f"{len(rows)} failed addresses, {gave_up} given up after {MAX_ATTEMPTS} attempts")
+    for reason, count in sorted(reasons.items(), key=lambda item: -item[1]):
+        print(f"  {reason:<24} {count}")
+    print(f"Saved failure report to {output_file}")
+    return rows
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Geocode the addresses listed in the missing-address file")
+    arg_parser.add_argument("--missing", default=MISSING_FILE)
+    arg_parser.add_argument("--cache", default=CACHE_FILE)
+    arg_parser.add_argument("--queue", action="store_true", help=f"first queue un-geocoded addresses from new or changed appraisals in {DATA_FILE}")
+    arg_parser.add_argument("--full", action="store_true", help="with --queue, ignore the watermark and check every appraisal")
+    arg_parser.add_argument("--report", action="store_true", help=f"only write the failed-address report to {FAILURES_FILE}")
+    args = arg_parser.parse_args(argv)
 
-    # Save incrementally
-    with open(CACHE_FILE, "w") as f:
-        json.dump(geocoded, f, indent=2)
+    if args.report:
+        report_failures(args.cache)
+        return
+    if args.queue:
+        queue_missing(cache_file=args.cache, missing_file=args.missing, full=args.full)
+    geocode_missing(args.missing, args.cache)
+    metrics.export("geocode_all_addresses")
 
-    time.sleep(1)
 
-print(f"\nGeocoding complete — {added} new addresses added to {CACHE_FILE}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import json
+import os
+import resource
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+# Config
+# One JSONL log for every run plus one Prometheus textfile per script, so a
+# node_exporter textfile collector can scrape the whole directory
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")
+METRICS_JSONL = "metrics.jsonl"
+PREFIX = "comps"
+
+RUN_ID = uuid.uuid4().hex[:12]
+
+stages = []
+functions = {}
+counters = {}
+summaries = {}
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+@contextmanager
+def stage(name, items=None):
+    record = {"stage": name, "items": items}
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    rss_start = peak_rss_mb()
+    try:
+        yield record
+    finally:
+        wall = time.perf_counter() - wall_start
+        record["wall_s"] = round(wall, 4)
+        record["cpu_s"] = round(time.process_time() - cpu_start, 4)
+        record["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        record["rss_growth_mb"] = round(peak_rss_mb() - rss_start, 1)
+        items = record["items"]
+        record["items_per_s"] = round(items / wall, 1) if items and wall > 0 else None
+        stages.append(record)
+
+
+def timed(name):
+    def decorator(fn):
+        stats = functions.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "max_s": 0.0})
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall_start
+                stats["calls"] += 1
+                stats["wall_s"] += wall
+                stats["cpu_s"] += time.process_time() - cpu_start
+                if wall > stats["max_s"]:
+                    stats["max_s"] = wall
+
+        return wrapper
+
+    return decorator
+
+
+def incr(name, value=1, **labels):
+    key = (name, _labels_key(labels))
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = (name, _labels_key(labels))
+    summary = summaries.setdefault(key, {"count": 0, "sum": 0.0, "max": 0.0})
+    summary["count"] += 1
+    summary["sum"] += value
+    if value > summary["max"]:
+        summary["max"] = value
+
+
+def record_llm_call(response, call, latency):
+    observe("llm_latency_seconds", latency, call=call)
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        incr("llm_tokens_total", usage.prompt_tokens, call=call, kind="prompt")
+        incr("llm_tokens_total", usage.completion_tokens, call=call, kind="completion")
+
+
+def snapshot():
+    return {
+        "run_id": RUN_ID,
+        "stages": list(stages),
+        "functions": {
+            name: dict(s, calls_per_s=round(s["calls"] / s["wall_s"], 1) if s["wall_s"] else None)
+            for name, s in functions.items() if s["calls"]
+        },
+        "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in counters.items()],
+        "summaries": [{"name": n, "labels": dict(l)} | s for (n, l), s in summaries.items()],
+    }
+
+
+def reset():
+    stages.clear()
+    counters.clear()
+    summaries.clear()
+    for stats in functions.values():
+        stats.update(calls=0, wall_s=0.0, cpu_s=0.0, max_s=0.0)
+
+
+def script_name():
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+
+
+def write_jsonl(path, script=None):
+    ts = time.strftime("%Y-%m-%dT%H:%M:%S")
+    base = {"ts": ts, "run_id": RUN_ID, "script": script or script_name()}
+    snap = snapshot()
+
+    with open(path, "a") as f:
+        for record in snap["stages"]:
+            f.write(json.dumps(base | {"type": "stage"} | record) + "\n")
+        for name, stats in snap["functions"].items():
+            f.write(json.dumps(base | {"type": "function", "function": name} | stats) + "\n")
+        for record in snap["counters"]:
+            f.write(json.dumps(base | {"type": "counter"} | record) + "\n")
+        for record in snap["summaries"]:
+            f.write(json.dumps(base | {"type": "summary"} | record) + "\n")
+
+
+def _escape(val):
+    return str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def write_prometheus(path, script=None):
+    lines = []
+    script = script or script_name()
+
+    def metric(name, kind, help_text, samples):
+        if not samples:
+            return
+        lines.append(f"# HELP {PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{PREFIX}_{name}{_prom_labels({'script': script} | labels)} {value}")
+
+    snap = snapshot()
+    metric("stage_wall_seconds", "gauge", "Wall time per pipeline stage.",
+           [({"stage": s["stage"]}, s["wall_s"]) for s in snap["stages"]])
+    metric("stage_cpu_seconds", "gauge", "CPU time per pipeline stage.",
+           [({"stage": s["stage"]}, s["cpu_s"]) for s in snap["stages"]])
+    metric("stage_peak_rss_megabytes", "gauge", "Process peak RSS at the end of each stage.",
+           [({"stage": s["stage"]}, s["peak_rss_mb"]) for s in snap["stages"]])
+    metric("stage_items_per_second", "gauge", "Item throughput per pipeline stage.",
+           [({"stage": s["stage"]}, s["items_per_s"]) for s in snap["stages"] if s["items_per_s"] is not None])
+    metric("function_calls_total", "counter", "Calls per instrumented function.",
+           [({"function": n}, s["calls"]) for n, s in snap["functions"].items()])
+    metric("function_wall_seconds_total", "counter", "Wall time per instrumented function.",
+           [({"function": n}, round(s["wall_s"], 6)) for n, s in snap["functions"].items()])
+    metric("function_cpu_seconds_total", "counter", "CPU time per instrumented function.",
+           [({"function": n}, round(s["cpu_s"], 6)) for n, s in snap["functions"].items()])
+
+    for name in sorted({c["name"] for c in snap["counters"]}):
+        metric(name, "counter", f"Counter {name}.",
+               [(c["labels"], c["value"]) for c in snap["counters"] if c["name"] == name])
+
+    for name in sorted({s["name"] for s in snap["summaries"]}):
+        rows = [s for s in snap["summaries"] if s["name"] == name]
+        lines.append(f"# HELP {PREFIX}_{name} Summary {name}.")
+        lines.append(f"# TYPE {PREFIX}_{name} summary")
+        for s in rows:
+            labels = _prom_labels({"script": script} | s["labels"])
+            lines.append(f"{PREFIX}_{name}_count{labels} {s['count']}")
+            lines.append(f"{PREFIX}_{name}_sum{labels} {round(s['sum'], 6)}")
+
+    # Write then rename so a scraper never reads a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def export(script=None, metrics_dir=METRICS_DIR):
+    if not metrics_dir:
+        return
+    script = script or script_name()
+    os.makedirs(metrics_dir, exist_ok=True)
+    write_jsonl(os.path.join(metrics_dir, METRICS_JSONL), script)
+    write_prometheus(os.path.join(metrics_dir, f"{script}.prom"), script)
+
+
+def print_summary():
+    for record in stages:
+        print(
+            f"[metrics] {record['stage']}: {record['wall_s']:.3f}s wall, {record['cpu_s']:.3f}s cpu, "
+            f"{record['peak_rss_mb']:.1f} MB peak RSS, {record['items']} items"
+        )
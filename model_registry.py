@@ -0,0 +1,189 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+# Config
+REGISTRY_DIR = os.getenv("MODEL_REGISTRY_DIR", "models")
+CURRENT_FILE = "CURRENT"
+MODEL_NAME = "model.json"
+META_NAME = "meta.json"
+LEGACY_MODEL_FILE = "xgb_rank_model.json"
+
+# Versioned model registry
+#
+# Every trained model is stored once under models/v0001, models/v0002, ...
+# next to a meta.json with its training-data fingerprint, params and
+# evaluation metrics. A version directory is written under a temporary name
+# and renamed into place, and models/CURRENT is replaced atomically, so a
+# reader never sees a half-written model. Switching or rolling back is a
+# pointer rewrite; consumers holding a ModelHandle pick it up on their next
+# call without restarting.
+
+
+def _version_name(version):
+    return f"v{int(version):04d}"
+
+
+def version_dir(version, registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, _version_name(version))
+
+
+def list_versions(registry_dir=REGISTRY_DIR):
+    if not os.path.isdir(registry_dir):
+        return []
+    versions = []
+    for name in os.listdir(registry_dir):
+        if name.startswith("v") and name[1:].isdigit() and os.path.exists(os.path.join(registry_dir, name, MODEL_NAME)):
+            versions.append(int(name[1:]))
+    return sorted(versions)
+
+
+def fingerprint(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def current_version(registry_dir=REGISTRY_DIR):
+    try:
+        with open(os.path.join(registry_dir, CURRENT_FILE)) as f:
+            return int(f.read().strip().lstrip("v"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def set_current(version, registry_dir=REGISTRY_DIR):
+    if int(version) not in list_versions(registry_dir):
+        raise ValueError(f"Model version {version} is not in {registry_dir}")
+    _write_atomic(os.path.join(registry_dir, CURRENT_FILE), _version_name(version) + "\n")
+    print(f"Current model is now {_version_name(version)}")
+    return int(version)
+
+
+def rollback(registry_dir=REGISTRY_DIR):
+    current = current_version(registry_dir)
+    older = [v for v in list_versions(registry_dir) if current is None or v < current]
+    if not older:
+        raise ValueError("No earlier model version to roll back to")
+    return set_current(older[-1], registry_dir)
+
+
+def read_metadata(version, registry_dir=REGISTRY_DIR):
+    with open(os.path.join(version_dir(version, registry_dir), META_NAME)) as f:
+        return json.load(f)
+
+
+def model_path(version=None, registry_dir=REGISTRY_DIR):
+    # Falls back to the flat model file for trees trained before the registry
+    version = version if version is not None else current_version(registry_dir)
+    if version is None:
+        return LEGACY_MODEL_FILE
+    return os.path.join(version_dir(version, registry_dir), MODEL_NAME)
+
+
+def register_model(model, training_data_file=None, eval_metrics=None, params=None, registry_dir=REGISTRY_DIR, activate=True):
+    os.makedirs(registry_dir, exist_ok=True)
+    version = (list_versions(registry_dir) or [0])[-1] + 1
+    final_dir = version_dir(version, registry_dir)
+    tmp_dir = f"{final_dir}.tmp-{os.getpid()}"
+
+    os.makedirs(tmp_dir)
+    try:
+        model.save_model(os.path.join(tmp_dir, MODEL_NAME))
+        meta = {
+            "version": version,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "training_data": training_data_file,
+            "training_data_sha256": fingerprint(training_data_file) if training_data_file else None,
+            "params": params,
+            "metrics": eval_metrics or {},
+        }
+        with open(os.path.join(tmp_dir, META_NAME), "w") as f:
+            json.dump(meta, f, indent=2)
+        os.rename(tmp_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    print(f"Registered model {_version_name(version)} in {registry_dir}")
+    if activate:
+        set_current(version, registry_dir)
+    return version
+
+
+def load_booster(path):
+    import xgboost as xgb
+
+    model = xgb.Booster()
+    model.load_model(path)
+    return model
+
+
+class ModelHandle:
+    # Holds the current model for a long-running consumer. get() re-reads the
+    # pointer at most every check_interval seconds and loads a new version
+    # only when it changed; the swap is a single reference assignment, so
+    # callers always get a fully loaded model.
+    def __init__(self, loader=load_booster, registry_dir=REGISTRY_DIR, check_interval=1.0):
+        self.loader = loader
+        self.registry_dir = registry_dir
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._checked = 0.0
+        self.version, self.model = self._load(current_version(registry_dir))
+
+    def _load(self, version):
+        return version, self.loader(model_path(version, self.registry_dir))
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                self._checked = now
+                version = current_version(self.registry_dir)
+                if version != self.version:
+                    self.version, self.model = self._load(version)
+                    print(f"Hot-swapped to model {_version_name(version) if version else LEGACY_MODEL_FILE}")
+        return self.model
+
+
+def print_versions(registry_dir=REGISTRY_DIR):
+    current = current_version(registry_dir)
+    for version in list_versions(registry_dir):
+        meta = read_metadata(version, registry_dir)
+        marker = "*" if version == current else " "
+        scores = "  ".join(f"{k}={v:.3f}" for k, v in meta.get("metrics", {}).items())
+        data = (meta.get("training_data_sha256") or "")[:12]
+        print(f"{marker} {_version_name(version)}  {meta['created']}  data {data}  {scores}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="List, activate or roll back registered ranking models")
+    arg_parser.add_argument("command", choices=["list", "use", "rollback"])
+    arg_parser.add_argument("version", nargs="?", type=int, help="version for 'use'")
+    arg_parser.add_argument("--registry", default=REGISTRY_DIR)
+    args = arg_parser.parse_args()
+
+    if args.command == "use":
+        if args.version is None:
+            arg_parser.error("'use' needs a version")
+        set_current(args.version, args.registry)
+    elif args.command == "rollback":
+        rollback(args.registry)
+    else:
+        print_versions(args.registry)
@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import forest
+import metrics
+import model_registry
+import train_model
+
+# Config
+DEPTHS = [2, 3, 4, 6, 8]
+ROUNDS = [10, 25, 50, 100, 200]
+KS = (1, 3)
+LATENCY_SUBJECTS = 200
+REPORT_FILE = "model_sizing.json"
+
+# Model sizing
+#
+# One booster is trained per depth at the largest round count and truncated
+# (booster[:rounds]) to every smaller count, so a sweep costs one training run
+# per depth. Each variant is scored on the same held-out split train_model.py
+# uses: NDCG@k and precision@k per order, per-subject scoring latency with the
+# compiled forest the online path uses, and the saved model size. A variant
+# is on the Pareto frontier when no other is at least as fast and at least as
+# good on the chosen metric.
+
+
+def ranking_metrics(scores, labels, order_ids, ks=KS):
+    qid = pd.factorize(order_ids)[0]
+    order = np.lexsort((-scores, qid))
+    qid, labels = qid[order], np.asarray(labels, dtype=float)[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(qid)) + 1]
+    sizes = np.diff(np.r_[starts, len(qid)])
+    position = np.arange(len(qid)) - np.repeat(starts, sizes)
+
+    # Ideal ordering: labels sorted high to low within each order
+    ideal = labels[np.lexsort((-labels, qid))]
+    discount = 1.0 / np.log2(position + 2)
+    has_positive = np.add.reduceat(labels, starts) > 0
+
+    out = {}
+    for k in ks:
+        top = position < k
+        hits = np.add.reduceat(labels * top, starts)
+        dcg = np.add.reduceat(labels * discount * top, starts)
+        idcg = np.add.reduceat(ideal * discount * top, starts)
+        out[f"precision@{k}"] = float(hits.sum() / (k * len(starts)))
+        # Orders without a labelled comp have no ideal ranking and are left out
+        out[f"ndcg@{k}"] = float((dcg[has_positive] / idcg[has_positive]).mean()) if has_positive.any() else 0.0
+    return out
+
+
+def scoring_latency_ms(compiled, df_test, subjects=LATENCY_SUBJECTS, seed=0):
+    groups = [g[train_model.feature_cols].to_numpy(dtype=float) for _, g in df_test.groupby("orderID")]
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(groups), size=min(subjects, len(groups)), replace=False)
+    timings = []
+    for i in sample:
+        start = time.perf_counter()
+        forest.predict_forest(compiled, groups[i])
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.median(timings)), float(np.percentile(timings, 95))
+
+
+def model_size_kb(booster):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "model.json")
+        booster.save_model(path)
+        return os.path.getsize(path) / 1024
+
+
+def sweep(df_train, df_test, depths=DEPTHS, rounds=ROUNDS, ks=KS, threads=None):
+    import xgboost as xgb
+
+    X_test = xgb.DMatrix(df_test[train_model.feature_cols].astype(float))
+    results, boosters = [], {}
+    for depth in depths:
+        with metrics.stage("sizing_train", items=len(df_train)):
+            full = train_model.train_model(df_train, train_model.params | {"max_depth": depth, "verbosity": 0}, max(rounds), threads)
+        for n in sorted(rounds):
+            booster = full[:n]
+            compiled = forest.compile_forest(json.loads(booster.save_raw(raw_format="json")))
+            median_ms, p95_ms = scoring_latency_ms(compiled, df_test)
+            result = {
+                "max_depth": depth,
+                "num_boost_round": n,
+                **ranking_metrics(booster.predict(X_test), df_test["label"].to_numpy(), df_test["orderID"].to_numpy(), ks),
+                "latency_ms": round(median_ms, 4),
+                "latency_p95_ms": round(p95_ms, 4),
+                "size_kb": round(model_size_kb(booster), 1),
+            }
+            results.append(result)
+            boosters[(depth, n)] = booster
+            print(f"depth {depth:>2}  rounds {n:>4}  " + "  ".join(f"{k}={v:.3f}" for k, v in result.items() if "@" in k)
+                  + f"  {median_ms:.3f} ms  {result['size_kb']:.0f} KB")
+    return results, boosters
+
+
+def pareto_frontier(results, metric):
+    # Fastest first; a variant joins the frontier only if it beats every faster one
+    frontier, best = [], -np.inf
+    for result in sorted(results, key=lambda r: (r["latency_ms"], -r[metric])):
+        if result[metric] > best:
+            frontier.append(result)
+            best = result[metric]
+    return frontier
+
+
+def choose(frontier, metric, min_quality):
+    meeting = [r for r in frontier if r[metric] >= min_quality]
+    return meeting[0] if meeting else None
+
+
+def print_frontier(frontier, metric):
+    print(f"\nPareto frontier (latency vs {metric}):")
+    for r in frontier:
+        print(f"  depth {r['max_depth']:>2}  rounds {r['num_boost_round']:>4}  {metric}={r[metric]:.3f}  "
+              f"{r['latency_ms']:.3f} ms (p95 {r['latency_p95_ms']:.3f})  {r['size_kb']:.0f} KB")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Sweep model depth and rounds and report the latency/quality Pareto frontier")
+    arg_parser.add_argument("--data", help="training data CSV (default: as train_model.py)")
+    arg_parser.add_argument("--depths", type=int, nargs="+", default=DEPTHS)
+    arg_parser.add_argument("--rounds", type=int, nargs="+", default=ROUNDS)
+    arg_parser.add_argument("--metric", default="ndcg@3", help="quality metric for the frontier, e.g. ndcg@3 or precision@1")
+    arg_parser.add_argument("--min-quality", type=float, help="pick the fastest frontier model with at least this metric value")
+    arg_parser.add_argument("--export", action="store_true", help="register the picked model as a new version (not made current)")
+    arg_parser.add_argument("--threads", type=int, help="XGBoost threads (default: all cores)")
+    arg_parser.add_argument("--output", default=REPORT_FILE)
+    args = arg_parser.parse_args(argv)
+
+    name, _, k = args.metric.partition("@")
+    if name not in ("ndcg", "precision") or not k.isdigit():
+        arg_parser.error(f"Unknown metric {args.metric}; use ndcg@k or precision@k")
+
+    training_data_file = args.data or train_model.get_training_data_file()
+    df_train, df_test = train_model.split_data(train_model.load_training_data(training_data_file))
+
+    results, boosters = sweep(df_train, df_test, args.depths, args.rounds, tuple(sorted(set(KS) | {int(k)})), args.threads)
+    frontier = pareto_frontier(results, args.metric)
+    print_frontier(frontier, args.metric)
+
+    chosen = choose(frontier, args.metric, args.min_quality) if args.min_quality is not None else None
+    if args.min_quality is not None:
+        if chosen is None:
+            print(f"\nNo model reaches {args.metric} >= {args.min_quality}")
+        else:
+            print(f"\nCheapest model with {args.metric} >= {args.min_quality}: depth {chosen['max_depth']}, {chosen['num_boost_round']} rounds")
+
+    with open(args.output, "w") as f:
+        json.dump({"metric": args.metric, "results": results, "frontier": frontier, "chosen": chosen}, f, indent=2)
+    print(f"Saved sizing report to {args.output}")
+
+    if args.export:
+        if chosen is None:
+            arg_parser.error("--export needs --min-quality and a model that meets it")
+        booster = boosters[(chosen["max_depth"], chosen["num_boost_round"])]
+        # Same names as train_model.py for precision, so registry listings line up
+        eval_metrics = {
+            (f"top{k.split('@')[1]}_precision" if k.startswith("precision@") else k.replace("@", "_at_")): v
+            for k, v in chosen.items() if "@" in k
+        }
+        params = train_model.params | {"max_depth": chosen["max_depth"], "num_boost_round": chosen["num_boost_round"]}
+        version = model_registry.register_model(booster, training_data_file, eval_metrics, params, activate=False)
+        print(f"Activate it with: python model_registry.py use {version}")
+    metrics.export("model_sizing")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import copy
+import hashlib
+import json
+import os
+
+from addresses import canonical_key
+
+# Compact typed records
+#
+# Cleaning turns each subject/comp/property dict into a PropertyRecord with a
+# fixed set of slots, so per-candidate memory is a few hundred bytes instead of
+# a dict that keeps every raw string next to its parsed value. The three
+# sources use different raw field names; they are mapped onto one schema here
+# (e.g. comp sale_date and property close_date both become sale_date). Raw
+# input is only kept when asked for.
+#
+# Each AppraisalRecord carries source_hash, a hash of its raw input. Stages
+# run with --incremental compare it against their existing output and only
+# reprocess orderIDs that are new or whose raw input changed.
+#
+# Listings in the properties pool recur across many appraisals. They are
+# cleaned once and stored once in a property table keyed by property_id
+# (normalized address plus close date and price); appraisals reference them
+# by ID, and every appraisal that shares a listing shares the same record.
+# Per-subject values such as distance are computed by the feature kernels,
+# never stored on a shared record.
+
+RECORD_FIELDS = (
+    "property_id", "address", "address_context",
+    "effective_date", "sale_date",
+    "subject_age", "effective_age", "age",
+    "gla", "lot_size_sf", "room_count", "num_beds",
+    "bath_score", "num_full_baths", "num_half_baths",
+    "sale_price", "distance_to_subject_km", "condition",
+    "raw_type", "property_type", "lat", "lon",
+    "raw",
+)
+
+# Cleaned record field -> raw field per source
+SOURCE_FIELDS = {
+    "subject": {
+        "address": "address", "effective_date": "effective_date", "subject_age": "subject_age",
+        "effective_age": "effective_age", "gla": "gla", "lot_size_sf": "lot_size_sf",
+        "room_count": "room_count", "num_beds": "num_beds", "bath_score": "bath_score",
+        "num_full_baths": "num_full_baths", "num_half_baths": "num_half_baths",
+        "condition": "condition", "raw_type": "structure_type",
+    },
+    "comps": {
+        "address": "address", "sale_date": "sale_date", "age": "age", "gla": "gla",
+        "lot_size_sf": "lot_size_sf", "room_count": "room_count", "num_beds": "num_beds",
+        "bath_score": "bath_score", "num_full_baths": "num_full_baths", "num_half_baths": "num_half_baths",
+        "sale_price": "sale_price", "distance_to_subject_km": "distance_to_subject_km",
+        "condition": "condition", "raw_type": "prop_type",
+    },
+    "properties": {
+        "address": "address", "sale_date": "close_date", "age": "age", "gla": "gla",
+        "lot_size_sf": "lot_size_sf", "room_count": "room_count", "num_beds": "num_beds",
+        "bath_score": "bath_score", "num_full_baths": "num_full_baths", "num_half_baths": "num_half_baths",
+        "sale_price": "sale_price", "raw_type": "property_sub_type",
+    },
+}
+
+# Location context used to disambiguate addresses when geocoding
+CONTEXT_FIELDS = {
+    "subject": ("subject_city_province_zip", "municipality_district"),
+    "comps": ("city_province",),
+    "properties": ("city", "province", "postal_code"),
+}
+
+
+class PropertyRecord:
+    __slots__ = RECORD_FIELDS
+
+    def __init__(self, **fields):
+        for name in RECORD_FIELDS:
+            setattr(self, name, fields.get(name))
+
+    # Mapping-style access keeps the registry kernels and enrichment code
+    # working on records and plain dicts alike
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in RECORD_FIELDS if getattr(self, name) is not None}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    @classmethod
+    def from_cleaned(cls, cleaned, source, raw=None):
+        record = cls(**{field: cleaned.get(raw_field) for field, raw_field in SOURCE_FIELDS[source].items()})
+        context = [cleaned.get(name) for name in CONTEXT_FIELDS[source]]
+        record.address_context = [str(part).strip() for part in context if part] or None
+        record.raw = raw
+        return record
+
+    def __repr__(self):
+        return f"PropertyRecord({self.to_dict()!r})"
+
+
+class AppraisalRecord:
+    __slots__ = ("order_id", "subject", "comps", "properties", "source_hash")
+
+    def __init__(self, order_id, subject, comps, properties, source_hash=None):
+        self.order_id = order_id
+        self.subject = subject
+        self.comps = comps
+        self.properties = properties
+        self.source_hash = source_hash
+
+    def to_dict(self):
+        return {
+            "orderID": self.order_id,
+            "source_hash": self.source_hash,
+            "subject": self.subject.to_dict(),
+            "comps": [c.to_dict() for c in self.comps],
+            "property_ids": [p.property_id for p in self.properties],
+        }
+
+    @classmethod
+    def from_dict(cls, data, table=None):
+        if "property_ids" in data:
+            properties = [table[pid] for pid in data["property_ids"]]
+        else:
+            properties = [PropertyRecord.from_dict(p) for p in data.get("properties", [])]
+        return cls(
+            str(data.get("orderID", "UNKNOWN")),
+            PropertyRecord.from_dict(data["subject"]),
+            [PropertyRecord.from_dict(c) for c in data.get("comps", [])],
+            properties,
+            data.get("source_hash"),
+        )
+
+    @classmethod
+    def from_cleaned(cls, appraisal, raw=None, source_hash=None):
+        convert = PropertyRecord.from_cleaned
+        raw = raw or {}
+        raw_comps = raw.get("comps") or [None] * len(appraisal.get("comps", []))
+        raw_props = raw.get("properties") or [None] * len(appraisal.get("properties", []))
+        return cls(
+            str(appraisal.get("orderID", "UNKNOWN")),
+            convert(appraisal["subject"], "subject", raw.get("subject")),
+            [convert(c, "comps", r) for c, r in zip(appraisal.get("comps", []), raw_comps)],
+            [convert(p, "properties", r) for p, r in zip(appraisal.get("properties", []), raw_props)],
+            source_hash,
+        )
+
+
+def snapshot_raw(appraisal):
+    return copy.deepcopy({k: appraisal.get(k) for k in ("subject", "comps", "properties")})
+
+
+def property_id(prop):
+    # Listing identity of a raw properties-pool entry. Uses the rule-based key
+    # only, so IDs do not change when address_aliases.json is edited
+    address = canonical_key(prop.get("address") or "") or ""
+    key = f"{address}|{prop.get('close_date') or ''}|{prop.get('close_price') or ''}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def content_hash(appraisal):
+    payload = json.dumps(appraisal, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def load_existing(path, incremental):
+    # orderID -> record of an existing artifact, empty for a full run
+    if not incremental or not os.path.exists(path):
+        return {}
+    return {a.order_id: a for a in load_appraisals(path)}
+
+
+def is_unchanged(existing, order_id, source_hash):
+    record = existing.get(order_id)
+    return record is not None and source_hash is not None and record.source_hash == source_hash
+
+
+def merge_appraisals(existing, updates):
+    # Reprocessed orderIDs replace their old record in place, new ones are appended
+    updates = {a.order_id: a for a in updates}
+    merged = [updates.pop(order_id, record) for order_id, record in existing.items()]
+    return merged + list(updates.values())
+
+
+def save_appraisals(path, appraisals):
+    # Only listings still referenced by an appraisal are written
+    table = {}
+    for appraisal in appraisals:
+        for prop in appraisal.properties:
+            table.setdefault(prop.property_id, prop)
+    with open(path, "w") as f:
+        json.dump({
+            # The table key is the property_id, so it is not repeated in the entry
+            "properties": {pid: {k: v for k, v in prop.to_dict().items() if k != "property_id"} for pid, prop in table.items()},
+            "appraisals": [a.to_dict() for a in appraisals],
+        }, f, separators=(",", ":"))
+
+
+def load_appraisals(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    table = {pid: PropertyRecord.from_dict(dict(p, property_id=pid)) for pid, p in data.get("properties", {}).items()}
+    return [AppraisalRecord.from_dict(a, table) for a in data["appraisals"]]
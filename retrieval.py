@@ -0,0 +1,273 @@
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+from dateutil import parser
+
+import metrics
+from addresses import address_key
+from features import CANONICAL_TYPES
+from records import PropertyRecord, load_appraisals
+
+# Config
+INPUT_FILE = "feature_engineered_appraisals_dataset.json"
+INDEX_FILE = "comp_index.npz"
+TOP_N = 50
+NPROBE = 8
+# Extra neighbours fetched per query so filtering still leaves TOP_N
+OVERSAMPLE = 2
+
+# Embedded attributes. Numbers are standardized over the pool (log first
+# where the distribution is skewed) and a missing value sits at the pool
+# mean. Subjects carry age as subject_age or effective_age.
+EMBED_FIELDS = [
+    {"field": "gla", "log": True, "weight": 1.0},
+    {"field": "lot_size_sf", "log": True, "weight": 0.5},
+    {"field": "age", "subject": ("subject_age", "effective_age"), "weight": 0.5},
+    {"field": "num_beds", "weight": 0.5},
+    {"field": "bath_score", "weight": 0.5},
+    {"field": "room_count", "weight": 0.25},
+]
+TYPE_WEIGHT = 1.5
+# Location is embedded as planar km, so this many km count as one unit
+LOCATION_SCALE_KM = 2.0
+KM_PER_DEGREE = 111.32
+
+# Comp retrieval index
+#
+# Every sold listing in the history (pool properties and comps, one entry per
+# address, sale date and price) is embedded by the attributes the ranker
+# compares: size, lot, age, rooms, property type and location. The vectors are
+# grouped into k-means cells offline (an inverted-file index); a query only
+# scans the nprobe cells nearest the subject, so retrieval stays in the
+# milliseconds however large the archive grows. Retrieved listings are
+# filtered (no sales after the subject's effective date, not the subject
+# itself) and join the appraisal's own pool before ranking.
+
+
+def _number(val):
+    if isinstance(val, bool) or not isinstance(val, (int, float, np.integer, np.floating)):
+        return math.nan
+    return float(val)
+
+
+def _has_location(record):
+    return not math.isnan(_number(record.get("lat"))) and not math.isnan(_number(record.get("lon")))
+
+
+def _timestamp(val):
+    if not val or not isinstance(val, str):
+        return math.nan
+    try:
+        return parser.parse(val).replace(tzinfo=None).timestamp()
+    except (ValueError, OverflowError):
+        return math.nan
+
+
+def _raw_columns(records, subject=False):
+    columns = []
+    for spec in EMBED_FIELDS:
+        fields = spec.get("subject", (spec["field"],)) if subject else (spec["field"],)
+        values = []
+        for record in records:
+            val = math.nan
+            for field in fields:
+                val = _number(record.get(field))
+                if not math.isnan(val):
+                    break
+            if spec.get("log") and not math.isnan(val):
+                val = math.log1p(max(val, 0.0))
+            values.append(val)
+        columns.append(values)
+    return np.asarray(columns, dtype=float).T.reshape(len(records), len(EMBED_FIELDS))
+
+
+def embed(records, params, subject=False):
+    raw = _raw_columns(records, subject)
+    numbers = np.nan_to_num((raw - params["mean"]) / params["std"]) * params["weights"]
+
+    types = np.zeros((len(records), len(CANONICAL_TYPES)))
+    for i, record in enumerate(records):
+        if record.get("property_type") in CANONICAL_TYPES:
+            types[i, CANONICAL_TYPES.index(record.get("property_type"))] = TYPE_WEIGHT
+
+    lat = np.asarray([_number(r.get("lat")) for r in records], dtype=float)
+    lon = np.asarray([_number(r.get("lon")) for r in records], dtype=float)
+    location = np.column_stack([
+        (lat - params["origin"][0]) * KM_PER_DEGREE,
+        (lon - params["origin"][1]) * KM_PER_DEGREE * math.cos(math.radians(params["origin"][0])),
+    ]) / LOCATION_SCALE_KM
+    return np.hstack([numbers, types, np.nan_to_num(location)]).astype(np.float32)
+
+
+def collect_pool(appraisals):
+    # One entry per listing; comps carry a distance to their own subject,
+    # which must not leak to the next one
+    pool, seen = [], set()
+    for appraisal in appraisals:
+        for prop in list(appraisal.comps) + list(appraisal.properties):
+            key = (address_key(prop.address or ""), prop.sale_date, prop.sale_price)
+            if not key[0] or key in seen:
+                continue
+            seen.add(key)
+            if prop.get("lat") is None or prop.get("lon") is None or prop.get("sale_price") is None:
+                metrics.incr("retrieval_pool_total", result="skipped")
+                continue
+            metrics.incr("retrieval_pool_total", result="indexed")
+            pool.append(PropertyRecord.from_dict(dict(prop.to_dict(), distance_to_subject_km=None, raw=None)))
+    return pool
+
+
+def _kmeans(vectors, n_cells):
+    from sklearn.cluster import MiniBatchKMeans
+
+    kmeans = MiniBatchKMeans(n_clusters=n_cells, random_state=0, n_init=3, batch_size=4096)
+    return kmeans.fit_predict(vectors), kmeans.cluster_centers_.astype(np.float32)
+
+
+def build_index(appraisals, n_cells=None):
+    pool = collect_pool(appraisals)
+    if not pool:
+        raise ValueError("No geocoded sold listings to index")
+
+    raw = _raw_columns(pool)
+    with np.errstate(invalid="ignore"):
+        std = np.nanstd(raw, axis=0)
+    lat = np.asarray([r.lat for r in pool], dtype=float)
+    lon = np.asarray([r.lon for r in pool], dtype=float)
+    params = {
+        "mean": np.nan_to_num(np.nanmean(raw, axis=0)),
+        "std": np.where(np.nan_to_num(std) > 0, np.nan_to_num(std), 1.0),
+        "weights": np.asarray([spec["weight"] for spec in EMBED_FIELDS], dtype=float),
+        "origin": np.asarray([np.median(lat), np.median(lon)]),
+    }
+    vectors = embed(pool, params)
+
+    n_cells = n_cells or max(1, min(len(pool), int(4 * math.sqrt(len(pool)))))
+    cells, centroids = _kmeans(vectors, n_cells) if n_cells > 1 else (np.zeros(len(pool), dtype=np.int64), vectors.mean(axis=0, keepdims=True))
+
+    # Rows sorted by cell, so each cell is one contiguous slice
+    order = np.argsort(cells, kind="stable")
+    offsets = np.searchsorted(cells[order], np.arange(len(centroids) + 1))
+    return {
+        **params,
+        "centroids": centroids,
+        "offsets": offsets,
+        "vectors": vectors[order],
+        "sale_ts": np.asarray([_timestamp(pool[i].sale_date) for i in order], dtype=float),
+        "records": [pool[i] for i in order],
+    }
+
+
+def save_index(index, output_file=INDEX_FILE):
+    np.savez(
+        output_file,
+        **{k: v for k, v in index.items() if k != "records"},
+        records=np.asarray(json.dumps([r.to_dict() for r in index["records"]])),
+    )
+    print(f"Saved comp index ({len(index['records'])} listings, {len(index['centroids'])} cells) to {output_file}")
+
+
+def load_index(path=INDEX_FILE):
+    with np.load(path) as data:
+        index = {k: data[k] for k in data.files if k != "records"}
+        index["records"] = [PropertyRecord.from_dict(r) for r in json.loads(str(data["records"]))]
+    return index
+
+
+def search(index, queries, n=TOP_N, nprobe=NPROBE):
+    # Row ids and squared distances of the n nearest listings per query,
+    # scanning only the nprobe nearest cells
+    centroids, offsets, vectors = index["centroids"], index["offsets"], index["vectors"]
+    nprobe = min(nprobe, len(centroids))
+    cell_dist = ((queries[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+    probes = np.argpartition(cell_dist, nprobe - 1, axis=1)[:, :nprobe]
+
+    results = []
+    for query, cells in zip(queries, probes):
+        rows = np.concatenate([np.arange(offsets[c], offsets[c + 1]) for c in cells])
+        dist = ((vectors[rows] - query) ** 2).sum(axis=1)
+        top = np.argpartition(dist, n - 1)[:n] if len(rows) > n else np.arange(len(rows))
+        top = top[np.argsort(dist[top], kind="stable")]
+        results.append((rows[top], dist[top]))
+    return results
+
+
+def retrieve(index, subjects, n=TOP_N, nprobe=NPROBE):
+    # Listings per subject, ready to join its candidate pool. A subject
+    # without coordinates would embed at the origin and get arbitrary
+    # neighbours, so it gets none
+    has_location = [_has_location(s) for s in subjects]
+    located = [s for s, ok in zip(subjects, has_location) if ok]
+    metrics.incr("retrieval_queries_total", len(subjects) - len(located), result="no_location")
+    results = iter(search(index, embed(located, index, subject=True), n * OVERSAMPLE, nprobe) if located else [])
+
+    found = []
+    for subject, ok in zip(subjects, has_location):
+        if not ok:
+            found.append([])
+            continue
+        rows, _ = next(results)
+        effective = _timestamp(subject.get("effective_date"))
+        subject_address = address_key(subject.get("address") or "")
+        keep = []
+        for row in rows:
+            if not math.isnan(effective) and index["sale_ts"][row] > effective:
+                continue
+            record = index["records"][row]
+            if address_key(record.address or "") == subject_address:
+                continue
+            keep.append(record)
+            if len(keep) == n:
+                break
+        found.append(keep)
+    metrics.incr("retrieval_queries_total", len(located), result="searched")
+    return found
+
+
+def benchmark(index, appraisals, n=TOP_N, nprobe=NPROBE):
+    subjects = [a.subject for a in appraisals if _has_location(a.subject)]
+    queries = embed(subjects, index, subject=True)
+
+    start = time.perf_counter()
+    approx = search(index, queries, n, nprobe)
+    approx_ms = (time.perf_counter() - start) * 1000 / max(len(subjects), 1)
+
+    start = time.perf_counter()
+    exact = []
+    for query in queries:
+        dist = ((index["vectors"] - query) ** 2).sum(axis=1)
+        exact.append(set(np.argsort(dist, kind="stable")[:n]))
+    exact_ms = (time.perf_counter() - start) * 1000 / max(len(subjects), 1)
+
+    overlap = [len(set(rows) & truth) / max(len(truth), 1) for (rows, _), truth in zip(approx, exact)]
+    print(f"Subjects: {len(subjects)}  listings: {len(index['records'])}  cells: {len(index['centroids'])}  nprobe: {nprobe}")
+    print(f"Recall@{n} vs exact search: {np.mean(overlap):.3f}")
+    print(f"Per query: {approx_ms:.2f} ms approximate, {exact_ms:.2f} ms exact")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Build the approximate nearest-neighbour index over every sold listing in the history")
+    arg_parser.add_argument("--input", default=INPUT_FILE)
+    arg_parser.add_argument("--output", default=INDEX_FILE)
+    arg_parser.add_argument("--cells", type=int, help="k-means cells (default: 4 * sqrt(listings))")
+    arg_parser.add_argument("--benchmark", action="store_true", help="compare recall and latency against exact search")
+    arg_parser.add_argument("-n", type=int, default=TOP_N)
+    arg_parser.add_argument("--nprobe", type=int, default=NPROBE)
+    args = arg_parser.parse_args(argv)
+
+    appraisals = load_appraisals(args.input)
+    with metrics.stage("retrieval_index") as stage:
+        index = build_index(appraisals, args.cells)
+        stage["items"] = len(index["records"])
+    save_index(index, args.output)
+
+    if args.benchmark:
+        benchmark(index, appraisals, args.n, args.nprobe)
+    metrics.export("retrieval")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import cascade as cascade_pruning
+import feature_stats
+import features
+import forest
+import metrics
+import model_registry
+import retrieval
+import training_data
+from clean_initial_data import clean_appraisal
+from feature_registry import FEATURE_COLS
+from records import AppraisalRecord, content_hash
+
+# Config
+DATA_FILE = "training_data.csv"
+OUTPUT_FILE = "top_k_scores.jsonl"
+TOP_K = 3
+
+# Output columns kept for each ranked candidate
+CANDIDATE_COLUMNS = ["candidate_address", "score", "rank", "is_comp"]
+
+# Appraisals per task in batch inference
+CHUNK_SIZE = 64
+
+
+# Scores with the compiled forest, so ranking needs neither xgboost nor a DMatrix
+def load_scoring_model(model_file=None):
+    with open(model_file or model_registry.model_path(), "r") as f:
+        return forest.compile_forest(json.load(f))
+
+
+# A fixed --model file, or the registry's current version through a
+# ModelHandle, so a long batch picks up set_current/rollback between chunks.
+# Returns a callable giving (model, version label) for the next chunk.
+def model_source(model_file=None):
+    if model_file:
+        model = load_scoring_model(model_file)
+        return lambda: (model, model_file)
+    handle = model_registry.ModelHandle(loader=load_scoring_model)
+    return lambda: (handle.get(), handle.version)
+
+
+def rank_candidates(df, model, k=TOP_K):
+    X = df[model["feature_names"] or FEATURE_COLS].to_numpy(dtype=float)
+    df = df.assign(score=forest.predict_forest(model, X).astype(float))
+    df = df.sort_values(["orderID", "score"], ascending=[True, False], kind="stable")
+    df["rank"] = df.groupby("orderID").cumcount() + 1
+    return df[df["rank"] <= k]
+
+
+def _json_value(val):
+    if isinstance(val, (np.integer, np.floating)):
+        val = val.item()
+    if isinstance(val, float) and np.isnan(val):
+        return None
+    return val
+
+
+def write_top_k(ranked, output_file=OUTPUT_FILE, columns=CANDIDATE_COLUMNS):
+    columns = [c for c in columns if c in ranked.columns]
+    with open(output_file, "w") as f:
+        for order_id, group in ranked.groupby("orderID", sort=False):
+            record = {
+                "orderID": _json_value(order_id),
+                "subject_address": group["subject_address"].iloc[0] if "subject_address" in group else None,
+                "top_k": [{c: _json_value(row[c]) for c in columns} for _, row in group.iterrows()],
+            }
+            f.write(json.dumps(record) + "\n")
+    print(f"Saved top-{int(ranked['rank'].max()) if len(ranked) else 0} candidates for {ranked['orderID'].nunique()} orders to {output_file}")
+
+
+# Inference for new appraisals
+#
+# Raw appraisals in the appraisals_dataset.json shape go through the same
+# cleaning, geocode-cache lookup and feature code as the training pipeline,
+# entirely in memory, and each chunk is featurized and scored in one batch.
+# With a retrieval index, each subject's nearest historical listings join its
+# own pool before ranking.
+
+def prepare_appraisal(raw):
+    source_hash = content_hash(raw)
+    record = AppraisalRecord.from_cleaned(clean_appraisal(raw), source_hash=source_hash)
+    features.add_property_types(record)
+    features.add_geocoded_addresses(record)
+    features.get_distance_to_subject(record)
+    return record
+
+
+def rank_appraisals(raw_appraisals, model, k=TOP_K, index=None, retrieve=0, stats=None, cascade=None):
+    records = [prepare_appraisal(raw) for raw in raw_appraisals]
+    retrieved = set()
+    if index is not None and retrieve:
+        found = retrieval.retrieve(index, [r.subject for r in records], retrieve)
+        for record, extra in zip(records, found):
+            record.properties = record.properties + extra
+            retrieved.update(id(p) for p in extra)
+
+    table = training_data.collect_candidates(records)
+    # Drift stats describe every candidate, like the training snapshot, so
+    # with stats on the full features are computed before any pruning
+    feats = training_data.featurize(table) if stats is not None or cascade is None else None
+    if stats is not None and table["candidates"]:
+        stats.update(feats)
+    # Optional cascade (cascade.py): cheap rules drop candidates before the full features
+    if cascade is not None:
+        keep = cascade_pruning.cascade_keep(table, cascade)
+        table = training_data.select_candidates(table, keep)
+        feats = training_data.featurize(table) if feats is None else {name: np.asarray(values)[keep] for name, values in feats.items()}
+    X = np.column_stack([feats[c] for c in model["feature_names"] or FEATURE_COLS]) if table["candidates"] else np.empty((0, 0))
+    scores = forest.predict_forest(model, X) if len(X) else np.empty(0, dtype=np.float32)
+
+    # collect_candidates emits each subject's candidates as one contiguous run
+    subject_index = np.asarray(table["subject_index"], dtype=np.int64)
+    bounds = np.searchsorted(subject_index, np.arange(len(records) + 1))
+
+    results = []
+    for i, record in enumerate(records):
+        rows = np.arange(bounds[i], bounds[i + 1])
+        order = rows[np.argsort(-scores[rows], kind="stable")][:k]
+        results.append({
+            "orderID": record.order_id,
+            "subject_address": record.subject.address,
+            "top_k": [
+                {
+                    "candidate_address": table["meta"]["candidate_address"][j],
+                    "group": table["groups"][j],
+                    "score": float(scores[j]),
+                    "rank": rank,
+                    "sale_price": table["candidates"][j].sale_price,
+                    "retrieved": id(table["candidates"][j]) in retrieved,
+                }
+                for rank, j in enumerate(order, start=1)
+            ],
+        })
+    return results
+
+
+def rank_appraisal(raw, model, k=TOP_K, index=None, retrieve=0, cascade=None):
+    return rank_appraisals([raw], model, k, index, retrieve, cascade=cascade)[0]
+
+
+def iter_appraisals(paths):
+    # .jsonl inputs (one appraisal per line) stream; .json inputs are loaded whole
+    for path in paths:
+        with open(path, "r") as f:
+            if path.endswith(".jsonl"):
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            else:
+                yield from json.load(f)["appraisals"]
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Each worker compiles the model and loads the geocode cache and retrieval
+# index once; the model is re-checked against the registry per chunk
+_worker = {}
+
+def _init_worker(model_file, index_file):
+    _worker["model"] = model_source(model_file)
+    _worker["index"] = retrieval.load_index(index_file) if index_file else None
+    features.get_address_data()
+
+
+# Feature stats are collected per chunk and merged by the parent
+def _rank_chunk(chunk, k, retrieve, cascade):
+    stats = feature_stats.FeatureStats()
+    model, version = _worker["model"]()
+    return _with_version(rank_appraisals(chunk, model, k, _worker["index"], retrieve, stats, cascade), version), stats
+
+
+def _with_version(results, version):
+    for result in results:
+        result["model_version"] = version
+    return results
+
+
+def iter_rankings(raw_appraisals, model_file=None, k=TOP_K, workers=1, chunk_size=CHUNK_SIZE, index_file=None, retrieve=0, stats=None,
+                  cascade=None):
+    index_file = index_file if retrieve else None
+    chunks = chunked(raw_appraisals, chunk_size)
+
+    if workers <= 1:
+        get_model = model_source(model_file)
+        index = retrieval.load_index(index_file) if index_file else None
+        for chunk in chunks:
+            model, version = get_model()
+            yield from _with_version(rank_appraisals(chunk, model, k, index, retrieve, stats, cascade), version)
+        return
+
+    # At most two chunks per worker in flight, so memory stays flat however
+    # long the input is; results come back in input order
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(model_file, index_file)) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_rank_chunk, chunk, k, retrieve, cascade))
+            if len(pending) >= workers * 2:
+                yield from _collect(pending.popleft(), stats)
+        while pending:
+            yield from _collect(pending.popleft(), stats)
+
+
+def _collect(future, stats):
+    results, chunk_stats = future.result()
+    if stats is not None:
+        stats.merge(chunk_stats)
+    return results
+
+
+def rank_files(paths, output_file=OUTPUT_FILE, model_file=None, k=TOP_K, workers=1, chunk_size=CHUNK_SIZE, index_file=None, retrieve=0,
+               stats_file=feature_stats.SCORING_FILE, cascade=None):
+    count = 0
+    stats = feature_stats.FeatureStats() if stats_file else None
+    with metrics.stage("inference") as stage, open(output_file, "w") as f:
+        for result in iter_rankings(iter_appraisals(paths), model_file, k, workers, chunk_size, index_file, retrieve, stats, cascade):
+            f.write(json.dumps(result) + "\n")
+            count += 1
+        stage["items"] = count
+    print(f"Saved top-{k} candidates for {count} appraisals to {output_file}")
+    if stats is not None:
+        save_feature_stats(stats, stats_file)
+    return count
+
+
+def save_feature_stats(stats, stats_file):
+    feature_stats.save_stats(stats, stats_file)
+    print(f"Saved feature stats to {stats_file}")
+    feature_stats.check_drift(stats)
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Rank candidates with the current model and write the top-k per order as JSONL")
+    arg_parser.add_argument("--data", default=DATA_FILE, help="candidate rows with feature columns")
+    arg_parser.add_argument("--appraisals", nargs="+", help="raw appraisal files (.json or .jsonl) to run end to end instead of --data")
+    arg_parser.add_argument("--model", help="model file (default: current registry version)")
+    arg_parser.add_argument("-k", type=int, default=TOP_K)
+    arg_parser.add_argument("--workers", type=int, default=1, help="processes for --appraisals (0 = one per CPU)")
+    arg_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    arg_parser.add_argument("--retrieve", type=int, default=0, metavar="N", help="add the N nearest historical listings from the comp index to each pool")
+    arg_parser.add_argument("--index", default=retrieval.INDEX_FILE, help="comp index built by retrieval.py")
+    arg_parser.add_argument("--output", default=OUTPUT_FILE)
+    arg_parser.add_argument("--stats", default=feature_stats.SCORING_FILE, help="where to write feature stats for the drift check")
+    arg_parser.add_argument("--no-stats", dest="stats", action="store_const", const=None, help="skip feature stats and the drift check")
+    arg_parser.add_argument("--cascade", action="store_true", help="prune candidates with the cascade rules before featurizing (--appraisals)")
+    arg_parser.add_argument("--cascade-stage1", action="store_true", help="also keep only the first-stage model's best candidates")
+    args = arg_parser.parse_args(argv)
+    if (args.cascade or args.cascade_stage1) and not args.appraisals:
+        arg_parser.error("--cascade applies to --appraisals; rows in --data are already featurized")
+    cascade = cascade_pruning.cascade_config(args.cascade_stage1) if args.cascade or args.cascade_stage1 else None
+
+    if args.appraisals:
+        rank_files(args.appraisals, args.output, args.model, args.k, args.workers or os.cpu_count(), args.chunk_size, args.index, args.retrieve, args.stats, cascade)
+    else:
+        model = load_scoring_model(args.model)
+        df = pd.read_csv(args.data)
+        with metrics.stage("score", items=len(df)):
+            ranked = rank_candidates(df, model, args.k)
+        write_top_k(ranked, args.output)
+        if args.stats:
+            save_feature_stats(feature_stats.FeatureStats().update(df), args.stats)
+    metrics.export("score")
+
+
+if __name__ == "__main__":
+    main()
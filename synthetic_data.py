@@ -0,0 +1,216 @@
+import argparse
+import json
+import random
+from datetime import date, timedelta
+
+# Config
+OUTPUT_FILE = "synthetic_appraisals_dataset.json"
+GEOCODE_OUTPUT_FILE = "synthetic_geocoded_addresses.json"
+
+STREETS = [
+    "Oakview", "Amberdale", "Ashwood", "Conservatory", "Janette", "Bath", "High Gate Park",
+    "Isle of Man", "Hitchcock", "John F. Scott", "Broadway", "Princess", "Division", "Sydenham",
+]
+SUFFIXES = [("Ave", "Avenue"), ("Cres", "Crescent"), ("Dr", "Drive"), ("St", "Street"), ("Rd", "Road")]
+CITIES = [
+    ("Kingston", "ON", "K7M"), ("Ottawa", "ON", "K2P"), ("Calgary", "AB", "T2N"),
+    ("Halifax", "NS", "B3H"), ("Regina", "SK", "S4P"),
+]
+CITY_CENTRES = {
+    "Kingston": (44.2312, -76.4860), "Ottawa": (45.4215, -75.6972), "Calgary": (51.0447, -114.0719),
+    "Halifax": (44.6488, -63.5752), "Regina": (50.4452, -104.6189),
+}
+STRUCTURE_TYPES = [
+    "Detached", "Townhouse", "Semi-Detached", "Condominium", "Duplex", "Row unit 2 storey",
+    "Single Family Residence", "Condo Apt", "Link", "Triplex", "Detachd", "",
+]
+CONDITIONS = ["Average", "Good", "Superior", "Fair"]
+
+
+def _postal(rng, prefix):
+    return f"{prefix} {rng.randint(1, 9)}{rng.choice('ABCEGHJKLMNPRSTVXY')}{rng.randint(1, 9)}"
+
+
+def _street_address(rng):
+    suffix_short, suffix_long = rng.choice(SUFFIXES)
+    suffix = suffix_short if rng.random() < 0.7 else suffix_long
+    street = f"{rng.randint(1, 4999)} {rng.choice(STREETS)} {suffix}"
+    if rng.random() < 0.15:
+        street = f"{rng.randint(100, 999)}-{street}" if rng.random() < 0.5 else f"Unit {rng.randint(1, 999)} - {street}"
+    return street
+
+
+def _gla(rng, sqft):
+    if rng.random() < 0.1:
+        return f"{round(sqft / 10.7639)} sqm"
+    return rng.choice([f"{sqft:,} SqFt", str(sqft), f"{sqft} sf"])
+
+
+def _lot_size(rng, sqft):
+    r = rng.random()
+    if r < 0.1:
+        return rng.choice(["n/a", "Condo Common Property", ""])
+    if r < 0.2:
+        return f"{sqft / 43560:.2f} Acres"
+    if r < 0.3:
+        return f"{rng.randint(30, 80)}' x {rng.randint(90, 150)}' / {sqft:,} sf"
+    return rng.choice([f"{sqft:,} SqFt", f"{sqft} sf", f"{round(sqft / 10.7639)} sqm", f"{sqft} +/-"])
+
+
+def _age(rng, effective, years):
+    r = rng.random()
+    if r < 0.05:
+        return "New"
+    if r < 0.5:
+        return str(effective.year - years)
+    return rng.choice([str(years), f"{years} +/-", f"{years} yrs"])
+
+
+def _baths(rng, full, half):
+    return rng.choice([f"{full}:{half}", f"{full}F {half}H" if half else f"{full}F", f"{full}:{half}"])
+
+
+def _rooms(rng, rooms):
+    return f"{rooms - 1}+1" if rng.random() < 0.1 else str(rooms)
+
+
+def _house(rng):
+    gla = rng.randint(700, 3500)
+    return {
+        "gla": gla,
+        "lot": rng.randint(1500, 40000),
+        "years": rng.randint(0, 90),
+        "beds": rng.randint(1, 5),
+        "rooms": rng.randint(4, 11),
+        "full": rng.randint(1, 4),
+        "half": rng.randint(0, 2),
+        "type": rng.choice(STRUCTURE_TYPES),
+        "price": rng.randint(150, 1800) * 1000,
+    }
+
+
+def _jitter(rng, house):
+    out = dict(house)
+    out["gla"] = max(400, house["gla"] + rng.randint(-300, 300))
+    out["lot"] = max(500, house["lot"] + rng.randint(-2000, 2000))
+    out["years"] = max(0, house["years"] + rng.randint(-10, 10))
+    out["beds"] = max(1, house["beds"] + rng.randint(-1, 1))
+    out["price"] = max(50000, house["price"] + rng.randint(-80, 80) * 1000)
+    return out
+
+
+def _coords(rng, city):
+    lat, lon = CITY_CENTRES[city]
+    return round(lat + rng.uniform(-0.08, 0.08), 7), round(lon + rng.uniform(-0.08, 0.08), 7)
+
+
+# reuse: share of pool properties drawn from listings already used by other
+# appraisals in the same city, the way active listings recur in real data
+def make_appraisal(rng, order_id, num_candidates, num_comps=3, geocoded=None, reuse=0.0, listings=None):
+    city, province, prefix = rng.choice(CITIES)
+    postal = _postal(rng, prefix)
+    effective = date(2024, 1, 1) + timedelta(days=rng.randint(0, 540))
+    house = _house(rng)
+    street = _street_address(rng)
+
+    subject = {
+        "address": f"{street} {city} {province} {postal}",
+        "subject_city_province_zip": f"{city} {province} {postal}",
+        "municipality_district": city,
+        "effective_date": effective.strftime("%b/%d/%Y"),
+        "subject_age": _age(rng, effective, house["years"]),
+        "effective_age": str(max(0, house["years"] - rng.randint(0, 10))),
+        "gla": _gla(rng, house["gla"]),
+        "lot_size_sf": _lot_size(rng, house["lot"]),
+        "room_count": _rooms(rng, house["rooms"]),
+        "num_beds": str(house["beds"]) if rng.random() > 0.1 else f"{house['beds']}+1",
+        "num_baths": _baths(rng, house["full"], house["half"]),
+        "structure_type": house["type"],
+        "condition": rng.choice(CONDITIONS),
+    }
+
+    properties = []
+    city_listings = listings.setdefault(city, []) if listings is not None else []
+    for _ in range(num_candidates):
+        if reuse and city_listings and rng.random() < reuse:
+            properties.append(dict(rng.choice(city_listings)))
+            continue
+        cand = _jitter(rng, house) if rng.random() < 0.2 else _house(rng)
+        sold = effective - timedelta(days=rng.randint(-30, 900))
+        properties.append({
+            "address": _street_address(rng),
+            "city": city,
+            "province": province,
+            "postal_code": _postal(rng, prefix),
+            "close_date": sold.isoformat(),
+            "year_built": str(sold.year - cand["years"]),
+            "gla": str(cand["gla"]) if rng.random() > 0.05 else None,
+            "lot_size_sf": _lot_size(rng, cand["lot"]),
+            "room_count": str(cand["rooms"]),
+            "bedrooms": str(cand["beds"]),
+            "full_baths": str(cand["full"]),
+            "half_baths": str(cand["half"]) if rng.random() > 0.2 else None,
+            "close_price": str(cand["price"]),
+            "property_sub_type": cand["type"] if rng.random() > 0.3 else cand["type"].lower(),
+        })
+        if reuse:
+            city_listings.append(properties[-1])
+
+    comps = []
+    for prop in rng.sample(properties, min(num_comps, len(properties))):
+        cand = _jitter(rng, house)
+        comps.append({
+            "address": prop["address"],
+            "city_province": f"{city} {province} {prop['postal_code']}",
+            "sale_date": date.fromisoformat(prop["close_date"]).strftime("%b/%d/%Y"),
+            "age": _age(rng, effective, cand["years"]),
+            "gla": _gla(rng, cand["gla"]),
+            "lot_size": _lot_size(rng, cand["lot"]),
+            "room_count": _rooms(rng, cand["rooms"]),
+            "bed_count": str(cand["beds"]),
+            "bath_count": _baths(rng, cand["full"], cand["half"]),
+            "condition": rng.choice(CONDITIONS),
+            "distance_to_subject": f"{rng.uniform(0.01, 5):.2f} KM" if rng.random() > 0.1 else None,
+            "sale_price": f"{cand['price']:,}",
+            "prop_type": house["type"],
+        })
+
+    if geocoded is not None:
+        for addr in [subject["address"]] + [p["address"] for p in properties]:
+            if rng.random() > 0.02:
+                lat, lon = _coords(rng, city)
+                geocoded[addr.lower()] = {"lat": lat, "lon": lon}
+
+    return {"orderID": str(order_id), "subject": subject, "comps": comps, "properties": properties}
+
+
+def generate(num_appraisals, num_candidates, seed=0, geocoded=None, reuse=0.0):
+    rng = random.Random(seed)
+    listings = {}
+    return {
+        "appraisals": [
+            make_appraisal(rng, 4000000 + i, num_candidates, geocoded=geocoded, reuse=reuse, listings=listings)
+            for i in range(num_appraisals)
+        ]
+    }
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Generate a synthetic appraisals dataset")
+    arg_parser.add_argument("--appraisals", type=int, default=100)
+    arg_parser.add_argument("--candidates", type=int, default=50, help="candidate properties per appraisal")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--reuse", type=float, default=0.0, help="share of pool properties reused from earlier appraisals")
+    arg_parser.add_argument("--output", default=OUTPUT_FILE)
+    arg_parser.add_argument("--geocode-output", default=GEOCODE_OUTPUT_FILE)
+    args = arg_parser.parse_args()
+
+    geocoded = {}
+    data = generate(args.appraisals, args.candidates, args.seed, geocoded, args.reuse)
+
+    with open(args.output, "w") as f:
+        json.dump(data, f)
+    with open(args.geocode_output, "w") as f:
+        json.dump(geocoded, f)
+
+    print(f"Saved {args.appraisals} synthetic appraisals to {args.output}")
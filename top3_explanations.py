@@ -1,208 +1,600 @@
-import shap
-import xgboost as xgb
+import argparse
+import json
 import pandas as pd
 import numpy as np
-from openai import OpenAI
 import os
 from tqdm import tqdm
-import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
+from addresses import address_key
+import cascade as cascade_pruning
+from feature_registry import FEATURE_COLS
+import metrics
+import model_registry
+from records import load_appraisals
+
+# Config
+RAW_DATA_FILE = "feature_engineered_appraisals_dataset.json"
+OUTPUT_FILE = "top3_gpt_explanations.csv"
+CHECKPOINT_FILE = "top3_explanations_checkpoint.jsonl"
+LLM_MODEL = "gpt-3.5-turbo"
+# SHAP items per side named in a template explanation
+TEMPLATE_FACTORS = 2
+
+# Feature columns (declared in feature_registry.py)
+feature_cols = FEATURE_COLS
+
+client = None
 
 # Load API Key
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY is not set.")
-client = OpenAI(api_key=api_key)
+def get_client():
+    global client
+    if client is None:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("OPENAI_API_KEY is not set.")
+        from openai import OpenAI
+        client = OpenAI(api_key=api_key)
+    return client
 
 # Load model and data
-model = xgb.Booster()
-model.load_model("xgb_rank_model.json")
+# Resolves to the registry's current version unless a file is given
+def load_model(model_file=None):
+    import xgboost as xgb
+    model = xgb.Booster()
+    model.load_model(model_file or model_registry.model_path())
+    return model
 
-with open("feature_engineered_appraisals_dataset.json") as f:
-    raw_data = json.load(f)
+def load_raw_data(raw_data_file=RAW_DATA_FILE):
+    return load_appraisals(raw_data_file)
 
-data_file = (
-    "training_data_with_feedback.csv"
-    if os.path.exists("feedback_log.csv") and os.path.getsize("feedback_log.csv") > 0
-    else "training_data.csv"
-)
+def get_data_file():
+    return (
+        "training_data_with_feedback.csv"
+        if os.path.exists("feedback_log.csv") and os.path.getsize("feedback_log.csv") > 0
+        else "training_data.csv"
+    )
 
-df = pd.read_csv(data_file)
-print(f"Using training data: {data_file}")
-
-# Feature columns 
-feature_cols = [
-    'bath_score_diff', 'full_baths_diff', 'half_baths_diff',
-    'room_count_diff', 'bedrooms_diff', 'effective_age_diff',
-    'subject_age_diff', 'lot_size_sf_diff', 'gla_diff',
-    'abs_bath_score_diff', 'abs_full_bath_diff', 'abs_half_bath_diff',
-    'abs_room_count_diff', 'abs_bedrooms_diff', 'abs_effective_age_diff',
-    'abs_subject_age_diff', 'abs_lot_size_sf_diff', 'abs_gla_diff',
-    'same_property_type', 'sold_recently', # 'distance_to_subject_km'
-]
-df[feature_cols] = df[feature_cols].astype(float)
+def load_training_data(data_file):
+    df = pd.read_csv(data_file)
+    df[feature_cols] = df[feature_cols].astype(float)
+    return df
 
 # Lookup actual property info 
-def find_raw_values(order_id, candidate_address):
-    for appraisal in raw_data["appraisals"]:
-        if str(appraisal.get("orderID")) != str(order_id):
+def subject_values(subject):
+    return {
+        "subject_bath_score": subject.get("bath_score"),
+        "subject_num_full_baths": subject.get("num_full_baths"),
+        "subject_num_half_baths": subject.get("num_half_baths"),
+        "subject_bedrooms": subject.get('num_beds'),
+        "subject_gla": subject.get("gla"),
+        "subject_lot_size_sf": subject.get("lot_size_sf"),
+        "subject_property_type": subject.get("property_type"),
+    }
+
+def candidate_values(prop):
+    return {
+        "candidate_bath_score": prop.get("bath_score"),
+        "candidate_num_full_baths": prop.get("num_full_baths"),
+        "candidate_num_half_baths": prop.get("num_half_baths"),
+        "candidate_bedrooms": prop.get('num_beds'),
+        "candidate_gla": prop.get("gla"),
+        "candidate_lot_size_sf": prop.get("lot_size_sf"),
+        "candidate_property_type": prop.get("property_type"),
+        "candidate_close_price": prop.get("sale_price")
+    }
+
+def find_raw_values(raw_data, order_id, candidate_address):
+    subject_vals = {}
+    for appraisal in raw_data:
+        if appraisal.order_id != str(order_id):
             continue
-        subject = appraisal.get("subject", {})
-        subject_vals = {
-            "subject_bath_score": subject.get("bath_score"),
-            "subject_num_full_baths": subject.get("num_full_baths"),
-            "subject_num_half_baths": subject.get("num_half_baths"),
-            "subject_bedrooms": subject.get('num_beds'),
-            "subject_gla": subject.get("gla"),
-            "subject_lot_size_sf": subject.get("lot_size_sf"),
-            "subject_property_type": subject.get("property_type"),
-            
-        }
+        subject_vals = subject_values(appraisal.subject)
         for group in ("comps", "properties"):
-            for prop in appraisal.get(group, []):
-                if prop.get("address", "").strip().lower() == candidate_address.strip().lower():
-                    return subject_vals | {
-                        "candidate_bath_score": prop.get("bath_score"),
-                        "candidate_num_full_baths": prop.get("num_full_baths"),
-                        "candidate_num_half_baths": prop.get("num_half_baths"),
-                        "candidate_bedrooms": prop.get('num_beds'),
-                        "candidate_gla": prop.get("gla"),
-                        "candidate_lot_size_sf": prop.get("lot_size_sf"),
-                        "candidate_property_type": prop.get("property_type"),
-                        "candidate_close_price": prop.get("sale_price")
-                    }
+            for prop in getattr(appraisal, group):
+                if address_key(prop.address) == address_key(candidate_address):
+                    return subject_vals | candidate_values(prop)
     return subject_vals
 
-# GPT explanation 
-def gpt_explanation(score, pos_feats, neg_feats, candidate_address, subject_address):
-    try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        """You are a real estate appraisal assistant. Your job is to explain why a machine learning model ranked a candidate property as more or less comparable to a subject property.
+# orderID -> (subject, {address: candidate}) so each lookup is a dict hit
+# instead of a scan over every appraisal
+def build_raw_index(raw_data):
+    index = {}
+    for appraisal in raw_data:
+        candidates = {}
+        for group in ("comps", "properties"):
+            for prop in getattr(appraisal, group):
+                candidates.setdefault(address_key(prop.address), prop)
+        index.setdefault(appraisal.order_id, (appraisal.subject, candidates))
+    return index
 
-                            The model uses feature differences (e.g., size difference, age difference) between the candidate and subject. Positive SHAP values mean the feature made the 
-                            candidate more similar (better match), while negative SHAP values indicate dissimilarity.
+def lookup_raw_values(raw_index, order_id, candidate_address):
+    subject, candidates = raw_index.get(str(order_id), ({}, {}))
+    prop = candidates.get(address_key(candidate_address))
+    if prop is None:
+        return subject_values(subject)
+    return subject_values(subject) | candidate_values(prop)
 
-                            Do not say whether the property is 'good' or 'bad'. Instead, explain how the model interpreted the feature similarities or differences that affected the score."""
+# GPT explanation 
+SYSTEM_PROMPT = (
+    "You are a real estate appraisal assistant. Your job is to explain why a machine learning model ranked a candidate property as more or less comparable to a subject property.\n\n"
+    "The model uses feature differences (e.g., size difference, age difference) between the candidate and subject. Positive SHAP values mean the feature made the candidate more similar (better match), while negative SHAP values indicate dissimilarity.\n\n"
+    "Do not say whether the property is 'good' or 'bad'. Instead, explain how the model interpreted the feature similarities or differences that affected the score. Use both the actual feature values and their SHAP impact scores."
+)
 
-                    )
-                },
+def enrich(features, row):
+    return ', '.join(
+        f"{f} = {row.get(f, 'N/A')} (SHAP {v:+.2f})"
+        for f, v in features
+    )
+
+@metrics.timed("gpt_explanation")
+def gpt_explanation(score, pos_feats, neg_feats, candidate_address, subject_address, row):
+    try:
+        start = time.perf_counter()
+        response = get_client().chat.completions.create(
+            model=LLM_MODEL,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": (
-                        f"""
-                        The model assigned the candidate property at {candidate_address} a score of {score:.2f} when comparing it to the subject at {subject_address}.
-
-                        Features that made the candidate more similar:
-                        {', '.join([f'{f} ({v:.2f})' for f, v in pos_feats]) or 'None'}
-
-                        Features that made the candidate less similar:
-                        {', '.join([f'{f} ({v:.2f})' for f, v in neg_feats]) or 'None'}
-
-                        Based only on the features and their impact, describe why the model produced this score. Focus on the similarity or difference in attributes.
-                        """
+                        f"The model gave the candidate property at {candidate_address} a score of {score:.2f} when comparing it to the subject at {subject_address}.\n\n"
+                        f"These features made the candidate more similar:\n{enrich(pos_feats, row) or 'None'}\n\n"
+                        f"These features made the candidate less similar:\n{enrich(neg_feats, row) or 'None'}\n\n"
+                        "Using the actual values and SHAP scores, explain in 1–2 sentences why the model ranked this candidate where it did."
                     )
                 }
             ],
             temperature=0.7
         )
+        metrics.record_llm_call(response, "explanation", time.perf_counter() - start)
         return response.choices[0].message.content.strip()
     except Exception as e:
+        metrics.incr("llm_errors_total", call="explanation")
         return f"[Error getting GPT explanation: {e}]"
 
-def gpt_explanation(score, pos_feats, neg_feats, candidate_address, subject_address, row):
-    def enrich(features):
-        return ', '.join(
-            f"{f} = {row.get(f, 'N/A')} (SHAP {v:+.2f})"
-            for f, v in features
+# Template explanations
+#
+# Deterministic text from the top SHAP items and the raw values from
+# lookup_raw_values, with no network call. A feature and its abs_ twin
+# describe the same attribute and are merged into one phrase. Diffs are
+# subject minus candidate (feature_registry.py).
+EXPLANATION_TOPICS = {
+    "gla_diff": "gla", "abs_gla_diff": "gla",
+    "lot_size_sf_diff": "lot_size_sf", "abs_lot_size_sf_diff": "lot_size_sf",
+    "bedrooms_diff": "bedrooms", "abs_bedrooms_diff": "bedrooms",
+    "full_baths_diff": "num_full_baths", "abs_full_bath_diff": "num_full_baths",
+    "half_baths_diff": "num_half_baths", "abs_half_bath_diff": "num_half_baths",
+    "bath_score_diff": "bath_score", "abs_bath_score_diff": "bath_score",
+    "room_count_diff": "room_count", "abs_room_count_diff": "room_count",
+    "effective_age_diff": "age", "abs_effective_age_diff": "age",
+    "subject_age_diff": "age", "abs_subject_age_diff": "age",
+    "same_property_type": "property_type",
+    "sold_recently": "sold_recently",
+}
+
+# topic -> (label, unit) for topics with subject_/candidate_ raw values
+RAW_TOPICS = {
+    "gla": ("living area", " sq ft"),
+    "lot_size_sf": ("lot size", " sq ft"),
+    "bedrooms": ("bedrooms", ""),
+    "num_full_baths": ("full baths", ""),
+    "num_half_baths": ("half baths", ""),
+    "bath_score": ("bath score", ""),
+}
+
+def _present(val):
+    return val is not None and val != "" and not (isinstance(val, float) and np.isnan(val))
+
+def format_value(val, unit=""):
+    if not _present(val):
+        return "n/a"
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return str(val)
+    return f"{val:,.0f}{unit}" if val.is_integer() else f"{val:,.1f}{unit}"
+
+def _signed_feature(feature):
+    signed = feature[len("abs_"):] if feature.startswith("abs_") else feature
+    return {"full_bath_diff": "full_baths_diff", "half_bath_diff": "half_baths_diff"}.get(signed, signed)
+
+# The diff behind the feature SHAP picked (effective_age_diff and
+# subject_age_diff are both "age"), or the topic's first present one
+def _signed_diff(row, topic, feature=None):
+    features = [_signed_feature(feature)] if feature else [f for f, t in EXPLANATION_TOPICS.items() if t == topic and not f.startswith("abs_")]
+    for f in features:
+        if _present(row.get(f)):
+            return float(row[f])
+    return None
+
+# Subject and candidate agree on the topic, e.g. zero diff or same type
+def _unchanged(topic, row, feature=None):
+    if topic in RAW_TOPICS:
+        subject, candidate = row.get(f"subject_{topic}"), row.get(f"candidate_{topic}")
+        return _present(subject) and _present(candidate) and subject == candidate
+    if topic == "property_type":
+        return row.get("same_property_type") == 1
+    if topic in ("age", "room_count"):
+        return _signed_diff(row, topic, feature) == 0
+    return False
+
+def describe_topic(topic, row, feature=None):
+    if topic in RAW_TOPICS:
+        label, unit = RAW_TOPICS[topic]
+        subject, candidate = row.get(f"subject_{topic}"), row.get(f"candidate_{topic}")
+        if not _present(subject) and not _present(candidate):
+            return f"{label} (not recorded)"
+        return f"{label} ({format_value(candidate, unit)} vs {format_value(subject)} for the subject)"
+    if topic == "property_type":
+        subject, candidate = row.get("subject_property_type"), row.get("candidate_property_type")
+        if row.get("same_property_type") == 1:
+            return f"same property type ({subject})" if _present(subject) else "same property type"
+        return f"property type ({candidate if _present(candidate) else 'n/a'} vs {subject if _present(subject) else 'n/a'} for the subject)"
+    if topic == "sold_recently":
+        # No sale date: the clause is omitted rather than guessed
+        if not _present(row.get("sold_recently")):
+            return None
+        return "sale within 90 days of the effective date" if row.get("sold_recently") == 1 else "sale date more than 90 days from the effective date"
+
+    diff = _signed_diff(row, topic, feature) if topic in ("age", "room_count") else None
+    if diff is None:
+        return topic.replace("_", " ")
+    if topic == "age":
+        if diff == 0:
+            return "same age"
+        return f"age ({format_value(abs(diff))} years {'newer' if diff > 0 else 'older'})"
+    if diff == 0:
+        return "same room count"
+    rooms = "room" if abs(diff) == 1 else "rooms"
+    return f"room count ({format_value(abs(diff))} {'fewer' if diff > 0 else 'more'} {rooms})"
+
+def _topics(factors):
+    # (topic, net SHAP, strongest feature) per topic, strongest first; a topic
+    # whose diff and abs_diff pull opposite ways lands on the side that wins
+    totals, strongest = {}, {}
+    for feature, value in factors:
+        topic = EXPLANATION_TOPICS.get(feature, feature)
+        totals[topic] = totals.get(topic, 0.0) + value
+        if topic not in strongest or abs(value) > abs(strongest[topic][1]):
+            strongest[topic] = (feature, value)
+    return [(topic, total, strongest[topic][0]) for topic, total in sorted(totals.items(), key=lambda item: -abs(item[1]))]
+
+def _join(phrases):
+    return phrases[0] if len(phrases) == 1 else ", ".join(phrases[:-1]) + " and " + phrases[-1]
+
+@metrics.timed("template_explanation")
+def template_explanation(score, pos_feats, neg_feats, candidate_address, subject_address, row):
+    topics = _topics(list(pos_feats) + list(neg_feats))
+    described = [(describe_topic(topic, row, feature), value, _unchanged(topic, row, feature)) for topic, value, feature in topics]
+    raised = [text for text, value, _ in described if text and value > 0][:TEMPLATE_FACTORS]
+    # Nothing differs, so nothing to be held back by
+    lowered = [text for text, value, same in described if text and value < 0 and not same][:TEMPLATE_FACTORS]
+    text = f"Scored {score:.2f}."
+    if raised:
+        text += f" Ranked up by {_join(raised)}."
+    if lowered:
+        text += f" Held back by {_join(lowered)}."
+    if not raised and not lowered:
+        text += " No single feature stood out."
+    return text
+
+def fill_failed_explanations(scored):
+    # LLM enrichment is best effort: any row it failed on keeps the template text
+    failed = 0
+    for row, positive_factors, negative_factors in scored:
+        if str(row.get("explanation", "")).startswith("[Error"):
+            row["explanation"] = template_explanation(
+                row["score"], positive_factors[:3], negative_factors[:3], row["candidate_address"], row["subject_address"], row
+            )
+            failed += 1
+    return failed
+
+# Batched GPT explanations
+#
+# One request per order: the system prompt and subject go out once and every
+# top-k candidate is listed by number. The reply must be a JSON object with
+# one non-empty explanation per candidate number; anything else falls back to
+# gpt_explanation per candidate, so a bad reply costs extra calls, never a
+# missing explanation.
+def batch_prompt(items):
+    subject_address = items[0][0]["subject_address"]
+    lines = [f"The model compared {len(items)} candidate properties to the subject at {subject_address}.\n"]
+    for number, (row, pos_feats, neg_feats) in enumerate(items, start=1):
+        lines.append(
+            f"Candidate {number}: {row['candidate_address']}, score {row['score']:.2f}\n"
+            f"  More similar: {enrich(pos_feats[:3], row) or 'None'}\n"
+            f"  Less similar: {enrich(neg_feats[:3], row) or 'None'}"
         )
+    lines.append(
+        "\nUsing the actual values and SHAP scores, explain in 1–2 sentences per candidate why the model ranked it where it did. "
+        'Reply with only a JSON object of the form {"explanations": [{"candidate": 1, "explanation": "..."}, ...]} '
+        "with exactly one entry per candidate."
+    )
+    return "\n".join(lines)
 
+def parse_batch_reply(content, count):
+    # Explanations in candidate order, or None when the reply does not cover
+    # every candidate exactly once
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        entries = json.loads(content)["explanations"]
+        by_number = {int(entry["candidate"]): entry["explanation"] for entry in entries}
+    except (ValueError, KeyError, TypeError):
+        return None
+    # null, non-string or blank explanations count as missing
+    by_number = {number: text.strip() if isinstance(text, str) else "" for number, text in by_number.items()}
+    if len(entries) != count or sorted(by_number) != list(range(1, count + 1)) or not all(by_number.values()):
+        return None
+    return [by_number[number] for number in range(1, count + 1)]
+
+@metrics.timed("gpt_explanation_batch")
+def gpt_explanations_batch(items):
+    explanations = None
+    try:
+        start = time.perf_counter()
+        response = get_client().chat.completions.create(
+            model=LLM_MODEL,
             messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are a real estate appraisal assistant. Your job is to explain why a machine learning model ranked a candidate property as more or less comparable to a subject property.\n\n"
-                        "The model uses feature differences (e.g., size difference, age difference) between the candidate and subject. Positive SHAP values mean the feature made the candidate more similar (better match), while negative SHAP values indicate dissimilarity.\n\n"
-                        "Do not say whether the property is 'good' or 'bad'. Instead, explain how the model interpreted the feature similarities or differences that affected the score. Use both the actual feature values and their SHAP impact scores."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": (
-                        f"The model gave the candidate property at {candidate_address} a score of {score:.2f} when comparing it to the subject at {subject_address}.\n\n"
-                        f"These features made the candidate more similar:\n{enrich(pos_feats) or 'None'}\n\n"
-                        f"These features made the candidate less similar:\n{enrich(neg_feats) or 'None'}\n\n"
-                        "Using the actual values and SHAP scores, explain in 1–2 sentences why the model ranked this candidate where it did."
-                    )
-                }
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": batch_prompt(items)},
             ],
+            response_format={"type": "json_object"},
             temperature=0.7
         )
-        return response.choices[0].message.content.strip()
+        metrics.record_llm_call(response, "explanation_batch", time.perf_counter() - start)
+        explanations = parse_batch_reply(response.choices[0].message.content, len(items))
     except Exception as e:
-        return f"[Error getting GPT explanation: {e}]"
+        metrics.incr("llm_errors_total", call="explanation_batch")
+        print(f"[Batch explanation error] {e}")
+
+    if explanations is None:
+        metrics.incr("llm_batch_fallbacks_total")
+        explanations = [
+            gpt_explanation(row["score"], pos_feats[:3], neg_feats[:3], row["candidate_address"], row["subject_address"], row)
+            for row, pos_feats, neg_feats in items
+        ]
+    return explanations
 
 
 # SHAP wrapper  
-def model_predict(X_df):
-    dmatrix = xgb.DMatrix(X_df)
-    return model.predict(dmatrix)
+def make_explainer(model, background):
+    import shap
+    import xgboost as xgb
 
-explainer = shap.Explainer(model_predict, df[feature_cols])
+    def model_predict(X_df):
+        dmatrix = xgb.DMatrix(X_df)
+        return model.predict(dmatrix)
+
+    return shap.Explainer(model_predict, background)
+
+@metrics.timed("shap")
+def shap_factors(explainer, row):
+    row_df = row[feature_cols].to_frame().T.astype(float)
+    shap_vals = explainer(row_df)
+
+    # Strongest first, so callers taking the top few get the ones that matter
+    shap_items = sorted(zip(row_df.columns, shap_vals.values[0]), key=lambda item: -abs(item[1]))
+    positive_factors = [(f, v) for f, v in shap_items if v > 0]
+    negative_factors = [(f, v) for f, v in shap_items if v < 0]
+    return positive_factors, negative_factors
+
+def top_candidates(model, group, k=3):
+    import xgboost as xgb
 
-# Main loop 
-results = []
-for order_id, group in tqdm(df.groupby("orderID"), desc="Generating GPT Explanations"):
     group = group.copy()
     group[feature_cols] = group[feature_cols].astype(float)
     dmatrix = xgb.DMatrix(group[feature_cols])
     group["score"] = model.predict(dmatrix)
     group["rank"] = group["score"].rank(method="first", ascending=False)
 
-    top3 = group.sort_values("score", ascending=False).head(3)
+    return group.sort_values("score", ascending=False).head(k)
+
+# Main loop 
+def score_order(order_id, group, model, explainer, raw_index, k=3):
+    scored = []
+    top3 = top_candidates(model, group, k)
 
     for _, row in top3.iterrows():
-        row_df = row[feature_cols].to_frame().T.astype(float)
         try:
-            shap_vals = explainer(row_df)
+            positive_factors, negative_factors = shap_factors(explainer, row)
         except Exception as e:
             print(f"[SHAP Error] orderID={order_id}: {e}")
             continue
 
-        shap_items = list(zip(row_df.columns, shap_vals.values[0]))
-        positive_factors = [(f, v) for f, v in shap_items if v > 0]
-        negative_factors = [(f, v) for f, v in shap_items if v < 0]
-
-        extra = find_raw_values(order_id, row["candidate_address"])
+        extra = lookup_raw_values(raw_index, order_id, row["candidate_address"])
         enriched_row = row.to_dict() | extra | {"orderID": order_id}
+        scored.append((enriched_row, positive_factors, negative_factors))
+    return scored
 
-        explanation = gpt_explanation(
-            row['score'], positive_factors[:3], negative_factors[:3],
-            row["candidate_address"], row["subject_address"], enriched_row
-        )
+def iter_scored_orders(df, model, explainer, raw_data, k=3):
+    raw_index = build_raw_index(raw_data)
+    for order_id, group in tqdm(df.groupby("orderID"), desc="Scoring orders"):
+        yield order_id, score_order(order_id, group, model, explainer, raw_index, k)
+
+# Parallel mode: orders are sharded across a process pool. Each worker loads
+# the model, SHAP explainer and raw-value index once in its initializer.
+_worker = {}
 
-        enriched_row["explanation"] = explanation
+def _init_worker(model_file, raw_data_file, background):
+    _worker["model"] = load_model(model_file)
+    _worker["explainer"] = make_explainer(_worker["model"], background)
+    _worker["raw_index"] = build_raw_index(load_raw_data(raw_data_file))
+
+def _score_shard(shard, k):
+    return [
+        (order_id, score_order(order_id, group, _worker["model"], _worker["explainer"], _worker["raw_index"], k))
+        for order_id, group in shard
+    ]
+
+def iter_scored_orders_parallel(df, workers, model_file=None, raw_data_file=RAW_DATA_FILE, k=3, shards_per_worker=4, background=None):
+    # Resolve once so every worker loads the same model version
+    model_file = model_file or model_registry.model_path()
+    groups = list(df.groupby("orderID"))
+    # Round-robin shards keep large and small orders spread across workers
+    num_shards = max(1, min(len(groups), workers * shards_per_worker))
+    shards = [groups[i::num_shards] for i in range(num_shards)]
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker,
+        initargs=(model_file, raw_data_file, df[feature_cols] if background is None else background)
+    ) as pool:
+        for shard_orders in tqdm(pool.map(_score_shard, shards, [k] * num_shards), total=num_shards, desc=f"Scoring orders ({workers} workers)"):
+            yield from shard_orders
+
+def explain_scored(scored, explain=gpt_explanation, progress=True):
+    results = []
+    for enriched_row, positive_factors, negative_factors in tqdm(scored, desc="Generating explanations", disable=not progress):
+        enriched_row["explanation"] = explain(
+            enriched_row['score'], positive_factors[:3], negative_factors[:3],
+            enriched_row["candidate_address"], enriched_row["subject_address"], enriched_row
+        )
         results.append(enriched_row)
+    return results
+
+# scored is grouped by orderID (explain_order passes one order at a time)
+def explain_scored_batched(scored, explain_batch=gpt_explanations_batch, progress=True):
+    results = []
+    orders = groupby(scored, key=lambda item: item[0]["orderID"])
+    for _, items in tqdm(orders, desc="Generating GPT Explanations (one request per order)", disable=not progress):
+        items = list(items)
+        for (enriched_row, _, _), explanation in zip(items, explain_batch(items)):
+            enriched_row["explanation"] = explanation
+            results.append(enriched_row)
+    return results
+
+# Explanations for one order's scored candidates, and how many of them fell
+# back to template text after an LLM failure
+def explain_order(items, llm=False, llm_mode="batch"):
+    if not llm:
+        return explain_scored(items, template_explanation, progress=False), 0
+    rows = explain_scored_batched(items, progress=False) if llm_mode == "batch" else explain_scored(items, progress=False)
+    return rows, fill_failed_explanations(items)
+
+# Checkpoints
+#
+# Every finished order is appended to the checkpoint as one JSON line and
+# flushed, so a crash, Ctrl-C or rate-limit storm loses at most the orders in
+# flight. The first line records what the run was built from (training data
+# version, model, explanation mode); a rerun with the same inputs skips the
+# orderIDs already there, anything else starts over. With --llm, orders where
+# the LLM failed and template text was used are redone on resume. The CSV is
+# written from the checkpoint at the end and the checkpoint is then removed.
+def run_signature(data_file, model_file, llm, k=3, cascade=None):
+    stat = os.stat(data_file)
+    return {"data_file": data_file, "data_version": [stat.st_mtime_ns, stat.st_size], "model": model_file, "llm": llm, "k": k,
+            "cascade": cascade}
+
+def read_checkpoint(path, signature):
+    # {orderID: entry}, or None when there is no checkpoint for this run
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    # A crash mid-write leaves a partial last line; drop it so appends stay valid
+    cut = data.rfind(b"\n") + 1
+    if cut < len(data):
+        with open(path, "r+b") as f:
+            f.truncate(cut)
+    lines = data[:cut].decode().splitlines()
+    if not lines or json.loads(lines[0]) != {"run": signature}:
+        return None
+    entries = {}
+    for line in lines[1:]:
+        entry = json.loads(line)
+        # A redone order is appended again; the later line wins
+        entries[entry["orderID"]] = entry
+    return entries
+
+def _plain(val):
+    return val.item() if hasattr(val, "item") else str(val)
+
+def append_checkpoint(f, order_id, rows, llm_failed=0):
+    f.write(json.dumps({"orderID": str(order_id), "llm_failed": llm_failed, "rows": rows}, default=_plain) + "\n")
+    f.flush()
 
 # Final output 
-top3_df = pd.DataFrame(results)
-top3_df = top3_df.sort_values(by=["orderID", "score"], ascending=[True, False])
-top3_df.to_csv("top3_gpt_explanations.csv", index=False)
-print("\nSaved top3_gpt_explanations.csv")
+def save_results(results, output_file=OUTPUT_FILE):
+    top3_df = pd.DataFrame(results)
+    top3_df = top3_df.sort_values(by=["orderID", "score"], ascending=[True, False])
+    top3_df.to_csv(output_file, index=False)
+    print(f"\nSaved {output_file}")
+    return top3_df
 
 # Analysis 
-print("\n[Results Analysis]")
-print("Total top-3 rows:", len(top3_df))
-print("How many are labeled comps (is_comp = 1)?", top3_df["is_comp"].sum())
-print("Top-3 Precision:", top3_df["is_comp"].mean())
-print(top3_df["is_comp"].value_counts())
-
-false_positives = top3_df[top3_df["is_comp"] == 0][["orderID", "candidate_address"]]
-print("\nFalse Positives (Top-3 predicted but not comps):")
-print(false_positives.to_string(index=False))
+def print_analysis(top3_df):
+    print("\n[Results Analysis]")
+    print("Total top-3 rows:", len(top3_df))
+    print("How many are labeled comps (is_comp = 1)?", top3_df["is_comp"].sum())
+    print("Top-3 Precision:", top3_df["is_comp"].mean())
+    print(top3_df["is_comp"].value_counts())
+
+    false_positives = top3_df[top3_df["is_comp"] == 0][["orderID", "candidate_address"]]
+    print("\nFalse Positives (Top-3 predicted but not comps):")
+    print(false_positives.to_string(index=False))
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Explain the top-3 ranked candidates for every order")
+    arg_parser.add_argument("--workers", type=int, default=1, help="processes for scoring and SHAP (0 = one per CPU)")
+    arg_parser.add_argument("--llm", action="store_true", help="write LLM explanations instead of templates (needs OPENAI_API_KEY)")
+    arg_parser.add_argument("--llm-mode", choices=["batch", "single"], default="batch",
+                            help="with --llm: one request per order for all its candidates, or one per candidate")
+    arg_parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="append-only progress file a rerun resumes from")
+    arg_parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint and explain every order again")
+    arg_parser.add_argument("--cascade", action="store_true", help="prune candidates with the cascade rules before scoring and SHAP")
+    arg_parser.add_argument("--cascade-stage1", action="store_true", help="also keep only the first-stage model's best candidates")
+    args = arg_parser.parse_args(argv)
+    cascade = cascade_pruning.cascade_config(args.cascade_stage1) if args.cascade or args.cascade_stage1 else None
+    workers = args.workers or os.cpu_count()
+
+    if args.llm:
+        get_client()
+
+    data_file = get_data_file()
+    df = load_training_data(data_file)
+    print(f"Using training data: {data_file}")
+    if cascade is not None:
+        df = cascade_pruning.prune_frame(df, cascade)
+        print(f"Cascade kept {len(df)} candidate rows")
+
+    model_file = model_registry.model_path()
+    signature = run_signature(data_file, model_file, args.llm, cascade=cascade)
+    done = None if args.restart else read_checkpoint(args.checkpoint, signature)
+    if done is None:
+        with open(args.checkpoint, "w") as f:
+            f.write(json.dumps({"run": signature}) + "\n")
+        done = {}
+    else:
+        if args.llm:
+            done = {order_id: entry for order_id, entry in done.items() if not entry["llm_failed"]}
+        print(f"Resuming from {args.checkpoint}: {len(done)} of {df['orderID'].nunique()} orders already explained")
+    todo = df[~df["orderID"].astype(str).isin(done)]
+
+    llm_failed = 0
+    with metrics.stage("explain", items=todo["orderID"].nunique()), open(args.checkpoint, "a") as checkpoint:
+        if len(todo) and workers > 1:
+            orders = iter_scored_orders_parallel(todo, workers, model_file, background=df[feature_cols])
+        elif len(todo):
+            model = load_model(model_file)
+            orders = iter_scored_orders(todo, model, make_explainer(model, df[feature_cols]), load_raw_data())
+        else:
+            orders = []
+        for order_id, items in orders:
+            rows, failed = explain_order(items, args.llm, args.llm_mode)
+            append_checkpoint(checkpoint, order_id, rows, failed)
+            llm_failed += failed
+    if llm_failed:
+        print(f"{llm_failed} LLM explanations failed; used template text for those (a rerun retries them)")
+
+    results = [row for entry in read_checkpoint(args.checkpoint, signature).values() for row in entry["rows"]]
+    top3_df = save_results(results)
+    if not llm_failed:
+        os.remove(args.checkpoint)
+    print_analysis(top3_df)
+    metrics.export("top3_explanations")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,72 +1,101 @@
+import argparse
 import pandas as pd
-import xgboost as xgb
-from sklearn.model_selection import train_test_split
 import numpy as np
 import os
+import tempfile
+import time
+from feature_registry import FEATURE_COLS
+import metrics
+import model_registry
 
 SHUFFLE_LABELS = False
 
-training_data_file = "training_data_with_feedback.csv" if os.path.exists("feedback_log.csv") and os.path.getsize("feedback_log.csv") > 0 else "training_data.csv"
+# Define feature columns (declared in feature_registry.py)
+feature_cols = FEATURE_COLS
 
-# Load dataset
-df = pd.read_csv(training_data_file)
+# Train ranking model
+params = {
+    'objective': 'rank:pairwise',
+    'eval_metric': 'ndcg',
+    'eta': 0.1,
+    'max_depth': 6,
+    'verbosity': 1
+}
+NUM_BOOST_ROUND = 100
 
-print(f"Using training data: {training_data_file}")
+# Out-of-core training
+#
+# --external-memory never holds the training CSV in memory. A first pass
+# reads only the orderID column in chunks to count rows per order (one entry
+# per order, not per row); the sorted orders are cut into batches of about
+# BATCH_ROWS rows. A second pass spools each chunk's rows into per-batch .npz
+# parts on disk. XGBoost then pulls one batch at a time through a DataIter,
+# sorted by orderID, so every order's candidates sit together and query ids
+# increase across batches, and keeps its own hist pages on disk. The held-out
+# orders are the same as split_data's. tree_method 'hist' is set only here;
+# the in-memory path keeps the default.
+CHUNK_ROWS = 100_000
+BATCH_ROWS = 250_000
+TEST_FRACTION = 0.2
 
-if SHUFFLE_LABELS:
-    print("Shuffling labels for sanity check...")
-    df["is_comp"] = df.groupby("orderID")["is_comp"].transform(
-        lambda x: np.random.permutation(x.values)
-    )
+# Negative sampling
+#
+# --negatives N keeps every comp and at most N non-comps per order in the
+# training split. A --hard-fraction share of those are the non-comps the
+# current registered model scores highest (the pairs it still gets wrong or
+# nearly wrong); the rest are drawn uniformly, so easy negatives stay
+# represented. The held-out split is never sampled, so precision is measured
+# on the full candidate set either way; --compare also trains on every row and
+# prints both runs side by side.
+HARD_FRACTION = 0.5
+SAMPLING_SEED = 42
 
-# Define feature columns
-feature_cols = [
-    'bath_score_diff', 'full_baths_diff', 'half_baths_diff',
-    'room_count_diff', 'bedrooms_diff', 'effective_age_diff',
-    'subject_age_diff', 'lot_size_sf_diff', 'gla_diff',
-    'abs_bath_score_diff', 'abs_full_bath_diff', 'abs_half_bath_diff',
-    'abs_room_count_diff', 'abs_bedrooms_diff', 'abs_effective_age_diff',
-    'abs_subject_age_diff', 'abs_lot_size_sf_diff', 'abs_gla_diff',
-    'same_property_type', 'sold_recently', # 'distance_to_subject_km'
-]
+def get_training_data_file():
+    return "training_data_with_feedback.csv" if os.path.exists("feedback_log.csv") and os.path.getsize("feedback_log.csv") > 0 else "training_data.csv"
 
-# Fill in label if not already present
-df['label'] = df['is_comp']
+def load_training_data(training_data_file):
+    # Load dataset
+    df = pd.read_csv(training_data_file)
 
-# Train-test split
-df_train, df_test = train_test_split(
-    df, test_size=0.2, random_state=42, stratify=df['label']
-)
+    if SHUFFLE_LABELS:
+        print("Shuffling labels for sanity check...")
+        df["is_comp"] = df.groupby("orderID")["is_comp"].transform(
+            lambda x: np.random.permutation(x.values)
+        )
 
-# Sort for group creation
-df_train = df_train.sort_values("orderID")
-df_test = df_test.sort_values("orderID")
+    # Fill in label if not already present
+    df['label'] = df['is_comp']
+    return df
 
-# Group by orderID for ranking
-groups_train = df_train.groupby("orderID").size().to_list()
+def split_data(df):
+    # Whole orders are held out, chosen by the same orderID hash as
+    # --external-memory, so both modes evaluate on the same orders
+    test = is_test_order(df["orderID"])
+    df_train, df_test = df[~test], df[test]
 
-# Ensure numeric input (float) for DMatrix
-X_train = df_train[feature_cols].astype(float)
-y_train = df_train["label"]
+    # Sort for group creation
+    df_train = df_train.sort_values("orderID")
+    df_test = df_test.sort_values("orderID")
+    return df_train, df_test
 
-dtrain = xgb.DMatrix(X_train, label=y_train)
-dtrain.set_group(groups_train)
+def train_model(df_train, params=params, num_boost_round=NUM_BOOST_ROUND, threads=None):
+    import xgboost as xgb
 
-# Train ranking model
-params = {
-    'objective': 'rank:pairwise',
-    'eval_metric': 'ndcg',
-    'eta': 0.1,
-    'max_depth': 6,
-    'verbosity': 1
-}
+    # Group by orderID for ranking
+    groups_train = df_train.groupby("orderID").size().to_list()
+
+    # Ensure numeric input (float) for DMatrix
+    X_train = df_train[feature_cols].astype(float)
+    y_train = df_train["label"]
 
-model = xgb.train(params, dtrain, num_boost_round=100)
+    dtrain = xgb.DMatrix(X_train, label=y_train, nthread=threads)
+    dtrain.set_group(groups_train)
 
-# Evaluation
-print("\nTop-K Evaluation by Appraisal:")
+    return xgb.train(params | ({"nthread": threads} if threads else {}), dtrain, num_boost_round=num_boost_round)
+
+def evaluate_topk(model, df_group, k=3):
+    import xgboost as xgb
 
-def evaluate_topk(df_group, k=3):
     df_group = df_group.copy()
     X = xgb.DMatrix(df_group[feature_cols].astype(float))
     df_group["score"] = model.predict(X)
@@ -74,12 +103,240 @@ def evaluate_topk(df_group, k=3):
     correct = topk["label"].sum()
     return pd.Series({"correct": correct, "total": k})
 
-# Evaluate at K = 1, 3
-for k in [1, 3]:
-    results = df_test.groupby("orderID").apply(lambda g: evaluate_topk(g, k)).sum()
-    precision = results["correct"] / results["total"]
-    print(f"Top-{k} Precision: {precision:.3f}")
+def evaluate(model, df_test, ks=(1, 3)):
+    precisions = {}
+    for k in ks:
+        results = df_test.groupby("orderID").apply(lambda g: evaluate_topk(model, g, k)).sum()
+        precisions[k] = results["correct"] / results["total"]
+    return precisions
+
+
+def read_chunks(training_data_file, columns, chunk_rows=CHUNK_ROWS):
+    return pd.read_csv(training_data_file, usecols=columns, dtype={"orderID": str}, chunksize=chunk_rows)
+
+def is_test_order(order_ids, test_fraction=TEST_FRACTION):
+    # Stable per-order holdout from a hash of the orderID
+    hashed = pd.util.hash_array(np.asarray(order_ids, dtype=object))
+    return (hashed % 1000) < test_fraction * 1000
+
+def spool_batches(training_data_file, spool_dir, batch_rows=BATCH_ROWS, chunk_rows=CHUNK_ROWS):
+    counts = {}
+    for chunk in read_chunks(training_data_file, ["orderID"], chunk_rows):
+        for order_id, n in chunk["orderID"].value_counts().items():
+            counts[order_id] = counts.get(order_id, 0) + n
+
+    qids, batch_of = {}, {}
+    batch, rows = 0, 0
+    for qid, order_id in enumerate(sorted(counts)):
+        if rows >= batch_rows:
+            batch, rows = batch + 1, 0
+        qids[order_id], batch_of[order_id] = qid, batch
+        rows += counts[order_id]
+
+    parts = {"train": {}, "test": {}}
+    for c, chunk in enumerate(read_chunks(training_data_file, ["orderID", "is_comp"] + feature_cols, chunk_rows)):
+        chunk_batch = chunk["orderID"].map(batch_of).to_numpy()
+        test = is_test_order(chunk["orderID"])
+        for split, mask in (("train", ~test), ("test", test)):
+            for b in np.unique(chunk_batch[mask]):
+                rows = chunk[mask & (chunk_batch == b)]
+                path = os.path.join(spool_dir, f"{split}-{b:05d}-{c:05d}.npz")
+                np.savez(
+                    path,
+                    X=rows[feature_cols].to_numpy(dtype=np.float32),
+                    label=rows["is_comp"].to_numpy(dtype=np.float32),
+                    qid=rows["orderID"].map(qids).to_numpy(dtype=np.int64),
+                )
+                parts[split].setdefault(b, []).append(path)
+    print(f"Spooled {sum(counts.values())} rows from {len(counts)} orders into {batch + 1} batches")
+    return {split: [batches[b] for b in sorted(batches)] for split, batches in parts.items()}
+
+def load_batch(paths):
+    loaded = []
+    for path in paths:
+        with np.load(path) as data:
+            loaded.append((data["X"], data["label"], data["qid"]))
+    X, label, qid = (np.concatenate(arrays) for arrays in zip(*loaded))
+    order = np.argsort(qid, kind="stable")
+    return X[order], label[order], qid[order]
+
+def batch_iterator(batches, cache_prefix):
+    import xgboost as xgb
+
+    class BatchIterator(xgb.DataIter):
+        def __init__(self):
+            self._it = 0
+            super().__init__(cache_prefix=cache_prefix)
+
+        def next(self, input_data):
+            if self._it == len(batches):
+                return False
+            X, label, qid = load_batch(batches[self._it])
+            input_data(data=X, label=label, qid=qid)
+            self._it += 1
+            return True
+
+        def reset(self):
+            self._it = 0
+
+    return BatchIterator()
+
+def train_external(batches, cache_dir, params=params, num_boost_round=NUM_BOOST_ROUND, threads=None):
+    import xgboost as xgb
+
+    dtrain = xgb.ExtMemQuantileDMatrix(batch_iterator(batches, os.path.join(cache_dir, "cache")), nthread=threads)
+    return xgb.train(params | {"tree_method": "hist"} | ({"nthread": threads} if threads else {}), dtrain, num_boost_round=num_boost_round)
+
+def evaluate_external(model, batches, ks=(1, 3), threads=None):
+    import xgboost as xgb
+
+    correct, total = dict.fromkeys(ks, 0.0), dict.fromkeys(ks, 0)
+    for paths in batches:
+        X, label, qid = load_batch(paths)
+        scores = model.predict(xgb.DMatrix(X, nthread=threads))
+        # Highest score first within each order, then the top k rows per order
+        order = np.lexsort((-scores, qid))
+        starts = np.r_[0, np.flatnonzero(np.diff(qid[order])) + 1]
+        position = np.arange(len(order)) - np.repeat(starts, np.diff(np.r_[starts, len(order)]))
+        for k in ks:
+            correct[k] += label[order][position < k].sum()
+            total[k] += k * len(starts)
+    return {k: correct[k] / total[k] if total[k] else 0.0 for k in ks}
+
+def current_model_scores(df):
+    import xgboost as xgb
+
+    version = model_registry.current_version()
+    if version is None:
+        return None
+    model = model_registry.load_booster(model_registry.model_path(version))
+    return model.predict(xgb.DMatrix(df[feature_cols].astype(float)))
+
+def sample_negatives(df_train, negatives, hard_fraction=HARD_FRACTION, scores=None, seed=SAMPLING_SEED):
+    rng = np.random.default_rng(seed)
+    is_negative = df_train["label"] <= 0
+    neg = df_train.loc[is_negative, ["orderID"]].copy()
+    n_hard = int(round(negatives * hard_fraction)) if scores is not None else 0
+
+    keep = pd.Series(False, index=neg.index)
+    if n_hard:
+        neg["hard"] = np.asarray(scores)[is_negative.to_numpy()]
+        keep |= neg.groupby("orderID")["hard"].rank(method="first", ascending=False) <= n_hard
+    # Uniform draw from whatever the hard pick left
+    neg["random"] = np.where(keep, np.inf, rng.random(len(neg)))
+    keep |= neg.groupby("orderID")["random"].rank(method="first") <= negatives - n_hard
+
+    sampled = df_train[~is_negative | keep.reindex(df_train.index, fill_value=False)]
+    stats = {
+        "negatives_per_order": negatives,
+        "hard_fraction": hard_fraction if n_hard else 0.0,
+        "rows_before": len(df_train),
+        "rows_after": len(sampled),
+        "positives": int((~is_negative).sum()),
+        "negatives_before": int(is_negative.sum()),
+        "negatives_after": int(keep.sum()),
+        "rows_kept": round(len(sampled) / len(df_train), 4) if len(df_train) else 1.0,
+        "negatives_kept": round(int(keep.sum()) / int(is_negative.sum()), 4) if is_negative.any() else 1.0,
+    }
+    return sampled, stats
+
+def print_sampling(stats):
+    print(f"Negative sampling: {stats['rows_after']:,} of {stats['rows_before']:,} training rows "
+          f"({stats['rows_kept']:.1%}); {stats['negatives_after']:,} of {stats['negatives_before']:,} non-comps kept, "
+          f"{stats['hard_fraction']:.0%} hard; all {stats['positives']:,} comps kept")
+
+def train_timed(df_train, threads=None):
+    start = time.perf_counter()
+    with metrics.stage("train", items=len(df_train)):
+        model = train_model(df_train, threads=threads)
+    return model, time.perf_counter() - start
+
+def main_external(training_data_file, threads=None, batch_rows=BATCH_ROWS, spool_dir=None):
+    with tempfile.TemporaryDirectory(dir=spool_dir) as tmp_dir:
+        with metrics.stage("spool"):
+            batches = spool_batches(training_data_file, tmp_dir, batch_rows)
+        with metrics.stage("train"):
+            model = train_external(batches["train"], tmp_dir, threads=threads)
+        with metrics.stage("evaluate"):
+            precisions = evaluate_external(model, batches["test"], threads=threads)
+    return model, precisions
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Train the pairwise ranking model and register it as a new version")
+    arg_parser.add_argument("--data", help="training data CSV (default: with feedback if any was logged)")
+    arg_parser.add_argument("--threads", type=int, help="XGBoost threads (default: all cores)")
+    arg_parser.add_argument("--external-memory", action="store_true", help="stream the CSV in batches instead of loading it")
+    arg_parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows per external-memory batch")
+    arg_parser.add_argument("--spool-dir", help="directory for external-memory batches and caches (default: system temp)")
+    arg_parser.add_argument("--negatives", type=int, metavar="N", help="keep all comps and at most N non-comps per order for training")
+    arg_parser.add_argument("--hard-fraction", type=float, default=HARD_FRACTION,
+                            help="share of the N non-comps picked by the current model's scores (the rest are random)")
+    arg_parser.add_argument("--compare", action="store_true", help="with --negatives, also train on every row and compare")
+    args = arg_parser.parse_args(argv)
+    if args.compare and args.negatives is None:
+        arg_parser.error("--compare needs --negatives")
+    if args.negatives is not None and args.external_memory:
+        arg_parser.error("--negatives is not supported with --external-memory")
+    if not 0 <= args.hard_fraction <= 1:
+        arg_parser.error("--hard-fraction must be between 0 and 1")
+
+    training_data_file = args.data or get_training_data_file()
+    print(f"Using training data: {training_data_file}")
+
+    sampling = None
+    if args.external_memory:
+        model, precisions = main_external(training_data_file, args.threads, args.batch_rows, args.spool_dir)
+        print("\nTop-K Evaluation by Appraisal (held-out orders):")
+    else:
+        df = load_training_data(training_data_file)
+        df_train, df_test = split_data(df)
+        df_full = df_train
+        if args.negatives is not None:
+            scores = current_model_scores(df_train) if args.hard_fraction > 0 else None
+            if scores is None and args.hard_fraction > 0:
+                print("No registered model to mine hard negatives with; sampling uniformly")
+            df_train, sampling = sample_negatives(df_train, args.negatives, args.hard_fraction, scores)
+            print_sampling(sampling)
+            metrics.incr("training_rows_total", sampling["rows_after"], sampling="kept")
+            metrics.incr("training_rows_total", sampling["rows_before"] - sampling["rows_after"], sampling="dropped")
+        model, train_s = train_timed(df_train, args.threads)
+
+        # Evaluation
+        print("\nTop-K Evaluation by Appraisal:")
+
+        # Evaluate at K = 1, 3
+        with metrics.stage("evaluate", items=len(df_test)):
+            precisions = evaluate(model, df_test)
+    for k, precision in precisions.items():
+        print(f"Top-{k} Precision: {precision:.3f}")
+
+    # Same held-out rows, trained on every row instead of the sample
+    regressed = False
+    if args.compare and sampling is not None:
+        full_model, full_s = train_timed(df_full, args.threads)
+        with metrics.stage("evaluate", items=len(df_test)):
+            full_precisions = evaluate(full_model, df_test)
+        print(f"\n{'':<10} {'rows':>10} {'train s':>8} " + " ".join(f"{f'top-{k}':>7}" for k in precisions))
+        for name, rows, seconds, result in (("all rows", len(df_full), full_s, full_precisions), ("sampled", len(df_train), train_s, precisions)):
+            print(f"{name:<10} {rows:>10,} {seconds:>8.2f} " + " ".join(f"{p:>7.3f}" for p in result.values()))
+        sampling |= {f"full_top{k}_precision": round(float(p), 4) for k, p in full_precisions.items()}
+        sampling["train_speedup"] = round(full_s / train_s, 2) if train_s else None
+        regressed = any(precisions[k] < full_precisions[k] for k in precisions)
+        sampling["regressed"] = regressed
+
+    # Register the model as a new version; make it current unless the
+    # sampled model lost precision against the all-rows run
+    eval_metrics = {f"top{k}_precision": float(p) for k, p in precisions.items()}
+    version = model_registry.register_model(model, training_data_file, eval_metrics, params | {
+        "num_boost_round": NUM_BOOST_ROUND, "external_memory": args.external_memory, "negative_sampling": sampling,
+    }, activate=not regressed)
+    print(f"\nRanking model saved as {model_registry.model_path(version)}")
+    if regressed:
+        print(f"Sampled model is less precise than training on all rows; not made current "
+              f"(activate it with: python model_registry.py use {version})")
+    metrics.export("train_model")
+
 
-# Save the model
-model.save_model("xgb_rank_model.json")
-print("\nRanking model saved as xgb_rank_model.json")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,91 +1,120 @@
+import argparse
 import json
 import pandas as pd
 import os
-import re
+from addresses import address_key
+import feature_stats
+from feature_registry import FEATURE_NAMES, compile_batch_kernel
+import metrics
+from records import load_appraisals
 
 INPUT_FILE = "feature_engineered_appraisals_dataset.json"
 FEEDBACK_FILE = "feedback_log.csv"
 OUTPUT_FILE = "training_data.csv"
 OUTPUT_WITH_FEEDBACK = "training_data_with_feedback.csv"
+# orderID -> source_hash of the appraisals behind OUTPUT_FILE, for --incremental
+MANIFEST_FILE = "training_data_manifest.json"
 
-def safe_abs(val):
-    try:
-        return abs(val)
-    except:
-        return None
-
-def normalize_address(address):
-    address = str(address).lower().strip()
-    address = re.sub(r"\b(street|st\.?)\b", "st", address)
-    address = re.sub(r"\b(road|rd\.?)\b", "rd", address)
-    address = re.sub(r"\b(avenue|ave\.?)\b", "ave", address)
-    address = re.sub(r"\b(drive|dr\.?)\b", "dr", address)
-    address = re.sub(r"\b(unit|suite|apt)\b", "", address)
-    address = address.replace("-", " ").replace(",", "").replace(".", "")
-    address = re.sub(r"\s+", " ", address)
-    return address.strip()
-
-def make_row(order_id, subject, candidate, address, is_comp):
-    return {
-        "orderID": order_id,
-        "candidate_address": address,
-        "is_comp": is_comp,
-        "subject_address": subject.get("address"),
-
-        "bath_score_diff": candidate.get('bath_score_diff'),
-        "full_baths_diff": candidate.get('full_baths_diff'),
-        "half_baths_diff": candidate.get('half_baths_diff'),
-        "room_count_diff": candidate.get('room_count_diff'),
-        "bedrooms_diff": candidate.get('bedrooms_diff'),
-        "effective_age_diff": candidate.get('effective_age_diff'),
-        "subject_age_diff": candidate.get('subject_age_diff'),
-        "lot_size_sf_diff": candidate.get('lot_size_diff_sf'),
-        "gla_diff": candidate.get('gla_diff'),
-
-        "abs_bath_score_diff": safe_abs(candidate.get("bath_score_diff")),
-        "abs_full_bath_diff": safe_abs(candidate.get("full_baths_diff")),
-        "abs_half_bath_diff": safe_abs(candidate.get("half_baths_diff")),
-        "abs_room_count_diff": safe_abs(candidate.get("room_count_diff")),
-        "abs_bedrooms_diff": safe_abs(candidate.get("bedrooms_diff")),
-        "abs_effective_age_diff": safe_abs(candidate.get("effective_age_diff")),
-        "abs_subject_age_diff": safe_abs(candidate.get("subject_age_diff")),
-        "abs_lot_size_sf_diff": safe_abs(candidate.get("lot_size_diff_sf")),
-        "abs_gla_diff": safe_abs(candidate.get("gla_diff")),
-
-        "distance_to_subject_km": candidate.get('distance_to_subject_km'),
-        "same_property_type": candidate.get("same_property_type"),
-        "sold_recently": candidate.get("sold_recently")
-    }
+batch_kernel = compile_batch_kernel()
 
-def build_training_data_from_cleaned(cleaned_file):
-    with open(cleaned_file, "r") as f:
-        data = json.load(f)
+def collect_candidates(appraisals):
+    subjects = []
+    candidates = []
+    subject_index = []
+    groups = []
+    meta = {"orderID": [], "candidate_address": [], "is_comp": [], "subject_address": []}
 
-    rows = []
-
-    for appraisal in data["appraisals"]:
-        subject = appraisal["subject"]
-        order_id = str(appraisal.get("orderID", "UNKNOWN"))
+    for appraisal in appraisals:
+        subject = appraisal.subject
+        order_id = appraisal.order_id
         seen_addresses = set()
+        subjects.append(subject)
 
         # Build a lookup for comp labels
         comp_address_lookup = {
-            normalize_address(comp.get("address", ""))
-            for comp in appraisal.get("comps", [])
+            address_key(comp.address or "")
+            for comp in appraisal.comps
         }
 
         for group, label in [("comps", 1), ("properties", 0)]:
-            for prop in appraisal.get(group, []):
-                raw_address = prop.get("address", "")
-                norm_address = normalize_address(raw_address)
+            for prop in getattr(appraisal, group):
+                raw_address = prop.address or ""
+                norm_address = address_key(raw_address)
                 if not norm_address or norm_address in seen_addresses:
                     continue
 
                 is_comp = 1 if label == 1 else int(norm_address in comp_address_lookup)
-                rows.append(make_row(order_id, subject, prop, raw_address, is_comp))
+                candidates.append(prop)
+                subject_index.append(len(subjects) - 1)
+                groups.append(group)
+                meta["orderID"].append(order_id)
+                meta["candidate_address"].append(raw_address)
+                meta["is_comp"].append(is_comp)
+                meta["subject_address"].append(subject.get("address"))
                 seen_addresses.add(norm_address)
 
-    return pd.DataFrame(rows)
+    return {
+        "subjects": subjects,
+        "candidates": candidates,
+        "subject_index": subject_index,
+        "groups": groups,
+        "meta": meta,
+    }
+
+def select_candidates(table, keep):
+    rows = [i for i, k in enumerate(keep) if k]
+    return {
+        "subjects": table["subjects"],
+        "candidates": [table["candidates"][i] for i in rows],
+        "subject_index": [table["subject_index"][i] for i in rows],
+        "groups": [table["groups"][i] for i in rows],
+        "meta": {name: [values[i] for i in rows] for name, values in table["meta"].items()},
+    }
+
+def featurize(table, kernel=None):
+    kernel = kernel or batch_kernel
+    return kernel(table["subjects"], table["candidates"], table["subject_index"], table["groups"])
+
+def build_training_rows(appraisals):
+    table = collect_candidates(appraisals)
+    features = featurize(table)
+    return pd.DataFrame(table["meta"] | features, columns=list(table["meta"]) + FEATURE_NAMES)
+
+def build_training_data_from_cleaned(cleaned_file):
+    return build_training_rows(load_appraisals(cleaned_file))
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as f:
+        return json.load(f)
+
+def save_manifest(appraisals, manifest_file=MANIFEST_FILE):
+    with open(manifest_file, "w") as f:
+        json.dump({a.order_id: a.source_hash for a in appraisals}, f)
+
+# Rebuild rows only for orderIDs that are new or whose source_hash changed
+# since the existing training data was written
+def update_training_data(appraisals, existing_file=OUTPUT_FILE, manifest_file=MANIFEST_FILE):
+    manifest = load_manifest(manifest_file)
+    if not manifest or not os.path.exists(existing_file):
+        return build_training_rows(appraisals)
+
+    changed = [a for a in appraisals if a.source_hash is None or manifest.get(a.order_id) != a.source_hash]
+    changed_ids = {a.order_id for a in changed}
+    metrics.incr("incremental_orders_total", len(appraisals) - len(changed), stage="training_data", result="unchanged")
+    metrics.incr("incremental_orders_total", len(changed), stage="training_data", result="rebuilt")
+
+    # Orders gone from the input are dropped too, so the result matches a
+    # full rebuild; save_manifest then only lists the current orders
+    current_ids = {a.order_id for a in appraisals}
+    removed_ids = set(manifest) - current_ids
+    metrics.incr("incremental_orders_total", len(removed_ids), stage="training_data", result="removed")
+
+    existing = pd.read_csv(existing_file)
+    existing["orderID"] = existing["orderID"].astype(str)
+    existing = existing[existing["orderID"].isin(current_ids) & ~existing["orderID"].isin(changed_ids)]
+    return pd.concat([existing, build_training_rows(changed)], ignore_index=True)
 
 def apply_feedback(df, feedback_file):
     if not os.path.exists(feedback_file):
@@ -99,10 +128,10 @@ def apply_feedback(df, feedback_file):
 
     # Normalize for merge
     df["orderID"] = df["orderID"].astype(str)
-    df["norm_addr"] = df["candidate_address"].apply(normalize_address)
+    df["norm_addr"] = df["candidate_address"].apply(address_key)
 
     feedback_df["orderID"] = feedback_df["orderID"].astype(str)
-    feedback_df["norm_addr"] = feedback_df["candidate_address"].apply(normalize_address)
+    feedback_df["norm_addr"] = feedback_df["candidate_address"].apply(address_key)
 
     # Merge in feedback
     merged = df.merge(
@@ -122,14 +151,33 @@ def apply_feedback(df, feedback_file):
     return merged.drop(columns=["user_feedback", "norm_addr"], errors="ignore")
 
 
-if __name__ == "__main__":
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Build candidate training rows from the feature-engineered appraisals")
+    arg_parser.add_argument("--incremental", action="store_true", help="only rebuild rows for new or changed orderIDs")
+    args = arg_parser.parse_args(argv)
+
     if not os.path.exists(INPUT_FILE):
         raise FileNotFoundError(f"Input file not found: {INPUT_FILE}")
 
-    df = build_training_data_from_cleaned(INPUT_FILE)
+    appraisals = load_appraisals(INPUT_FILE)
+    with metrics.stage("training_data") as stage:
+        if args.incremental:
+            df = update_training_data(appraisals)
+        else:
+            df = build_training_rows(appraisals)
+        stage["items"] = len(df)
     df.to_csv(OUTPUT_FILE, index=False)
+    save_manifest(appraisals)
     print(f"Base training data saved to: {OUTPUT_FILE} ({df.shape})")
 
+    # Reference distribution for the drift check in score.py
+    feature_stats.save_stats(feature_stats.FeatureStats().update(df), feature_stats.REFERENCE_FILE)
+
     df_with_feedback = apply_feedback(df.copy(), FEEDBACK_FILE)
     df_with_feedback.to_csv(OUTPUT_WITH_FEEDBACK, index=False)
     print(f"Training data with feedback saved to: {OUTPUT_WITH_FEEDBACK} ({df_with_feedback.shape})")
+    metrics.export("training_data")
+
+
+if __name__ == "__main__":
+    main()
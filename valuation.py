@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import cascade as cascade_pruning
+import forest
+import metrics
+import model_registry
+import score
+import training_data
+from feature_registry import FEATURE_COLS
+from records import load_appraisals
+
+# Config
+INPUT_FILE = "feature_engineered_appraisals_dataset.json"
+OUTPUT_FILE = "valuations.json"
+FEEDBACK_FILE = training_data.FEEDBACK_FILE
+TOP_K = 3
+WEIGHTINGS = ["equal", "score", "distance"]
+
+# Distances below this count as this close, so a comp at 0 km does not take
+# all the weight
+MIN_DISTANCE_KM = 0.1
+
+# Value estimates
+#
+# Every order's candidates are scored in one vectorized pass, the top-k by
+# score are kept, and their sale prices give the estimate: a weighted mean
+# (equal weights, softmax of the model score, or inverse distance) plus the
+# min, max and midpoint the app shows. Candidates without a sale price are
+# skipped, the same way the app skips them, and candidates rejected in the
+# feedback log are dropped first, as in the rows the app shows. Results are written as a JSON
+# object keyed by orderID so the app and scoring service look an order up
+# directly.
+
+
+def _weights(df, weighting):
+    if weighting == "equal":
+        return pd.Series(1.0, index=df.index)
+    if weighting == "score":
+        # Softmax within each order; scores are only comparable inside an order
+        shifted = df["score"] - df.groupby("orderID")["score"].transform("max")
+        return np.exp(shifted)
+    if weighting == "distance":
+        return 1.0 / df["distance_to_subject_km"].clip(lower=MIN_DISTANCE_KM)
+    raise ValueError(f"Unknown weighting: {weighting}")
+
+
+def estimate_values(candidates, k=TOP_K, weighting="equal"):
+    # candidates: one row per candidate with orderID, score, sale_price and
+    # distance_to_subject_km
+    df = candidates.sort_values(["orderID", "score"], ascending=[True, False], kind="stable")
+    df = df[df.groupby("orderID").cumcount() < k]
+    df = df[df["sale_price"].notna()]
+
+    df = df.assign(weight=_weights(df, weighting))
+    # Distance weighting falls back to equal weights where distance is unknown
+    df["weight"] = df["weight"].fillna(1.0)
+    df["weighted_price"] = df["weight"] * df["sale_price"]
+
+    grouped = df.groupby("orderID")
+    out = pd.DataFrame({
+        "estimate": grouped["weighted_price"].sum() / grouped["weight"].sum(),
+        "min_price": grouped["sale_price"].min(),
+        "max_price": grouped["sale_price"].max(),
+        "num_prices": grouped["sale_price"].size(),
+    })
+    out["midpoint"] = out["min_price"] + (out["max_price"] - out["min_price"]) / 2
+    return out.reindex(candidates["orderID"].drop_duplicates().sort_values())
+
+
+def score_candidates(appraisals, model, cascade=None):
+    table = training_data.collect_candidates(appraisals)
+    if cascade is not None:
+        table = cascade_pruning.apply_cascade(table, cascade)
+    feats = training_data.featurize(table)
+    X = np.column_stack([feats[c] for c in model["feature_names"] or FEATURE_COLS])
+    return pd.DataFrame({
+        "orderID": table["meta"]["orderID"],
+        "candidate_address": table["meta"]["candidate_address"],
+        "is_comp": table["meta"]["is_comp"],
+        "score": forest.predict_forest(model, X).astype(float),
+        "sale_price": pd.to_numeric(pd.Series([c.sale_price for c in table["candidates"]], dtype=object), errors="coerce"),
+        "distance_to_subject_km": feats["distance_to_subject_km"],
+    })
+
+
+def _json_value(val):
+    if pd.isna(val):
+        return None
+    return int(val) if float(val).is_integer() else round(float(val), 2)
+
+
+def save_valuations(values, output_file=OUTPUT_FILE, **meta):
+    orders = {
+        str(order_id): {name: _json_value(val) for name, val in row.items()}
+        for order_id, row in values.iterrows()
+    }
+    tmp_path = f"{output_file}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"meta": meta, "orders": orders}, f)
+    os.replace(tmp_path, output_file)
+
+
+def load_valuations(path=OUTPUT_FILE):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_valuation(valuations, order_id):
+    return valuations["orders"].get(str(order_id))
+
+
+def print_summary(values):
+    valued = values["estimate"].notna()
+    print(f"Valued {int(valued.sum())} of {len(values)} orders")
+    if valued.any():
+        est = values.loc[valued, "estimate"]
+        spread = (values.loc[valued, "max_price"] - values.loc[valued, "min_price"]) / est
+        print(f"Estimate median {est.median():,.0f}, p10 {est.quantile(0.1):,.0f}, p90 {est.quantile(0.9):,.0f}")
+        print(f"Median price spread of the top-k: {spread.median():.1%}")
+
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Precompute value estimates for every order from its top-k candidates")
+    arg_parser.add_argument("--input", default=INPUT_FILE)
+    arg_parser.add_argument("--model", help="model file (default: current registry version)")
+    arg_parser.add_argument("-k", type=int, default=TOP_K)
+    arg_parser.add_argument("--weighting", choices=WEIGHTINGS, default="equal")
+    arg_parser.add_argument("--output", default=OUTPUT_FILE)
+    arg_parser.add_argument("--csv", help="also write the estimates as CSV for reporting")
+    arg_parser.add_argument("--cascade", action="store_true", help="prune candidates with the cascade rules before scoring")
+    arg_parser.add_argument("--cascade-stage1", action="store_true", help="also keep only the first-stage model's best candidates")
+    args = arg_parser.parse_args(argv)
+    cascade = cascade_pruning.cascade_config(args.cascade_stage1) if args.cascade or args.cascade_stage1 else None
+
+    model = score.load_scoring_model(args.model)
+    appraisals = load_appraisals(args.input)
+    with metrics.stage("valuation", items=len(appraisals)):
+        # Same feedback filtering as training_data_with_feedback.csv, which the app's comps come from
+        candidates = training_data.apply_feedback(score_candidates(appraisals, model, cascade), FEEDBACK_FILE)
+        values = estimate_values(candidates, args.k, args.weighting)
+
+    save_valuations(
+        values, args.output,
+        k=args.k, weighting=args.weighting, feedback_filtered=os.path.exists(FEEDBACK_FILE), model_version=model_registry.current_version() if not args.model else None,
+        model_file=args.model or model_registry.model_path(), created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    print(f"Saved value estimates to {args.output}")
+    if args.csv:
+        values.to_csv(args.csv, index_label="orderID")
+        print(f"Saved value estimates to {args.csv}")
+    print_summary(values)
+    metrics.export("valuation")
+
+
+if __name__ == "__main__":
+    main()